@@ -6,16 +6,12 @@ Incluye sincronización automática, emails y gestión de archivos adjuntos
 import os
 import json
 import sqlite3
-import smtplib
-import threading
-import time
 from datetime import datetime
 from flask import Flask, render_template, request, jsonify, redirect, url_for, flash, session
 from werkzeug.utils import secure_filename
-from email.mime.text import MimeText
-from email.mime.multipart import MimeMultipart
-from email.mime.base import MimeBase
-from email import encoders
+from email_outbox import EmailOutbox
+from attachment_store import attachment_store, install_attachment_store
+from upload_ingest import collect_uploads, init_app as init_upload_ingest
 
 # Importar módulo de Google Drive
 try:
@@ -32,6 +28,8 @@ app.secret_key = 'tu-clave-secreta-super-segura-cambiar-en-produccion'
 # Configuración
 UPLOAD_FOLDER = 'temp_uploads'
 ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif', 'pdf', 'txt', 'docx'}
+# Adjuntos recibidos por streaming directo al almacén, con límites de tamaño (413)
+init_upload_ingest(app, ALLOWED_EXTENSIONS)
 DATABASE = 'tickets.db'
 AUTO_SYNC_INTERVAL = 300  # 5 minutos
 
@@ -42,6 +40,8 @@ EMAIL_CONFIG = {
     'smtp_port': 587,
     'email': 'tu-email@gmail.com',  # Cambiar por tu email
     'password': 'tu-app-password',  # Cambiar por tu app password
+    'use_tls': True,
+    'coalesce_window': 60,  # Segundos en que se juntan los avisos para un mismo destinatario
     'developers': [
         'dev1@empresa.com',
         'dev2@empresa.com'
@@ -55,7 +55,11 @@ class TicketSystemComplete:
     def __init__(self):
         self.init_database()
         self.drive_manager = None
-        self.sync_thread = None
+        
+        # Bandeja de salida de correos (un worker con sesión SMTP reutilizada)
+        self.email_outbox = EmailOutbox(EMAIL_CONFIG)
+        if EMAIL_CONFIG['enabled']:
+            self.email_outbox.start()
         
         # Inicializar Google Drive si está disponible
         if GOOGLE_DRIVE_AVAILABLE:
@@ -145,7 +149,17 @@ class TicketSystemComplete:
             ''', (username, email, is_dev))
         
         conn.commit()
+        
+        # Adjuntos direccionados por contenido
+        install_attachment_store(conn)
         conn.close()
+        
+        # Adjuntos antiguos de temp_uploads al almacén por contenido
+        try:
+            attachment_store.migrate_legacy(UPLOAD_FOLDER)
+            attachment_store.collect_garbage()
+        except Exception as e:
+            print(f"⚠️ Mantenimiento de adjuntos fallido: {e}")
         print("✅ Base de datos inicializada")
 
     def init_google_drive(self):
@@ -162,26 +176,21 @@ class TicketSystemComplete:
             print(f"❌ Error inicializando Google Drive: {e}")
 
     def start_auto_sync(self):
-        """Inicia la sincronización automática en background"""
+        """Activa la sincronización periódica en el planificador de Drive"""
         if self.drive_manager and self.drive_manager.authenticated:
-            def auto_sync_worker():
-                while True:
-                    try:
-                        time.sleep(AUTO_SYNC_INTERVAL)
-                        print("🔄 Ejecutando sincronización automática...")
-                        self.sync_to_drive()
-                    except Exception as e:
-                        print(f"❌ Error en sincronización automática: {e}")
-            
-            self.sync_thread = threading.Thread(target=auto_sync_worker, daemon=True)
-            self.sync_thread.start()
+            # El mismo hilo atiende los cambios y la sincronización periódica: nunca dos subidas a la vez
+            self.drive_manager.sync_scheduler.start(interval=AUTO_SYNC_INTERVAL)
             print(f"🔄 Sincronización automática iniciada (cada {AUTO_SYNC_INTERVAL//60} minutos)")
 
     def allowed_file(self, filename):
         return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
     def create_ticket(self, title, description, category, priority, user_id, attachments=None):
-        """Crea un nuevo ticket"""
+        """Crea un nuevo ticket
+
+        `attachments` son dicts con 'stored_name', 'original_name' y 'blob'
+        (resultado de attachment_store.save_stream).
+        """
         conn = sqlite3.connect(DATABASE)
         cursor = conn.cursor()
         
@@ -193,43 +202,47 @@ class TicketSystemComplete:
         
         ticket_id = cursor.lastrowid
         
-        # Procesar archivos adjuntos
-        drive_attachments = []
-        local_attachments = []
-        
-        if attachments:
-            for attachment in attachments:
-                # Guardar localmente
-                local_attachments.append(attachment)
-                
-                # Subir a Google Drive si está disponible
-                if self.drive_manager and self.drive_manager.authenticated:
-                    file_path = os.path.join(UPLOAD_FOLDER, attachment)
-                    if os.path.exists(file_path):
-                        drive_info = self.drive_manager.upload_attachment(file_path, ticket_id)
-                        if drive_info:
-                            drive_attachments.append(drive_info)
+        # Los nombres guardados siguen en tickets.attachments; el contenido, en el almacén por hash
+        local_attachments = list(attachments or [])
+        stored_names = [attachment['stored_name'] for attachment in local_attachments]
         
         # Actualizar ticket con información de adjuntos
         cursor.execute('''
             UPDATE tickets 
-            SET attachments = ?, drive_attachments = ?
+            SET attachments = ?
             WHERE id = ?
         ''', (
-            json.dumps(local_attachments) if local_attachments else None,
-            json.dumps(drive_attachments) if drive_attachments else None,
+            json.dumps(stored_names) if stored_names else None,
             ticket_id
         ))
+        for attachment in local_attachments:
+            attachment_store.attach(conn, ticket_id, attachment['blob'],
+                                    attachment['stored_name'], attachment['original_name'])
+        
+        # Subida a Google Drive en segundo plano; drive_attachments se completa al terminar cada archivo
+        uploads = 0
+        if local_attachments and self.drive_manager and self.drive_manager.authenticated:
+            uploads = self.drive_manager.attachment_uploader.enqueue(ticket_id, [
+                {'path': attachment['blob']['path'],
+                 'original_name': attachment['original_name'],
+                 'hash': attachment['blob']['hash']}
+                for attachment in local_attachments
+            ], conn)
+        
+        # Datos del correo leídos con la misma conexión
+        email_ticket = self.get_email_ticket(cursor, ticket_id)
         
         conn.commit()
         conn.close()
+        if uploads:
+            self.drive_manager.attachment_uploader.wake()
         
-        # Enviar notificación por email
-        self.send_email_notification(ticket_id, 'new')
+        # Encolar notificación por email
+        self.send_email_notification(ticket_id, 'new', email_ticket)
         
-        # Sincronizar a Drive
+        # Marcar cambios para Drive (el planificador agrupa y sube una vez)
         if self.drive_manager:
-            threading.Thread(target=self.sync_to_drive, daemon=True).start()
+            self.drive_manager.schedule_sync()
         
         print(f"✅ Ticket #{ticket_id} creado: {title}")
         return ticket_id
@@ -303,113 +316,101 @@ class TicketSystemComplete:
                 VALUES (?, ?, ?)
             ''', (ticket_id, assigned_to, comment))
         
+        email_ticket = self.get_email_ticket(cursor, ticket_id)
+        
         conn.commit()
         conn.close()
         
-        # Enviar notificación
-        self.send_email_notification(ticket_id, 'update')
+        # Encolar notificación
+        self.send_email_notification(ticket_id, 'update', email_ticket)
         
-        # Sincronizar a Drive
+        # Marcar cambios para Drive (el planificador agrupa y sube una vez)
         if self.drive_manager:
-            threading.Thread(target=self.sync_to_drive, daemon=True).start()
+            self.drive_manager.schedule_sync()
         
         print(f"✅ Ticket #{ticket_id} actualizado a: {status}")
 
-    def send_email_notification(self, ticket_id, action):
-        """Envía notificaciones por email"""
+    def get_email_ticket(self, cursor, ticket_id):
+        """Datos del ticket que necesita el correo, con el cursor de la operación en curso"""
+        cursor.execute('''
+            SELECT t.title, t.description, t.category, t.priority, t.status,
+                   t.created_at, t.updated_at, t.resolved_at,
+                   u.username, u.email, d.username as dev_name, d.email as dev_email
+            FROM tickets t
+            JOIN users u ON t.user_id = u.id
+            LEFT JOIN users d ON t.assigned_to = d.id
+            WHERE t.id = ?
+        ''', (ticket_id,))
+        row = cursor.fetchone()
+        if not row:
+            return None
+        keys = ('title', 'description', 'category', 'priority', 'status', 'created_at', 'updated_at',
+                'resolved_at', 'username', 'email', 'dev_name', 'dev_email')
+        return dict(zip(keys, row))
+
+    def send_email_notification(self, ticket_id, action, ticket):
+        """Encola notificaciones por email; el worker de la bandeja las envía"""
         if not EMAIL_CONFIG['enabled']:
             print(f"📧 Email deshabilitado - Notificación para ticket {ticket_id}: {action}")
             return
         
+        if not ticket:
+            return
+        
         try:
-            # Obtener información del ticket
-            conn = sqlite3.connect(DATABASE)
-            cursor = conn.cursor()
-            cursor.execute('''
-                SELECT t.*, u.username, u.email, d.username as dev_name, d.email as dev_email
-                FROM tickets t
-                JOIN users u ON t.user_id = u.id
-                LEFT JOIN users d ON t.assigned_to = d.id
-                WHERE t.id = ?
-            ''', (ticket_id,))
-            ticket = cursor.fetchone()
-            conn.close()
-            
-            if not ticket:
-                return
-            
-            # Configurar mensaje
-            msg = MimeMultipart()
-            msg['From'] = EMAIL_CONFIG['email']
-            
             if action == 'new':
-                msg['To'] = ', '.join(EMAIL_CONFIG['developers'])
-                msg['Subject'] = f'[NUEVO TICKET #{ticket_id}] {ticket[1]}'
+                recipients = EMAIL_CONFIG['developers']
+                subject = f'[NUEVO TICKET #{ticket_id}] {ticket["title"]}'
                 
                 body = f"""
 🎫 NUEVO TICKET CREADO
 
 Ticket #: {ticket_id}
-Título: {ticket[1]}
-Usuario: {ticket[12]} ({ticket[13]})
-Categoría: {ticket[3]}
-Prioridad: {ticket[4]}
+Título: {ticket['title']}
+Usuario: {ticket['username']} ({ticket['email']})
+Categoría: {ticket['category']}
+Prioridad: {ticket['priority']}
 
 Descripción:
-{ticket[2]}
+{ticket['description']}
 
-Estado: {ticket[5]}
-Fecha de creación: {ticket[8]}
+Estado: {ticket['status']}
+Fecha de creación: {ticket['created_at']}
 
 🔗 Accede al sistema para ver más detalles y asignar el ticket.
                 """
             
             elif action == 'update':
-                # Notificar al usuario original
-                msg['To'] = ticket[13]  # Email del usuario
-                if ticket[15]:  # Si hay desarrollador asignado, incluirlo
-                    msg['Cc'] = ticket[15]
-                
-                msg['Subject'] = f'[ACTUALIZACIÓN TICKET #{ticket_id}] {ticket[1]}'
+                # Notificar al usuario original y al desarrollador asignado
+                recipients = [ticket['email'], ticket['dev_email']]
+                subject = f'[ACTUALIZACIÓN TICKET #{ticket_id}] {ticket["title"]}'
                 
                 body = f"""
 🔄 TICKET ACTUALIZADO
 
 Ticket #: {ticket_id}
-Título: {ticket[1]}
-Estado actual: {ticket[5]}
-Desarrollador asignado: {ticket[14] or 'Sin asignar'}
+Título: {ticket['title']}
+Estado actual: {ticket['status']}
+Desarrollador asignado: {ticket['dev_name'] or 'Sin asignar'}
 
-Última actualización: {ticket[9]}
-{f'Resuelto el: {ticket[10]}' if ticket[10] else ''}
+Última actualización: {ticket['updated_at']}
+{f"Resuelto el: {ticket['resolved_at']}" if ticket['resolved_at'] else ''}
 
 🔗 Accede al sistema para ver todos los detalles.
                 """
+            else:
+                return
             
-            msg.attach(MimeText(body, 'plain'))
-            
-            # Enviar email
-            server = smtplib.SMTP(EMAIL_CONFIG['smtp_server'], EMAIL_CONFIG['smtp_port'])
-            server.starttls()
-            server.login(EMAIL_CONFIG['email'], EMAIL_CONFIG['password'])
-            
-            recipients = msg['To'].split(', ')
-            if 'Cc' in msg:
-                recipients.extend(msg['Cc'].split(', '))
-            
-            text = msg.as_string()
-            server.sendmail(EMAIL_CONFIG['email'], recipients, text)
-            server.quit()
-            
-            print(f"📧 Email enviado para ticket {ticket_id} - {action}")
+            queued = self.email_outbox.enqueue(recipients, subject, body, ticket_id=ticket_id, action=action)
+            print(f"📧 Email encolado para ticket {ticket_id} - {action} ({queued} destinatarios)")
             
         except Exception as e:
-            print(f"❌ Error enviando email para ticket {ticket_id}: {e}")
+            print(f"❌ Error encolando email para ticket {ticket_id}: {e}")
 
     def sync_to_drive(self):
-        """Sincroniza datos locales a Google Drive"""
+        """Sincroniza datos locales a Google Drive y espera el resultado"""
         if self.drive_manager and self.drive_manager.authenticated:
-            success = self.drive_manager.sync_tickets_to_drive()
+            success = self.drive_manager.sync_scheduler.sync_now()
             if success:
                 print("☁️ Sincronización a Drive exitosa")
             return success
@@ -494,13 +495,17 @@ Desarrollador asignado: {ticket[14] or 'Sin asignar'}
             'database': 'OK',
             'google_drive': 'Desconectado',
             'email': 'Configurado' if EMAIL_CONFIG['enabled'] else 'Deshabilitado',
-            'auto_sync': 'Activo' if self.sync_thread and self.sync_thread.is_alive() else 'Inactivo'
+            'auto_sync': 'Inactivo',
+            'email_outbox': self.email_outbox.get_metrics() if EMAIL_CONFIG['enabled'] else None
         }
         
         if self.drive_manager:
             drive_status = self.drive_manager.get_drive_status()
             status['google_drive'] = drive_status.get('status', 'Error')
             status['drive_details'] = drive_status
+            scheduler = self.drive_manager.sync_scheduler.get_stats()
+            if scheduler['running'] and scheduler['interval_seconds']:
+                status['auto_sync'] = 'Activo'
         
         return status
 
@@ -576,15 +581,17 @@ def create_ticket():
     # Manejar archivos adjuntos
     attachments = []
     if 'attachments' in request.files:
-        files = request.files.getlist('attachments')
-        for file in files:
-            if file and ticket_system.allowed_file(file.filename):
-                filename = secure_filename(file.filename)
-                timestamp = datetime.now().strftime('%Y%m%d_%H%M%S_')
-                filename = timestamp + filename
-                file_path = os.path.join(UPLOAD_FOLDER, filename)
-                file.save(file_path)
-                attachments.append(filename)
+        files = [file for file in request.files.getlist('attachments')
+                 if file and ticket_system.allowed_file(file.filename)]
+        # Ya escritos en el almacén mientras se recibía la petición (hash y tipo MIME incluidos)
+        for upload in collect_uploads(files):
+            original_name = secure_filename(upload['original_name'])
+            timestamp = datetime.now().strftime('%Y%m%d_%H%M%S_')
+            attachments.append({
+                'stored_name': timestamp + original_name,
+                'original_name': original_name,
+                'blob': upload['blob']
+            })
     
     ticket_id = ticket_system.create_ticket(title, description, category, priority, user_id, attachments)
     
@@ -639,6 +646,12 @@ def api_stats():
         'system_status': system_status
     })
 
+@app.errorhandler(413)
+def request_entity_too_large(e):
+    # Límites de upload_ingest: los archivos a medio recibir ya se descartaron
+    flash(f'Adjuntos demasiado grandes: {e.description}', 'error')
+    return redirect(url_for('dashboard'))
+
 if __name__ == '__main__':
     print("🎫 Sistema de Tickets Completo v2.0")
     print("=" * 50)
@@ -5,12 +5,23 @@ Sin rutas duplicadas - Integrado con Google Drive y Telegram
 
 import os
 import json
+import base64
 import sqlite3
 import threading
 import time
+import mimetypes
 from datetime import datetime
-from flask import Flask, render_template, request, jsonify, redirect, url_for, flash, session, send_file
+from flask import Flask, Response, render_template, request, jsonify, redirect, url_for, flash, session, send_file, stream_with_context, has_request_context
 from werkzeug.utils import secure_filename
+from db_pool import DATABASE, db_connection, get_db, get_pool_metrics, init_app as init_db_pool
+from ticket_stats import StatisticsEngine, install_counters
+from db_schema import get_schema_status, migrate as migrate_schema
+from notification_log import NOTIFICATIONS_LOG, QUERY_LIMIT, format_record, notification_log
+from change_feed import AUDIENCE_DEVELOPERS, LONG_POLL_TIMEOUT, change_feed, parse_event_id
+from attachment_store import attachment_store, install_attachment_store
+from attachment_previews import PREVIEW_MIME, PREVIEW_SIZES, install_attachment_previews, preview_worker
+from upload_ingest import collect_uploads, get_ingest_metrics, init_app as init_upload_ingest
+from ticket_search import SEARCH_FILTERS, SEARCH_LIMIT, SearchUnavailableError, install_search, search_tickets
 
 # Intentar importar Google Drive y Telegram
 try:
@@ -22,7 +33,7 @@ except ImportError as e:
     GOOGLE_DRIVE_AVAILABLE = False
 
 try:
-    from telegram_notifications import send_telegram_notification, notify_new_ticket_async, notify_ticket_update_async
+    from telegram_notifications import send_telegram_notification, notify_new_ticket_async, notify_ticket_update_async, get_outbox_metrics, get_delivery_settings
     TELEGRAM_AVAILABLE = True
     print("✅ Telegram API disponible")
 except ImportError as e:
@@ -32,11 +43,39 @@ except ImportError as e:
 # Configuración de la aplicación
 app = Flask(__name__)
 app.secret_key = 'tu-clave-secreta-super-segura-cambiar-en-produccion'
+init_db_pool(app)
 
 # Configuración
 UPLOAD_FOLDER = 'temp_uploads'
 ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif', 'pdf', 'txt', 'docx'}
-DATABASE = 'tickets.db'
+# Adjuntos recibidos por streaming directo al almacén, con límites de tamaño (413)
+init_upload_ingest(app, ALLOWED_EXTENSIONS)
+ATTACHMENT_CACHE_MAX_AGE = 86400      # El contenido de una URL de adjunto no cambia nunca
+ATTACHMENT_DRIVE_FALLBACK = True      # Servir desde Drive los adjuntos que faltan en local
+PREVIEW_CACHE_MAX_AGE = 31536000      # Una miniatura depende solo del hash y el tamaño: no caduca
+TICKETS_PAGE_SIZE = 25
+TICKETS_PAGE_MAX = 100
+
+# Columnas base de tickets en su orden original (las plantillas acceden por posición)
+TICKET_COLUMNS_SQL = '''t.id, t.title, t.description, t.category, t.priority, t.status,
+               t.user_id, t.assigned_to, t.created_at, t.updated_at, t.resolved_at,
+               t.attachments, t.drive_attachments'''
+
+TICKET_LIST_COLUMNS = ['id', 'title', 'description', 'category', 'priority', 'status',
+                       'created_at', 'updated_at', 'attachments', 'user_name', 'developer_name',
+                       'status_rank', 'priority_rank', 'user_id']
+TICKET_LIST_SQL = '''
+    SELECT t.id, t.title, t.description, t.category, t.priority, t.status,
+           t.created_at, t.updated_at, t.attachments,
+           u.username as user_name, d.username as developer_name,
+           t.status_rank, t.priority_rank, t.user_id
+    FROM tickets t
+    LEFT JOIN users u ON t.user_id = u.id
+    LEFT JOIN users d ON t.assigned_to = d.id'''
+
+# Estadísticas que se envían como deltas por el feed de cambios
+LIVE_STATS_KEYS = ['total_tickets', 'open_tickets', 'in_progress_tickets', 'resolved_tickets',
+                   'avg_resolution_hours', 'total_users', 'total_developers', 'total_comments']
 
 # Crear carpetas necesarias
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
@@ -45,6 +84,9 @@ class TicketSystemComplete:
     def __init__(self):
         self.init_database()
         self.drive_manager = None
+        self.stats_engine = StatisticsEngine()
+        self._feed_lock = threading.Lock()
+        self._published_stats = None
         
         # Inicializar Google Drive si está disponible
         if GOOGLE_DRIVE_AVAILABLE:
@@ -63,136 +105,181 @@ class TicketSystemComplete:
         
     def init_database(self):
         """Inicializa la base de datos SQLite local"""
-        conn = sqlite3.connect(DATABASE)
-        cursor = conn.cursor()
-        
-        # Tabla de usuarios
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS users (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                username TEXT UNIQUE NOT NULL,
-                email TEXT NOT NULL,
-                is_active BOOLEAN DEFAULT 1,
-                is_developer BOOLEAN DEFAULT 0,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
-        
-        # Tabla de tickets - CON drive_attachments
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS tickets (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                title TEXT NOT NULL,
-                description TEXT NOT NULL,
-                category TEXT NOT NULL,
-                priority TEXT NOT NULL,
-                status TEXT DEFAULT 'Abierto',
-                user_id INTEGER,
-                assigned_to INTEGER,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                resolved_at TIMESTAMP,
-                attachments TEXT,
-                drive_attachments TEXT,
-                FOREIGN KEY (user_id) REFERENCES users (id),
-                FOREIGN KEY (assigned_to) REFERENCES users (id)
-            )
-        ''')
+        with db_connection() as conn:
+            cursor = conn.cursor()
         
-        # Tabla de comentarios
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS comments (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                ticket_id INTEGER,
-                user_id INTEGER,
-                comment TEXT NOT NULL,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (ticket_id) REFERENCES tickets (id),
-                FOREIGN KEY (user_id) REFERENCES users (id)
-            )
-        ''')
+            # Tabla de usuarios
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS users (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    username TEXT UNIQUE NOT NULL,
+                    email TEXT NOT NULL,
+                    is_active BOOLEAN DEFAULT 1,
+                    is_developer BOOLEAN DEFAULT 0,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            ''')
         
-        # Tabla de configuración del sistema
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS system_config (
-                key TEXT PRIMARY KEY,
-                value TEXT,
-                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
+            # Tabla de tickets - CON drive_attachments
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS tickets (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    title TEXT NOT NULL,
+                    description TEXT NOT NULL,
+                    category TEXT NOT NULL,
+                    priority TEXT NOT NULL,
+                    status TEXT DEFAULT 'Abierto',
+                    user_id INTEGER,
+                    assigned_to INTEGER,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    resolved_at TIMESTAMP,
+                    attachments TEXT,
+                    drive_attachments TEXT,
+                    FOREIGN KEY (user_id) REFERENCES users (id),
+                    FOREIGN KEY (assigned_to) REFERENCES users (id)
+                )
+            ''')
         
-        # Crear usuarios por defecto
-        cursor.execute('''
-            INSERT OR IGNORE INTO users (username, email, is_developer) 
-            VALUES ('admin', 'admin@empresa.com', 1)
-        ''')
+            # Tabla de comentarios
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS comments (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    ticket_id INTEGER,
+                    user_id INTEGER,
+                    comment TEXT NOT NULL,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    FOREIGN KEY (ticket_id) REFERENCES tickets (id),
+                    FOREIGN KEY (user_id) REFERENCES users (id)
+                )
+            ''')
         
-        # Agregar algunos usuarios de ejemplo
-        example_users = [
-            ('juan.perez', 'juan.perez@empresa.com', 0),
-            ('maria.garcia', 'maria.garcia@empresa.com', 0),
-            ('carlos.dev', 'carlos.dev@empresa.com', 1),
-            ('ana.support', 'ana.support@empresa.com', 1)
-        ]
+            # Tabla de configuración del sistema
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS system_config (
+                    key TEXT PRIMARY KEY,
+                    value TEXT,
+                    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            ''')
         
-        for username, email, is_dev in example_users:
+            # Crear usuarios por defecto
             cursor.execute('''
                 INSERT OR IGNORE INTO users (username, email, is_developer) 
-                VALUES (?, ?, ?)
-            ''', (username, email, is_dev))
+                VALUES ('admin', 'admin@empresa.com', 1)
+            ''')
         
-        conn.commit()
-        conn.close()
+            # Agregar algunos usuarios de ejemplo
+            example_users = [
+                ('juan.perez', 'juan.perez@empresa.com', 0),
+                ('maria.garcia', 'maria.garcia@empresa.com', 0),
+                ('carlos.dev', 'carlos.dev@empresa.com', 1),
+                ('ana.support', 'ana.support@empresa.com', 1)
+            ]
+        
+            for username, email, is_dev in example_users:
+                cursor.execute('''
+                    INSERT OR IGNORE INTO users (username, email, is_developer) 
+                    VALUES (?, ?, ?)
+                ''', (username, email, is_dev))
+        
+            conn.commit()
+        
+            # Migraciones versionadas: índices y rangos de orden almacenados
+            migrate_schema(conn)
+        
+            # Contadores materializados de estadísticas (triggers)
+            install_counters(conn)
+        
+            # Índice de búsqueda de texto completo (FTS5)
+            install_search(conn)
+        
+            # Adjuntos direccionados por contenido
+            install_attachment_store(conn)
+            install_attachment_previews(conn)
+        
+        # Adjuntos antiguos de temp_uploads al almacén por contenido
+        try:
+            attachment_store.migrate_legacy(UPLOAD_FOLDER)
+            attachment_store.collect_garbage()
+            preview_worker.collect_garbage()
+        except Exception as e:
+            print(f"⚠️ Mantenimiento de adjuntos fallido: {e}")
+        # Vistas previas que quedaron pendientes en la ejecución anterior
+        preview_worker.start()
         print("✅ Base de datos inicializada")
 
     def allowed_file(self, filename):
         return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
     
     def sync_to_drive(self):
-        """Sincroniza datos locales a Google Drive"""
+        """Sincroniza datos locales a Google Drive y espera el resultado
+
+        Pasa por el planificador: si hay una subida en curso no se lanza otra en paralelo.
+        """
         if self.drive_manager and self.drive_manager.authenticated:
-            return self.drive_manager.sync_tickets_to_drive()
+            return self.drive_manager.sync_scheduler.sync_now()
         return False
 
     def sync_from_drive(self):
         """Sincroniza datos desde Google Drive"""
         if self.drive_manager and self.drive_manager.authenticated:
-            return self.drive_manager.sync_tickets_from_drive()
+            success = self.drive_manager.sync_tickets_from_drive()
+            # La base descargada puede venir sin contadores o con otra versión
+            self.init_database()
+            # Los adjuntos de la base descargada pueden no estar en este disco
+            attachment_store.refresh_availability()
+            self.invalidate_statistics()
+            # Todo pudo cambiar: los dashboards abiertos deben recargar
+            change_feed.publish('reset', {'reason': 'sync_from_drive'})
+            return success
         return False
 
     def create_ticket(self, title, description, category, priority, user_id, attachments=None):
-        """Crea un nuevo ticket"""
-        conn = sqlite3.connect(DATABASE)
-        cursor = conn.cursor()
-        
-        # Procesar archivos adjuntos
-        drive_attachments = []
-        local_attachments = []
-        
-        if attachments:
-            for attachment in attachments:
-                # Guardar localmente
-                local_attachments.append(attachment)
-                
-                # Subir a Google Drive si está disponible
-                if self.drive_manager and self.drive_manager.authenticated:
-                    file_path = os.path.join(UPLOAD_FOLDER, attachment)
-                    if os.path.exists(file_path):
-                        drive_info = self.drive_manager.upload_attachment(file_path, None)  # ticket_id se agregará después
-                        if drive_info:
-                            drive_attachments.append(drive_info)
+        """Crea un nuevo ticket
+
+        `attachments` son dicts con 'stored_name', 'original_name' y 'blob'
+        (resultado de attachment_store.save_stream).
+        """
+        with db_connection() as conn:
+            cursor = conn.cursor()
         
-        # Insertar ticket
-        cursor.execute('''
-            INSERT INTO tickets (title, description, category, priority, user_id, attachments, drive_attachments)
-            VALUES (?, ?, ?, ?, ?, ?, ?)
-        ''', (title, description, category, priority, user_id, 
-              json.dumps(local_attachments) if local_attachments else None,
-              json.dumps(drive_attachments) if drive_attachments else None))
+            # Los nombres guardados siguen en tickets.attachments (dashboard y réplica en Drive)
+            local_attachments = list(attachments or [])
+            stored_names = [attachment['stored_name'] for attachment in local_attachments]
         
-        ticket_id = cursor.lastrowid
-        conn.commit()
-        conn.close()
+            # Insertar ticket
+            cursor.execute('''
+                INSERT INTO tickets (title, description, category, priority, user_id, attachments)
+                VALUES (?, ?, ?, ?, ?, ?)
+            ''', (title, description, category, priority, user_id, 
+                  json.dumps(stored_names) if stored_names else None))
+        
+            ticket_id = cursor.lastrowid
+        
+            # Enlaces al almacén por contenido (las referencias se cuentan por trigger)
+            for attachment in local_attachments:
+                attachment_store.attach(conn, ticket_id, attachment['blob'],
+                                        attachment['stored_name'], attachment['original_name'])
+        
+            # Subida a Google Drive en segundo plano; drive_attachments se completa al terminar cada archivo
+            uploads = 0
+            if local_attachments and self.drive_manager and self.drive_manager.authenticated:
+                uploads = self.drive_manager.attachment_uploader.enqueue(ticket_id, [
+                    {'path': attachment['blob']['path'],
+                     'original_name': attachment['original_name'],
+                     'hash': attachment['blob']['hash']}
+                    for attachment in local_attachments
+                ], conn)
+            conn.commit()
+        if uploads:
+            self.drive_manager.attachment_uploader.wake()
+        # Miniaturas en segundo plano (imágenes y primera página de los PDF)
+        try:
+            preview_worker.enqueue([attachment['blob'] for attachment in local_attachments])
+        except Exception as e:
+            print(f"⚠️ Error programando vistas previas: {e}")
+        self.notify_change(ticket_id, 'new')
         
         # Notificación simple por log
         self.log_notification(ticket_id, 'new', title)
@@ -204,92 +291,107 @@ class TicketSystemComplete:
             except Exception as e:
                 print(f"Error enviando notificación Telegram: {e}")
         
-        # Sincronizar a Drive
+        # Marcar cambios para Drive (el planificador agrupa y sube una vez)
         if self.drive_manager:
-            threading.Thread(target=self.sync_to_drive, daemon=True).start()
+            self.drive_manager.schedule_sync()
         
         print(f"✅ Ticket #{ticket_id} creado: {title}")
         return ticket_id
 
-    def get_tickets(self, user_id=None, is_developer=False):
-        """Obtiene tickets según el tipo de usuario"""
-        conn = sqlite3.connect(DATABASE)
-        cursor = conn.cursor()
-        
+    def get_tickets_page(self, user_id=None, is_developer=False, limit=TICKETS_PAGE_SIZE, cursor_token=None):
+        """Obtiene una página de tickets con paginación por cursor (keyset)
+
+        Desarrolladores: orden (status_rank, priority_rank, created_at DESC, id DESC)
+        Usuarios normales: sus tickets por (created_at DESC, id DESC)
+        Devuelve (tickets, next_cursor); next_cursor es None en la última página.
+        """
+        limit = max(1, min(int(limit), TICKETS_PAGE_MAX))
+        position = decode_cursor(cursor_token)
+        
+        conditions = []
+        params = []
+        
+        if not is_developer:
+            conditions.append('t.user_id = ?')
+            params.append(user_id)
+        
+        if position:
+            status_rank, priority_rank, created_at, last_id = position
+            if is_developer:
+                conditions.append('''(
+                    t.status_rank > ?
+                    OR (t.status_rank = ? AND t.priority_rank > ?)
+                    OR (t.status_rank = ? AND t.priority_rank = ? AND t.created_at < ?)
+                    OR (t.status_rank = ? AND t.priority_rank = ? AND t.created_at = ? AND t.id < ?)
+                )''')
+                params.extend([status_rank,
+                               status_rank, priority_rank,
+                               status_rank, priority_rank, created_at,
+                               status_rank, priority_rank, created_at, last_id])
+            else:
+                conditions.append('(t.created_at < ? OR (t.created_at = ? AND t.id < ?))')
+                params.extend([created_at, created_at, last_id])
+        
+        where = ('WHERE ' + ' AND '.join(conditions)) if conditions else ''
         if is_developer:
-            # Desarrolladores ven todos los tickets
-            cursor.execute('''
-                SELECT t.*, u.username as user_name, u.email as user_email,
-                       d.username as developer_name, d.email as developer_email
-                FROM tickets t
-                LEFT JOIN users u ON t.user_id = u.id
-                LEFT JOIN users d ON t.assigned_to = d.id
-                ORDER BY 
-                    CASE t.status 
-                        WHEN 'Abierto' THEN 1
-                        WHEN 'En Progreso' THEN 2
-                        WHEN 'Resuelto' THEN 3
-                        ELSE 4
-                    END,
-                    CASE t.priority
-                        WHEN 'Critical' THEN 1
-                        WHEN 'High' THEN 2
-                        WHEN 'Medium' THEN 3
-                        WHEN 'Low' THEN 4
-                        ELSE 5
-                    END,
-                    t.created_at DESC
-            ''')
+            order_by = 't.status_rank, t.priority_rank, t.created_at DESC, t.id DESC'
         else:
-            # Usuarios normales solo ven sus tickets
-            cursor.execute('''
-                SELECT t.*, u.username as user_name, u.email as user_email,
-                       d.username as developer_name, d.email as developer_email
-                FROM tickets t
-                LEFT JOIN users u ON t.user_id = u.id
-                LEFT JOIN users d ON t.assigned_to = d.id
-                WHERE t.user_id = ?
-                ORDER BY t.created_at DESC
-            ''', (user_id,))
-        
-        tickets = cursor.fetchall()
-        conn.close()
-        
-        return tickets
+            order_by = 't.created_at DESC, t.id DESC'
+        
+        with db_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(f'''
+                {TICKET_LIST_SQL}
+                {where}
+                ORDER BY {order_by}
+                LIMIT ?
+            ''', params + [limit + 1])
+            rows = cursor.fetchall()
+        
+        has_more = len(rows) > limit
+        tickets = [dict(zip(TICKET_LIST_COLUMNS, row)) for row in rows[:limit]]
+        
+        next_cursor = None
+        if has_more and tickets:
+            last = tickets[-1]
+            next_cursor = encode_cursor([last['status_rank'], last['priority_rank'],
+                                         last['created_at'], last['id']])
+        
+        return tickets, next_cursor
 
     def update_ticket_status(self, ticket_id, status, assigned_to=None, comment=None):
         """Actualiza el estado de un ticket"""
-        conn = sqlite3.connect(DATABASE)
-        cursor = conn.cursor()
-        
-        # Obtener estado anterior para Telegram
-        cursor.execute('SELECT title, status FROM tickets WHERE id = ?', (ticket_id,))
-        ticket_info = cursor.fetchone()
-        old_status = ticket_info[1] if ticket_info else 'Desconocido'
-        title = ticket_info[0] if ticket_info else 'Ticket sin título'
-        
-        if status == 'Resuelto':
-            cursor.execute('''
-                UPDATE tickets 
-                SET status = ?, assigned_to = ?, updated_at = CURRENT_TIMESTAMP, resolved_at = CURRENT_TIMESTAMP
-                WHERE id = ?
-            ''', (status, assigned_to, ticket_id))
-        else:
-            cursor.execute('''
-                UPDATE tickets 
-                SET status = ?, assigned_to = ?, updated_at = CURRENT_TIMESTAMP
-                WHERE id = ?
-            ''', (status, assigned_to, ticket_id))
-        
-        # Agregar comentario si se proporciona
-        if comment and assigned_to:
-            cursor.execute('''
-                INSERT INTO comments (ticket_id, user_id, comment)
-                VALUES (?, ?, ?)
-            ''', (ticket_id, assigned_to, comment))
-        
-        conn.commit()
-        conn.close()
+        with db_connection() as conn:
+            cursor = conn.cursor()
+        
+            # Obtener estado anterior para Telegram
+            cursor.execute('SELECT title, status FROM tickets WHERE id = ?', (ticket_id,))
+            ticket_info = cursor.fetchone()
+            old_status = ticket_info[1] if ticket_info else 'Desconocido'
+            title = ticket_info[0] if ticket_info else 'Ticket sin título'
+        
+            if status == 'Resuelto':
+                cursor.execute('''
+                    UPDATE tickets 
+                    SET status = ?, assigned_to = ?, updated_at = CURRENT_TIMESTAMP, resolved_at = CURRENT_TIMESTAMP
+                    WHERE id = ?
+                ''', (status, assigned_to, ticket_id))
+            else:
+                cursor.execute('''
+                    UPDATE tickets 
+                    SET status = ?, assigned_to = ?, updated_at = CURRENT_TIMESTAMP
+                    WHERE id = ?
+                ''', (status, assigned_to, ticket_id))
+        
+            # Agregar comentario si se proporciona
+            if comment and assigned_to:
+                cursor.execute('''
+                    INSERT INTO comments (ticket_id, user_id, comment)
+                    VALUES (?, ?, ?)
+                ''', (ticket_id, assigned_to, comment))
+        
+            conn.commit()
+        self.notify_change(ticket_id, 'update')
         
         # Notificación simple
         self.log_notification(ticket_id, 'update', f"Estado cambiado a: {status}")
@@ -301,103 +403,81 @@ class TicketSystemComplete:
             except Exception as e:
                 print(f"Error enviando notificación Telegram: {e}")
         
-        # Sincronizar a Drive
+        # Marcar cambios para Drive (el planificador agrupa y sube una vez)
         if self.drive_manager:
-            threading.Thread(target=self.sync_to_drive, daemon=True).start()
+            self.drive_manager.schedule_sync()
         
         print(f"✅ Ticket #{ticket_id} actualizado a: {status}")
 
-    def log_notification(self, ticket_id, action, details):
-        """Registra notificaciones en lugar de enviar emails"""
-        timestamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-        log_message = f"[{timestamp}] TICKET #{ticket_id} - {action.upper()}: {details}"
+    def log_notification(self, ticket_id, action, details, actor=None):
+        """Registra notificaciones en lugar de enviar emails
+
+        El registro se encola y lo escribe un hilo en background (JSON-lines rotado);
+        el eco en consola también sale de ese hilo.
+        """
+        if actor is None:
+            actor = session.get('username') if has_request_context() else 'sistema'
         
-        # Escribir a archivo de log
         try:
-            with open('notifications.log', 'a', encoding='utf-8') as f:
-                f.write(log_message + '\n')
+            record = notification_log.log(ticket_id, action, details, actor=actor)
         except Exception as e:
             print(f"Error escribiendo log: {e}")
+            return
         
-        # Mostrar en consola
-        print(f"📧 NOTIFICACIÓN: {log_message}")
+        # Publicar en los dashboards abiertos
+        change_feed.publish('notification', {'message': format_record(record)}, audience=AUDIENCE_DEVELOPERS)
+
+    def query_notifications(self, ticket_id=None, action=None, since=None, until=None, limit=QUERY_LIMIT):
+        """Consulta el historial de notificaciones (panel de administración)"""
+        return notification_log.query(ticket_id=ticket_id, action=action, since=since, until=until, limit=limit)
 
     def get_statistics(self):
-        """Obtiene estadísticas del sistema"""
-        conn = sqlite3.connect(DATABASE)
-        cursor = conn.cursor()
-        
-        # Estadísticas básicas
-        cursor.execute('SELECT COUNT(*) FROM tickets')
-        total_tickets = cursor.fetchone()[0]
-        
-        cursor.execute("SELECT COUNT(*) FROM tickets WHERE status = 'Abierto'")
-        open_tickets = cursor.fetchone()[0]
-        
-        cursor.execute("SELECT COUNT(*) FROM tickets WHERE status = 'En Progreso'")
-        in_progress_tickets = cursor.fetchone()[0]
-        
-        cursor.execute("SELECT COUNT(*) FROM tickets WHERE status = 'Resuelto'")
-        resolved_tickets = cursor.fetchone()[0]
-        
-        # Estadísticas por categoría
-        cursor.execute('''
-            SELECT category, COUNT(*) 
-            FROM tickets 
-            GROUP BY category 
-            ORDER BY COUNT(*) DESC
-        ''')
-        tickets_by_category = cursor.fetchall()
-        
-        # Estadísticas por prioridad
-        cursor.execute('''
-            SELECT priority, COUNT(*) 
-            FROM tickets 
-            GROUP BY priority 
-            ORDER BY 
-                CASE priority
-                    WHEN 'Critical' THEN 1
-                    WHEN 'High' THEN 2
-                    WHEN 'Medium' THEN 3
-                    WHEN 'Low' THEN 4
-                END
-        ''')
-        tickets_by_priority = cursor.fetchall()
-        
-        # Tiempo promedio de resolución
-        cursor.execute('''
-            SELECT AVG(
-                (julianday(resolved_at) - julianday(created_at)) * 24
-            ) as avg_hours
-            FROM tickets 
-            WHERE resolved_at IS NOT NULL
-        ''')
-        avg_resolution_time = cursor.fetchone()[0]
-        
-        # Estadísticas adicionales para admin
-        cursor.execute('SELECT COUNT(*) FROM users WHERE is_active = 1')
-        total_users = cursor.fetchone()[0]
-        
-        cursor.execute('SELECT COUNT(*) FROM users WHERE is_developer = 1 AND is_active = 1')
-        total_developers = cursor.fetchone()[0]
-        
-        cursor.execute('SELECT COUNT(*) FROM comments')
-        total_comments = cursor.fetchone()[0]
-        
-        conn.close()
-        
-        return {
-            'total_tickets': total_tickets,
-            'open_tickets': open_tickets,
-            'in_progress_tickets': in_progress_tickets,
-            'resolved_tickets': resolved_tickets,
-            'tickets_by_category': tickets_by_category,
-            'tickets_by_priority': tickets_by_priority,
-            'avg_resolution_hours': round(avg_resolution_time or 0, 1),
-            'total_users': total_users,
-            'total_developers': total_developers,
-            'total_comments': total_comments
-        }
+        """Obtiene estadísticas del sistema (cacheadas hasta el próximo cambio)"""
+        return self.stats_engine.get_statistics()
+
+    def invalidate_statistics(self):
+        """Invalida la caché de estadísticas tras una escritura"""
+        self.stats_engine.invalidate()
+
+    def get_ticket_summary(self, ticket_id):
+        """Un ticket con el mismo formato que las filas de get_tickets_page"""
+        with db_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(f'''
+                {TICKET_LIST_SQL}
+                WHERE t.id = ?
+            ''', (ticket_id,))
+            row = cursor.fetchone()
+        return dict(zip(TICKET_LIST_COLUMNS, row)) if row else None
+
+    def notify_change(self, ticket_id=None, action='update'):
+        """Invalida estadísticas y publica el cambio en el feed en vivo
+
+        Se publica el ticket modificado (visible para su dueño y desarrolladores)
+        y solo las estadísticas que cambiaron.
+        """
+        self.invalidate_statistics()
+        try:
+            if ticket_id is not None:
+                ticket = self.get_ticket_summary(ticket_id)
+                if ticket:
+                    ticket['attachments'] = from_json_filter(ticket['attachments'])
+                    change_feed.publish('ticket', {'action': action, 'ticket': ticket},
+                                        audience=ticket['user_id'])
+            self.publish_stats()
+        except Exception as e:
+            print(f"Error publicando cambio en el feed: {e}")
+
+    def publish_stats(self):
+        """Publica las estadísticas que cambiaron desde la última publicación"""
+        with self._feed_lock:
+            stats = self.get_statistics()
+            current = {key: stats[key] for key in LIVE_STATS_KEYS}
+            previous = self._published_stats or {}
+            delta = {key: value for key, value in current.items() if previous.get(key) != value}
+            self._published_stats = current
+            if delta:
+                change_feed.publish('stats', delta)
 
     def get_system_status(self):
         """Obtiene el estado del sistema"""
@@ -417,17 +497,29 @@ class TicketSystemComplete:
         return status
 
     def get_recent_notifications(self, limit=10):
-        """Obtiene las notificaciones recientes del log"""
+        """Obtiene las notificaciones recientes (buffer en memoria; el archivo solo se lee desde el final)"""
         try:
-            if os.path.exists('notifications.log'):
-                with open('notifications.log', 'r', encoding='utf-8') as f:
-                    lines = f.readlines()
-                    return lines[-limit:] if len(lines) > limit else lines
-            return []
+            return notification_log.recent(limit)
         except Exception as e:
             print(f"Error leyendo notificaciones: {e}")
             return []
 
+def encode_cursor(position):
+    """Serializa la posición de la última fila como token opaco para la API"""
+    return base64.urlsafe_b64encode(json.dumps(position).encode('utf-8')).decode('ascii')
+
+def decode_cursor(token):
+    """Recupera la posición desde el token; None si no hay token o es inválido"""
+    if not token:
+        return None
+    try:
+        position = json.loads(base64.urlsafe_b64decode(token.encode('ascii')).decode('utf-8'))
+        if isinstance(position, list) and len(position) == 4:
+            return position
+    except (ValueError, UnicodeError):
+        pass
+    return None
+
 # Instancia global del sistema
 ticket_system = TicketSystemComplete()
 
@@ -452,11 +544,10 @@ def index():
 def login():
     username = request.form['username']
     
-    conn = sqlite3.connect(DATABASE)
+    conn = get_db()
     cursor = conn.cursor()
     cursor.execute('SELECT * FROM users WHERE username = ? AND is_active = 1', (username,))
     user = cursor.fetchone()
-    conn.close()
     
     if user:
         session['user_id'] = user[0]
@@ -484,13 +575,16 @@ def dashboard():
     user_id = session['user_id']
     is_developer = session['is_developer']
     
-    tickets = ticket_system.get_tickets(user_id, is_developer)
+    # La lista de tickets se carga por páginas desde /api/tickets
+    # El id del feed se toma antes de leer datos para no perder cambios intermedios
+    last_event_id = change_feed.last_event_id()
     stats = ticket_system.get_statistics()
     system_status = ticket_system.get_system_status()
     recent_notifications = ticket_system.get_recent_notifications(5)
     
     return render_template('dashboard.html', 
-                         tickets=tickets, 
+                         page_size=TICKETS_PAGE_SIZE,
+                         last_event_id=last_event_id,
                          stats=stats,
                          system_status=system_status,
                          notifications=recent_notifications,
@@ -517,15 +611,17 @@ def create_ticket():
     # Manejar archivos adjuntos
     attachments = []
     if 'attachments' in request.files:
-        files = request.files.getlist('attachments')
-        for file in files:
-            if file and ticket_system.allowed_file(file.filename):
-                filename = secure_filename(file.filename)
-                timestamp = datetime.now().strftime('%Y%m%d_%H%M%S_')
-                filename = timestamp + filename
-                file_path = os.path.join(UPLOAD_FOLDER, filename)
-                file.save(file_path)
-                attachments.append(filename)
+        files = [file for file in request.files.getlist('attachments')
+                 if file and ticket_system.allowed_file(file.filename)]
+        # Ya escritos en el almacén mientras se recibía la petición (hash y tipo MIME incluidos)
+        for upload in collect_uploads(files):
+            original_name = secure_filename(upload['original_name'])
+            timestamp = datetime.now().strftime('%Y%m%d_%H%M%S_')
+            attachments.append({
+                'stored_name': timestamp + original_name,
+                'original_name': original_name,
+                'blob': upload['blob']
+            })
     
     ticket_id = ticket_system.create_ticket(title, description, category, priority, user_id, attachments)
     
@@ -557,11 +653,11 @@ def view_ticket(ticket_id):
     is_developer = session['is_developer']
     
     # Obtener ticket completo
-    conn = sqlite3.connect(DATABASE)
+    conn = get_db()
     cursor = conn.cursor()
     
-    cursor.execute('''
-        SELECT t.*, u.username as user_name, u.email as user_email, 
+    cursor.execute(f'''
+        SELECT {TICKET_COLUMNS_SQL}, u.username as user_name, u.email as user_email,
                d.username as developer_name, d.email as developer_email
         FROM tickets t
         LEFT JOIN users u ON t.user_id = u.id
@@ -595,29 +691,29 @@ def view_ticket(ticket_id):
     cursor.execute('SELECT id, username FROM users WHERE is_developer = 1 AND is_active = 1')
     developers = cursor.fetchall()
     
-    conn.close()
-    
-    # Procesar archivos adjuntos
+    # Archivos adjuntos: metadatos guardados al subir, una consulta y ningún acceso al disco
     attachments = []
-    if ticket[11]:  # ticket[11] es la columna attachments
-        try:
-            attachment_list = json.loads(ticket[11])
-            for filename in attachment_list:
-                file_path = os.path.join(UPLOAD_FOLDER, filename)
-                file_exists = os.path.exists(file_path)
-                file_size = 0
-                if file_exists:
-                    file_size = os.path.getsize(file_path)
-                
-                attachments.append({
-                    'filename': filename,
-                    'original_name': filename.split('_', 2)[-1] if '_' in filename else filename,
-                    'exists': file_exists,
-                    'size': file_size,
-                    'download_url': url_for('download_attachment', ticket_id=ticket_id, filename=filename)
-                })
-        except json.JSONDecodeError:
-            pass
+    drive_names = drive_attachment_names(ticket[12])
+    for stored in attachment_store.list_for_ticket(conn, ticket_id):
+        # Descargable si está en local o si hay copia en Drive a la que recurrir
+        in_drive = bool(stored['drive_id']) or stored['original_name'] in drive_names
+        available = stored['local'] or (in_drive and ATTACHMENT_DRIVE_FALLBACK)
+        has_preview = stored['preview_status'] == 'ready'
+        
+        attachments.append({
+            'filename': stored['stored_name'],
+            'original_name': stored['original_name'],
+            'exists': available,
+            'local': stored['local'],
+            'size': stored['size'] or 0,
+            'mime': stored['mime'],
+            'hash': stored['hash'],
+            'download_url': url_for('download_attachment', ticket_id=ticket_id, filename=stored['stored_name']),
+            'thumbnail_url': url_for('attachment_preview', digest=stored['hash'], size='thumb')
+                             if has_preview else None,
+            'preview_url': url_for('attachment_preview', digest=stored['hash'], size='large')
+                           if has_preview else None
+        })
     
     return render_template('view_ticket.html', 
                          ticket=ticket, 
@@ -640,7 +736,7 @@ def add_comment():
         return redirect(url_for('view_ticket', ticket_id=ticket_id))
     
     # Agregar comentario
-    conn = sqlite3.connect(DATABASE)
+    conn = get_db()
     cursor = conn.cursor()
     cursor.execute('''
         INSERT INTO comments (ticket_id, user_id, comment)
@@ -653,7 +749,7 @@ def add_comment():
     ''', (ticket_id,))
     
     conn.commit()
-    conn.close()
+    ticket_system.notify_change(ticket_id, 'comment')
     
     # Log de notificación
     ticket_system.log_notification(ticket_id, 'comment', f'Comentario agregado por {session["username"]}')
@@ -671,7 +767,7 @@ def assign_ticket():
     ticket_id = int(request.form['ticket_id'])
     assigned_to = int(request.form['assigned_to']) if request.form['assigned_to'] else None
     
-    conn = sqlite3.connect(DATABASE)
+    conn = get_db()
     cursor = conn.cursor()
     cursor.execute('''
         UPDATE tickets 
@@ -679,10 +775,9 @@ def assign_ticket():
         WHERE id = ?
     ''', (assigned_to, ticket_id))
     conn.commit()
-    conn.close()
+    ticket_system.notify_change(ticket_id, 'assign')
     
     if assigned_to:
-        cursor = sqlite3.connect(DATABASE).cursor()
         cursor.execute('SELECT username FROM users WHERE id = ?', (assigned_to,))
         dev_name = cursor.fetchone()[0]
         ticket_system.log_notification(ticket_id, 'assign', f'Ticket asignado a {dev_name}')
@@ -705,11 +800,10 @@ def download_attachment(ticket_id, filename):
     is_developer = session['is_developer']
     
     # Obtener información del ticket
-    conn = sqlite3.connect(DATABASE)
+    conn = get_db()
     cursor = conn.cursor()
-    cursor.execute('SELECT user_id, attachments FROM tickets WHERE id = ?', (ticket_id,))
+    cursor.execute('SELECT user_id, drive_attachments FROM tickets WHERE id = ?', (ticket_id,))
     ticket = cursor.fetchone()
-    conn.close()
     
     if not ticket:
         flash('Ticket no encontrado', 'error')
@@ -720,18 +814,117 @@ def download_attachment(ticket_id, filename):
         flash('No tienes permisos para descargar este archivo', 'error')
         return redirect(url_for('dashboard'))
     
-    # Buscar el archivo
-    file_path = os.path.join(UPLOAD_FOLDER, filename)
-    
-    if not os.path.exists(file_path):
-        flash('Archivo no encontrado', 'error')
-        return redirect(url_for('dashboard'))
+    # Buscar el archivo en el almacén por contenido
+    stored = attachment_store.find(conn, ticket_id, filename)
     
     try:
-        return send_file(file_path, as_attachment=True, download_name=filename)
+        present = bool(stored and stored['path'] and os.path.exists(stored['path']))
+        if stored and stored['hash'] and present != stored['local']:
+            # view_ticket no mira el disco: corrige attachments.local con lo que se ve aquí
+            attachment_store.set_local(conn, stored['hash'], present)
+            conn.commit()
+        if present:
+            # ETag fuerte (hash del contenido), 304, Range/206 y wsgi.file_wrapper (sendfile) los resuelve send_file
+            response = send_file(stored['path'], mimetype=stored['mime'], as_attachment=True,
+                                 download_name=stored['original_name'], etag=stored['hash'],
+                                 last_modified=stored['created_at'], conditional=True,
+                                 max_age=ATTACHMENT_CACHE_MAX_AGE)
+            response.cache_control.public = False
+            response.cache_control.private = True
+            return response
+        
+        drive_entry = find_drive_attachment(ticket[1], stored, filename)
+        if drive_entry and ATTACHMENT_DRIVE_FALLBACK and ticket_system.drive_manager \
+                and ticket_system.drive_manager.authenticated:
+            return drive_attachment_response(drive_entry, stored, filename)
     except Exception as e:
         flash(f'Error descargando archivo: {e}', 'error')
         return redirect(url_for('dashboard'))
+    
+    flash('Archivo no encontrado', 'error')
+    return redirect(url_for('dashboard'))
+
+def drive_attachment_names(drive_attachments):
+    """Nombres originales con copia en Drive según tickets.drive_attachments"""
+    try:
+        entries = json.loads(drive_attachments) if drive_attachments else []
+    except (TypeError, ValueError):
+        return set()
+    return {entry.get('original_name') for entry in entries if isinstance(entry, dict)}
+
+def find_drive_attachment(drive_attachments, stored, filename):
+    """Copia en Drive de un adjunto: por el hash subido o por nombre en tickets.drive_attachments"""
+    try:
+        entries = json.loads(drive_attachments) if drive_attachments else []
+    except (TypeError, ValueError):
+        entries = []
+    original_name = stored['original_name'] if stored else (
+        filename.split('_', 2)[-1] if '_' in filename else filename)
+    for entry in entries:
+        if stored and stored['drive_id'] and entry.get('drive_id') == stored['drive_id']:
+            return entry
+    for entry in entries:
+        if entry.get('original_name') == original_name:
+            return entry
+    if stored and stored['drive_id']:
+        return {'drive_id': stored['drive_id'], 'size': stored['size'], 'original_name': original_name}
+    return None
+
+def drive_attachment_response(drive_entry, stored, filename):
+    """Descarga en streaming desde Drive; si se conoce el hash, el archivo vuelve al almacén local"""
+    download_name = stored['original_name'] if stored else drive_entry.get('original_name') or filename
+    mime = (stored and stored['mime']) or mimetypes.guess_type(download_name)[0] or 'application/octet-stream'
+    chunks = ticket_system.drive_manager.iter_attachment(drive_entry['drive_id'])
+    if stored and stored['hash']:
+        chunks = attachment_store.restore_from(chunks, stored['hash'], mime)
+    
+    # direct_passthrough: Werkzeug no debe leer el generador para calcular Content-Length
+    response = Response(chunks, mimetype=mime, direct_passthrough=True)
+    response.headers.set('Content-Disposition', 'attachment', filename=download_name)
+    response.cache_control.private = True
+    response.cache_control.max_age = ATTACHMENT_CACHE_MAX_AGE
+    if stored and stored['hash']:
+        response.set_etag(stored['hash'])
+        if stored['created_at']:
+            response.last_modified = stored['created_at']
+        # Solo If-None-Match / If-Modified-Since: Drive se consulta únicamente si hay que enviar el cuerpo
+        response.make_conditional(request)
+    if response.status_code == 200:
+        size = drive_entry.get('size') or (stored and stored['size'])
+        if size:
+            response.content_length = int(size)
+        print(f"☁️ Adjunto {download_name} servido desde Drive (no está en local)")
+    return response
+
+@app.route('/attachment_preview/<digest>/<size>')
+def attachment_preview(digest, size):
+    """Miniatura de un adjunto por su hash; caché de larga duración (la URL no cambia de contenido)"""
+    if 'user_id' not in session:
+        return redirect(url_for('index'))
+    
+    if size not in PREVIEW_SIZES or len(digest) != 64 or not all(c in '0123456789abcdef' for c in digest):
+        return jsonify({'error': 'Vista previa no válida'}), 404
+    
+    # Los usuarios solo ven miniaturas de adjuntos de sus propios tickets
+    conn = get_db()
+    allowed = conn.execute('''
+        SELECT 1 FROM ticket_attachments ta JOIN tickets t ON t.id = ta.ticket_id
+        WHERE ta.hash = ? AND (? OR t.user_id = ?) LIMIT 1
+    ''', (digest, 1 if session['is_developer'] else 0, session['user_id'])).fetchone()
+    path = preview_worker.preview_path(digest, size)
+    if not allowed:
+        return jsonify({'error': 'Vista previa no disponible'}), 404
+    if not os.path.exists(path):
+        # Marcada como lista pero sin archivo (base traída de Drive): se vuelve a generar
+        preview_worker.regenerate(digest)
+        return jsonify({'error': 'Vista previa no disponible'}), 404
+    
+    response = send_file(path, mimetype=PREVIEW_MIME, etag=f'{digest}-{size}',
+                         conditional=True, max_age=PREVIEW_CACHE_MAX_AGE)
+    response.cache_control.public = False
+    response.cache_control.private = True
+    response.cache_control.immutable = True
+    return response
 
 # ==================== RUTAS DE ADMINISTRACIÓN ====================
 
@@ -747,7 +940,7 @@ def admin_panel():
     system_status = ticket_system.get_system_status()
     
     # Obtener usuarios
-    conn = sqlite3.connect(DATABASE)
+    conn = get_db()
     cursor = conn.cursor()
     cursor.execute('SELECT id, username, email, is_active, is_developer, created_at FROM users ORDER BY created_at DESC')
     users = cursor.fetchall()
@@ -764,11 +957,16 @@ def admin_panel():
         'os': platform.system() + ' ' + platform.release(),
         'cpu_percent': psutil.cpu_percent(),
         'memory_percent': psutil.virtual_memory().percent,
-        'disk_usage': psutil.disk_usage('.').percent
+        'disk_usage': psutil.disk_usage('.').percent,
+        'db_pool': get_pool_metrics(),
+        'stats_cache': ticket_system.stats_engine.get_metrics(),
+        'notification_log': notification_log.get_metrics(),
+        'upload_ingest': get_ingest_metrics(),
+        'attachment_previews': preview_worker.get_metrics(),
+        'telegram_outbox': get_outbox_metrics() if TELEGRAM_AVAILABLE else None,
+        'telegram_delivery': get_delivery_settings() if TELEGRAM_AVAILABLE else None
     }
     
-    conn.close()
-    
     return render_template('admin_panel.html',
                          stats=stats,
                          system_status=system_status,
@@ -801,6 +999,47 @@ def admin_sync_drive():
     
     return jsonify({'success': success, 'message': message})
 
+@app.route('/admin/notifications')
+def admin_notifications():
+    """Consulta del historial de notificaciones por ticket, acción y rango de fechas"""
+    if 'user_id' not in session or not session['is_developer']:
+        return jsonify({'success': False, 'message': 'Sin permisos'})
+    
+    try:
+        ticket_id = request.args.get('ticket_id') or None
+        limit = min(int(request.args.get('limit', QUERY_LIMIT)), 1000)
+        records = ticket_system.query_notifications(
+            ticket_id=int(ticket_id) if ticket_id else None,
+            action=request.args.get('action') or None,
+            since=request.args.get('since') or None,
+            until=request.args.get('until') or None,
+            limit=limit
+        )
+        return jsonify({'success': True, 'records': records})
+    
+    except ValueError:
+        return jsonify({'success': False, 'message': 'Parámetros inválidos'})
+    except Exception as e:
+        return jsonify({'success': False, 'message': f'Error: {str(e)}'})
+
+@app.route('/admin/rebuild_stats', methods=['POST'])
+def admin_rebuild_stats():
+    """Verifica los contadores de estadísticas y los reconstruye si hay diferencias"""
+    if 'user_id' not in session or not session['is_developer']:
+        return jsonify({'success': False, 'message': 'Sin permisos'})
+
+    try:
+        differences = ticket_system.stats_engine.verify()
+        if differences:
+            ticket_system.stats_engine.rebuild()
+            message = f'Contadores reconstruidos ({len(differences)} diferencias corregidas)'
+        else:
+            message = 'Contadores consistentes, no se requiere reconstrucción'
+        return jsonify({'success': True, 'message': message, 'differences': differences})
+
+    except Exception as e:
+        return jsonify({'success': False, 'message': f'Error: {str(e)}'})
+
 @app.route('/admin/toggle_user/<int:user_id>', methods=['POST'])
 def admin_toggle_user(user_id):
     """Activar/desactivar usuario"""
@@ -812,7 +1051,7 @@ def admin_toggle_user(user_id):
         return jsonify({'success': False, 'message': 'No puedes desactivarte a ti mismo'})
     
     try:
-        conn = sqlite3.connect(DATABASE)
+        conn = get_db()
         cursor = conn.cursor()
         
         # Obtener estado actual
@@ -826,7 +1065,7 @@ def admin_toggle_user(user_id):
         new_status = not user[0]
         cursor.execute('UPDATE users SET is_active = ? WHERE id = ?', (new_status, user_id))
         conn.commit()
-        conn.close()
+        ticket_system.notify_change()
         
         action = 'activado' if new_status else 'desactivado'
         return jsonify({'success': True, 'message': f'Usuario {user[1]} {action} exitosamente'})
@@ -850,14 +1089,14 @@ def admin_create_user():
         return redirect(url_for('admin_panel'))
     
     try:
-        conn = sqlite3.connect(DATABASE)
+        conn = get_db()
         cursor = conn.cursor()
         cursor.execute('''
             INSERT INTO users (username, email, is_developer, is_active)
             VALUES (?, ?, ?, 1)
         ''', (username, email, is_developer))
         conn.commit()
-        conn.close()
+        ticket_system.notify_change()
         
         role = 'desarrollador' if is_developer else 'usuario'
         flash(f'Usuario {username} creado exitosamente como {role}', 'success')
@@ -876,7 +1115,7 @@ def admin_fix_telegram_db():
         return jsonify({'success': False, 'message': 'Sin permisos'})
     
     try:
-        conn = sqlite3.connect(DATABASE)
+        conn = get_db()
         cursor = conn.cursor()
         
         # Crear tabla de configuración
@@ -889,7 +1128,6 @@ def admin_fix_telegram_db():
         ''')
         
         conn.commit()
-        conn.close()
         
         return jsonify({'success': True, 'message': 'Tabla de configuración creada exitosamente'})
         
@@ -906,15 +1144,10 @@ def admin_test_telegram():
         return jsonify({'success': False, 'message': 'Telegram no está disponible'})
     
     try:
-        # Enviar mensaje de prueba
-        from telegram_notifications import send_telegram_notification
-        message = f"🧪 Mensaje de prueba desde Sistema de Tickets\n\nUsuario: {session['username']}\nFecha: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}"
-        success = send_telegram_notification(message)
-        
-        if success:
-            return jsonify({'success': True, 'message': 'Mensaje de prueba enviado exitosamente'})
-        else:
-            return jsonify({'success': False, 'message': 'Error enviando mensaje de prueba'})
+        # Envío directo (sin bandeja de salida) para informar el resultado real
+        from telegram_notifications import send_telegram_test
+        success, message = send_telegram_test()
+        return jsonify({'success': success, 'message': message})
             
     except Exception as e:
         return jsonify({'success': False, 'message': f'Error: {str(e)}'})
@@ -935,12 +1168,24 @@ def admin_configure_telegram():
             return jsonify({'success': False, 'message': 'Token y Chat ID son requeridos'})
         
         # Configurar usando las funciones de telegram_notifications
-        from telegram_notifications import configure_notifications
+        from telegram_notifications import DELIVERY_SETTINGS, configure_notifications
+        
+        # Agrupación de eventos y límite de envío (opcionales)
+        delivery = {}
+        for name, (_, _, minimum, maximum) in DELIVERY_SETTINGS.items():
+            if data.get(name) not in (None, ''):
+                try:
+                    value = int(data[name])
+                except (TypeError, ValueError):
+                    return jsonify({'success': False, 'message': f'Valor inválido para {name}'})
+                if not minimum <= value <= maximum:
+                    return jsonify({'success': False, 'message': f'{name} debe estar entre {minimum} y {maximum}'})
+                delivery[name] = value
         
         if enabled:
-            success = configure_notifications('telegram', telegram_token=token, telegram_chat_id=chat_id)
+            success = configure_notifications('telegram', telegram_token=token, telegram_chat_id=chat_id, **delivery)
         else:
-            success = configure_notifications('none')
+            success = configure_notifications('none', **delivery)
         
         if success:
             status = 'habilitado' if enabled else 'deshabilitado'
@@ -964,7 +1209,101 @@ def api_stats():
     
     return jsonify({
         'stats': stats,
-        'system_status': system_status
+        'system_status': system_status,
+        'stats_cache': ticket_system.stats_engine.get_metrics()
+    })
+
+@app.route('/api/tickets')
+def api_tickets():
+    """API endpoint para listar tickets paginados por cursor"""
+    if 'user_id' not in session:
+        return jsonify({'error': 'No autorizado'}), 401
+    
+    try:
+        limit = int(request.args.get('limit', TICKETS_PAGE_SIZE))
+    except ValueError:
+        return jsonify({'error': 'Parámetro limit inválido'}), 400
+    
+    tickets, next_cursor = ticket_system.get_tickets_page(
+        session['user_id'],
+        session['is_developer'],
+        limit=limit,
+        cursor_token=request.args.get('cursor')
+    )
+    
+    for ticket in tickets:
+        ticket['attachments'] = from_json_filter(ticket['attachments'])
+    
+    return jsonify({
+        'tickets': tickets,
+        'next_cursor': next_cursor
+    })
+
+@app.route('/api/search')
+def api_search():
+    """API endpoint de búsqueda de texto completo en tickets y comentarios"""
+    if 'user_id' not in session:
+        return jsonify({'error': 'No autorizado'}), 401
+    
+    query = request.args.get('q', '').strip()
+    filters = {column: request.args.get(column) for column in SEARCH_FILTERS}
+    
+    try:
+        limit = int(request.args.get('limit', SEARCH_LIMIT))
+    except ValueError:
+        return jsonify({'error': 'Parámetro limit inválido'}), 400
+    
+    try:
+        results = search_tickets(query,
+                                 user_id=session['user_id'],
+                                 is_developer=session['is_developer'],
+                                 filters=filters,
+                                 limit=limit)
+    except SearchUnavailableError as e:
+        return jsonify({'error': str(e)}), 503
+    
+    return jsonify({
+        'query': query,
+        'results': results
+    })
+
+@app.route('/api/events')
+def api_events():
+    """Stream Server-Sent Events con los cambios de tickets, estadísticas y notificaciones"""
+    if 'user_id' not in session:
+        return jsonify({'error': 'No autorizado'}), 401
+    
+    # Al reconectar, el navegador envía Last-Event-ID automáticamente
+    last_id = parse_event_id(request.headers.get('Last-Event-ID') or request.args.get('since'),
+                             default=change_feed.last_event_id())
+    stream = change_feed.stream(last_id, session['user_id'], session['is_developer'])
+    
+    return Response(stream_with_context(stream),
+                    mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@app.route('/api/changes')
+def api_changes():
+    """Long-poll de cambios para navegadores sin EventSource"""
+    if 'user_id' not in session:
+        return jsonify({'error': 'No autorizado'}), 401
+    
+    last_id = parse_event_id(request.args.get('since'), default=change_feed.last_event_id())
+    try:
+        timeout = int(request.args.get('timeout', LONG_POLL_TIMEOUT))
+    except ValueError:
+        return jsonify({'error': 'Parámetro timeout inválido'}), 400
+    timeout = max(0, min(timeout, LONG_POLL_TIMEOUT))
+    events, last_id, reset = change_feed.wait_for_events(last_id,
+                                                         session['user_id'],
+                                                         session['is_developer'],
+                                                         timeout=timeout)
+    
+    return jsonify({
+        'events': [{'id': event['id'], 'type': event['type'], 'data': json.loads(event['payload'])}
+                   for event in events],
+        'last_id': last_id,
+        'reset': reset
     })
 
 @app.route('/api/system_info')
@@ -983,7 +1322,13 @@ def api_system_info():
             'cpu_percent': psutil.cpu_percent(),
             'memory_percent': psutil.virtual_memory().percent,
             'disk_usage': psutil.disk_usage('.').percent,
-            'uptime': time.time() - psutil.boot_time()
+            'uptime': time.time() - psutil.boot_time(),
+            'db_pool': get_pool_metrics(),
+            'stats_cache': ticket_system.stats_engine.get_metrics(),
+            'db_schema': get_schema_status(),
+            'change_feed': change_feed.get_metrics(),
+            'upload_ingest': get_ingest_metrics(),
+            'attachment_previews': preview_worker.get_metrics()
         }
         
         return jsonify({'success': True, 'data': info})
@@ -998,6 +1343,12 @@ def page_not_found(e):
                          error_code=404, 
                          error_message='Página no encontrada'), 404
 
+@app.errorhandler(413)
+def request_entity_too_large(e):
+    # Límites de upload_ingest: los archivos a medio recibir ya se descartaron
+    flash(f'Adjuntos demasiado grandes: {e.description}', 'error')
+    return redirect(url_for('dashboard'))
+
 @app.errorhandler(500)
 def internal_server_error(e):
     return render_template('error.html', 
@@ -1013,7 +1364,7 @@ if __name__ == '__main__':
     print(f"📁 Archivos temporales: {UPLOAD_FOLDER}")
     print(f"☁️ Google Drive: {'✅ Conectado' if GOOGLE_DRIVE_AVAILABLE and ticket_system.drive_manager and ticket_system.drive_manager.authenticated else '❌ Desconectado'}")
     print(f"📧 Telegram: {'✅ Disponible' if TELEGRAM_AVAILABLE else '❌ No disponible'}")
-    print(f"📝 Notificaciones: notifications.log")
+    print(f"📝 Notificaciones: {NOTIFICATIONS_LOG}")
     print("=" * 60)
     print("🌐 Accede a: http://localhost:5000")
     print("👤 Usuarios disponibles:")
@@ -0,0 +1,313 @@
+"""
+Miniaturas y vistas previas de adjuntos del Sistema de Tickets
+Un grupo de hilos acotado a los núcleos disponibles genera, al subir un adjunto, miniaturas
+WebP (JPEG si Pillow no tiene WebP) de imágenes y de la primera página de los PDF
+"""
+
+import os
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from attachment_store import attachment_store
+from db_pool import db_connection
+
+try:
+    from PIL import Image, ImageOps, features
+    PILLOW_AVAILABLE = True
+except ImportError as e:
+    print(f"⚠️ Pillow no disponible, sin vistas previas de adjuntos: {e}")
+    PILLOW_AVAILABLE = False
+
+try:
+    import fitz  # PyMuPDF: primera página de los PDF
+    PDF_PREVIEW_AVAILABLE = True
+except ImportError:
+    PDF_PREVIEW_AVAILABLE = False
+
+# Configuración
+PREVIEW_DIR = 'attachment_previews'
+PREVIEW_SIZES = {'thumb': 160, 'medium': 480, 'large': 1200}   # Lado mayor en píxeles
+PREVIEW_WORKERS = max(1, min(4, os.cpu_count() or 1))
+PREVIEW_QUALITY = 80
+PREVIEW_MAX_PIXELS = 50_000_000        # Imágenes más grandes no se procesan (bombas de descompresión)
+PREVIEW_MAX_ATTEMPTS = 3
+PREVIEW_RETRY_DELAY = 30               # Segundos antes de reintentar, multiplicados por el número de intento
+IMAGE_MIMES = {'image/png', 'image/jpeg', 'image/gif'}
+PDF_MIME = 'application/pdf'
+
+if PILLOW_AVAILABLE:
+    PREVIEW_FORMAT, PREVIEW_MIME, PREVIEW_EXT = (
+        ('WEBP', 'image/webp', 'webp') if features.check('webp') else ('JPEG', 'image/jpeg', 'jpg')
+    )
+    # Pillow solo falla al doble de este valor; el límite real lo comprueba _open()
+    Image.MAX_IMAGE_PIXELS = PREVIEW_MAX_PIXELS
+else:
+    PREVIEW_FORMAT, PREVIEW_MIME, PREVIEW_EXT = 'JPEG', 'image/jpeg', 'jpg'
+
+
+def install_attachment_previews(conn):
+    """Crea la tabla con el estado de las vistas previas de cada contenido"""
+    cursor = conn.cursor()
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS attachment_previews (
+            hash TEXT PRIMARY KEY,
+            status TEXT NOT NULL DEFAULT 'pending',
+            format TEXT,
+            width INTEGER,
+            height INTEGER,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            last_error TEXT,
+            updated_at REAL NOT NULL
+        )
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_attachment_previews_status ON attachment_previews (status)')
+    conn.commit()
+
+
+class PreviewTooLargeError(Exception):
+    """Imagen por encima de PREVIEW_MAX_PIXELS: se marca como 'unsupported'"""
+
+
+def supports_preview(mime):
+    if not PILLOW_AVAILABLE:
+        return False
+    return mime in IMAGE_MIMES or (mime == PDF_MIME and PDF_PREVIEW_AVAILABLE)
+
+
+class PreviewWorker:
+    """Genera las vistas previas en segundo plano, una tarea por contenido
+
+    Los estados quedan en attachment_previews ('pending', 'ready', 'failed',
+    'unsupported'). Un fallo se reintenta tras una espera creciente hasta
+    PREVIEW_MAX_ATTEMPTS; al arrancar se reencolan las 'pending' que quedaron
+    a medias. Las miniaturas se guardan en attachment_previews/ab/<hash>_<tamaño>.
+    """
+
+    def __init__(self, root=PREVIEW_DIR, workers=PREVIEW_WORKERS):
+        self.root = root
+        self.workers = workers
+        self._lock = threading.Lock()
+        self._executor = None
+        self._installed = False
+        self._queued = set()
+
+        self.metrics = {
+            'generated': 0,
+            'failed': 0,
+            'unsupported': 0,
+            'last_ms': None,
+        }
+
+    def install(self):
+        if not self._installed:
+            with db_connection() as conn:
+                install_attachment_previews(conn)
+            self._installed = True
+
+    def start(self):
+        """Crea el grupo de hilos y reencola las vistas previas pendientes (una sola vez)"""
+        with self._lock:
+            if self._executor is not None:
+                return
+            self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='attachment-preview')
+        try:
+            self.install()
+            with db_connection() as conn:
+                pending = conn.execute('''
+                    SELECT p.hash, a.mime FROM attachment_previews p JOIN attachments a ON a.hash = p.hash
+                    WHERE p.status = 'pending'
+                ''').fetchall()
+            for digest, mime in pending:
+                self._submit(digest, mime)
+        except Exception as e:
+            print(f"❌ Error reencolando vistas previas: {e}")
+
+    def preview_path(self, digest, size):
+        return os.path.join(self.root, digest[:2], f'{digest}_{size}.{PREVIEW_EXT}')
+
+    def enqueue(self, blobs):
+        """Programa las vistas previas de los contenidos recién subidos (dicts de save_stream)"""
+        blobs = [blob for blob in blobs if blob and supports_preview(blob['mime'])]
+        if not blobs:
+            return 0
+        self.start()
+        now = time.time()
+        with db_connection() as conn:
+            conn.executemany('''
+                INSERT OR IGNORE INTO attachment_previews (hash, status, updated_at) VALUES (?, 'pending', ?)
+            ''', [(blob['hash'], now) for blob in blobs])
+            conn.commit()
+            pending = {row[0] for row in conn.execute(f'''
+                SELECT hash FROM attachment_previews
+                WHERE status = 'pending' AND hash IN ({','.join('?' * len(blobs))})
+            ''', [blob['hash'] for blob in blobs])}
+        for blob in blobs:
+            if blob['hash'] in pending:
+                self._submit(blob['hash'], blob['mime'])
+        return len(pending)
+
+    def regenerate(self, digest):
+        """Vuelve a generar las vistas previas de un contenido cuyos archivos faltan"""
+        self.install()
+        with db_connection() as conn:
+            row = conn.execute('''
+                SELECT a.mime FROM attachment_previews p JOIN attachments a ON a.hash = p.hash
+                WHERE p.hash = ? AND p.status = 'ready' AND a.local = 1
+            ''', (digest,)).fetchone()
+            if row is None:
+                return False
+            conn.execute('''
+                UPDATE attachment_previews SET status = 'pending', attempts = 0, updated_at = ? WHERE hash = ?
+            ''', (time.time(), digest))
+            conn.commit()
+        self.start()
+        self._submit(digest, row[0])
+        return True
+
+    def _submit(self, digest, mime):
+        with self._lock:
+            if digest in self._queued:
+                return
+            self._queued.add(digest)
+        self._executor.submit(self._run, digest, mime)
+
+    def _run(self, digest, mime):
+        started = time.perf_counter()
+        retry_in = None
+        try:
+            width, height = self.generate(digest, mime)
+            self._set_status(digest, 'ready', width=width, height=height)
+            elapsed_ms = (time.perf_counter() - started) * 1000
+            with self._lock:
+                self.metrics['generated'] += 1
+                self.metrics['last_ms'] = round(elapsed_ms, 1)
+        except (PreviewTooLargeError, Image.DecompressionBombError) as e:
+            self._set_status(digest, 'unsupported', error=str(e))
+            with self._lock:
+                self.metrics['unsupported'] += 1
+        except Exception as e:
+            status, attempts = self._set_status(digest, 'failed', error=str(e))
+            with self._lock:
+                self.metrics['failed'] += 1
+            if status == 'pending':
+                retry_in = PREVIEW_RETRY_DELAY * attempts
+            print(f"❌ Error generando vista previa de {digest[:12]} (intento {attempts}): {e}")
+        finally:
+            with self._lock:
+                self._queued.discard(digest)
+        if retry_in is not None:
+            timer = threading.Timer(retry_in, self._submit, args=(digest, mime))
+            timer.daemon = True
+            timer.start()
+
+    def _open(self, digest, mime):
+        """Imagen de origen: el propio archivo o la primera página del PDF"""
+        path = attachment_store.blob_path(digest)
+        largest = max(PREVIEW_SIZES.values())
+        if mime == PDF_MIME:
+            with fitz.open(path) as document:
+                page = document[0]
+                zoom = largest / max(page.rect.width, page.rect.height)
+                pixmap = page.get_pixmap(matrix=fitz.Matrix(zoom, zoom), alpha=False)
+                return Image.frombytes('RGB', (pixmap.width, pixmap.height), pixmap.samples)
+        with Image.open(path) as source:
+            width, height = source.size
+            if width * height > PREVIEW_MAX_PIXELS:
+                raise PreviewTooLargeError(f'{width}x{height} supera {PREVIEW_MAX_PIXELS} píxeles')
+            # Los JPEG se decodifican ya reducidos (mucho más rápido en fotos grandes)
+            source.draft('RGB', (largest, largest))
+            source.seek(0)
+            image = ImageOps.exif_transpose(source)
+            # Copia cargada en memoria: el archivo se cierra al salir del with
+            if image is source:
+                image = source.copy()
+            image.load()
+        return image
+
+    def generate(self, digest, mime):
+        """Escribe todas las vistas previas de un contenido; devuelve el tamaño de la imagen decodificada"""
+        image = self._open(digest, mime)
+        width, height = image.size
+        if image.mode in ('P', 'LA', 'PA') or 'transparency' in image.info:
+            image = image.convert('RGBA')
+        if PREVIEW_FORMAT == 'JPEG' and image.mode == 'RGBA':
+            # JPEG no tiene transparencia: fondo blanco en lugar de negro
+            background = Image.new('RGB', image.size, 'white')
+            background.paste(image, mask=image.getchannel('A'))
+            image = background
+        elif image.mode not in ('RGB', 'RGBA'):
+            image = image.convert('RGB')
+        os.makedirs(os.path.join(self.root, digest[:2]), exist_ok=True)
+        # De mayor a menor: cada tamaño se reduce a partir del anterior
+        for size, pixels in sorted(PREVIEW_SIZES.items(), key=lambda item: -item[1]):
+            image.thumbnail((pixels, pixels), Image.Resampling.LANCZOS, reducing_gap=3.0)
+            fd, tmp_path = tempfile.mkstemp(prefix='.preview_', dir=os.path.join(self.root, digest[:2]))
+            try:
+                with os.fdopen(fd, 'wb') as f:
+                    image.save(f, PREVIEW_FORMAT, quality=PREVIEW_QUALITY)
+                os.replace(tmp_path, self.preview_path(digest, size))
+            except Exception:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+                raise
+        return width, height
+
+    def _set_status(self, digest, status, error=None, width=None, height=None):
+        """Guarda el resultado de un intento; devuelve (estado final, intentos)"""
+        with db_connection() as conn:
+            conn.execute('''
+                UPDATE attachment_previews
+                SET status = CASE WHEN ? = 'failed' AND attempts + 1 < ? THEN 'pending' ELSE ? END,
+                    format = ?, width = ?, height = ?, last_error = ?,
+                    attempts = attempts + 1, updated_at = ?
+                WHERE hash = ?
+            ''', (status, PREVIEW_MAX_ATTEMPTS, status, PREVIEW_MIME if status == 'ready' else None,
+                  width, height, error, time.time(), digest))
+            conn.commit()
+            row = conn.execute('SELECT status, attempts FROM attachment_previews WHERE hash = ?',
+                               (digest,)).fetchone()
+        return tuple(row) if row else (status, 0)
+
+    def collect_garbage(self):
+        """Borra las vistas previas de contenidos que ya no existen en el almacén"""
+        self.install()
+        with db_connection() as conn:
+            conn.execute('DELETE FROM attachment_previews WHERE hash NOT IN (SELECT hash FROM attachments)')
+            conn.commit()
+            known = {row[0] for row in conn.execute('SELECT hash FROM attachment_previews')}
+        removed = 0
+        for directory, _, files in os.walk(self.root):
+            for name in files:
+                if not name.startswith('.') and name.split('_', 1)[0] not in known:
+                    os.remove(os.path.join(directory, name))
+                    removed += 1
+        if removed:
+            print(f"🗑️ {removed} vistas previas huérfanas eliminadas")
+        return removed
+
+    def get_metrics(self):
+        """Vistas previas generadas, pendientes y fallidas"""
+        with self._lock:
+            metrics = dict(self.metrics)
+            metrics['queued'] = len(self._queued)
+        metrics.update({
+            'workers': self.workers,
+            'format': PREVIEW_MIME,
+            'pillow': PILLOW_AVAILABLE,
+            'pdf': PDF_PREVIEW_AVAILABLE,
+        })
+        return metrics
+
+
+# Instancia global
+preview_worker = PreviewWorker()
+
+
+if __name__ == "__main__":
+    # Uso: python attachment_previews.py <hash> [mime]
+    if len(sys.argv) > 1:
+        print(preview_worker.generate(sys.argv[1], sys.argv[2] if len(sys.argv) > 2 else 'image/png'))
+    print(f"📊 {preview_worker.get_metrics()}")
@@ -0,0 +1,435 @@
+"""
+Almacén de archivos adjuntos del Sistema de Tickets
+Cada contenido se guarda una sola vez, nombrado por su SHA-256, en directorios repartidos
+(ab/cd/<hash>); la tabla attachments lleva tamaño, tipo MIME, referencias y copia en Drive
+"""
+
+import hashlib
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+
+from db_pool import db_connection
+
+# Configuración
+ATTACHMENT_STORE_DIR = 'attachment_store'
+STORE_CHUNK_SIZE = 1024 * 1024       # Lectura/escritura por bloques de 1 MB
+STORE_GC_GRACE_SECONDS = 3600        # Contenidos sin referencias que se conservan un tiempo (subidas en curso)
+
+ATTACHMENT_TRIGGERS = {
+    # Las referencias se cuentan solas al enlazar, reenlazar (réplica de Drive) o desenlazar un adjunto
+    'ticket_attachments_ref_insert': '''
+        AFTER INSERT ON ticket_attachments WHEN NEW.hash IS NOT NULL
+        BEGIN
+            UPDATE attachments SET refcount = refcount + 1 WHERE hash = NEW.hash;
+        END
+    ''',
+    'ticket_attachments_ref_delete': '''
+        AFTER DELETE ON ticket_attachments WHEN OLD.hash IS NOT NULL
+        BEGIN
+            UPDATE attachments
+            SET refcount = refcount - 1,
+                unreferenced_at = CASE WHEN refcount - 1 <= 0 THEN strftime('%s', 'now') ELSE unreferenced_at END
+            WHERE hash = OLD.hash;
+        END
+    ''',
+    'ticket_attachments_ref_update': '''
+        AFTER UPDATE OF hash ON ticket_attachments WHEN OLD.hash IS NOT NEW.hash
+        BEGIN
+            UPDATE attachments SET refcount = refcount + 1, unreferenced_at = NULL WHERE hash = NEW.hash;
+            UPDATE attachments
+            SET refcount = refcount - 1,
+                unreferenced_at = CASE WHEN refcount - 1 <= 0 THEN strftime('%s', 'now') ELSE unreferenced_at END
+            WHERE hash = OLD.hash;
+        END
+    ''',
+    'tickets_attachments_delete': '''
+        AFTER DELETE ON tickets
+        BEGIN
+            DELETE FROM ticket_attachments WHERE ticket_id = OLD.id;
+        END
+    ''',
+}
+
+
+def install_attachment_store(conn):
+    """Crea las tablas de adjuntos, sus índices y los triggers de referencias"""
+    cursor = conn.cursor()
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS attachments (
+            hash TEXT PRIMARY KEY,
+            size INTEGER NOT NULL,
+            mime TEXT,
+            refcount INTEGER NOT NULL DEFAULT 0,
+            drive_id TEXT,
+            created_at REAL NOT NULL,
+            unreferenced_at REAL,
+            local INTEGER NOT NULL DEFAULT 1
+        )
+    ''')
+    # Bases anteriores: `local` indica si el contenido está en este disco (evita os.path.exists por vista)
+    cursor.execute('PRAGMA table_info(attachments)')
+    if 'local' not in [row[1] for row in cursor.fetchall()]:
+        cursor.execute('ALTER TABLE attachments ADD COLUMN local INTEGER NOT NULL DEFAULT 1')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS ticket_attachments (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            ticket_id INTEGER NOT NULL,
+            hash TEXT REFERENCES attachments (hash),
+            stored_name TEXT NOT NULL,
+            original_name TEXT NOT NULL,
+            created_at REAL NOT NULL
+        )
+    ''')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_ticket_attachments_ticket
+        ON ticket_attachments (ticket_id, stored_name)
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_ticket_attachments_hash ON ticket_attachments (hash)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_attachments_refcount ON attachments (refcount)')
+    for name, body in ATTACHMENT_TRIGGERS.items():
+        cursor.execute(f'CREATE TRIGGER IF NOT EXISTS {name} {body}')
+    conn.commit()
+
+
+class BlobWriter:
+    """Escribe un contenido por bloques calculando su SHA-256 al vuelo
+
+    El archivo temporal se mueve a su ruta definitiva en finish(); si ese
+    contenido ya existía, el temporal se descarta (deduplicación).
+    """
+
+    def __init__(self, store):
+        self.store = store
+        self.sha256 = hashlib.sha256()
+        self.size = 0
+        fd, self.tmp_path = tempfile.mkstemp(prefix='.upload_', dir=store.tmp_dir)
+        self.f = os.fdopen(fd, 'wb')
+
+    def write(self, data):
+        self.sha256.update(data)
+        self.size += len(data)
+        self.f.write(data)
+        return len(data)
+
+    def finish(self, mime=None):
+        """Cierra el temporal y lo guarda por su hash; devuelve los datos del contenido"""
+        self.f.close()
+        digest = self.sha256.hexdigest()
+        path = self.store.blob_path(digest)
+        deduplicated = os.path.exists(path)
+        if deduplicated:
+            os.remove(self.tmp_path)
+            # Renueva la fecha: collect_garbage no borra contenidos recién reutilizados
+            os.utime(path)
+        else:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.replace(self.tmp_path, path)
+        return {
+            'hash': digest,
+            'size': self.size,
+            'mime': mime or 'application/octet-stream',
+            'path': path,
+            'deduplicated': deduplicated,
+        }
+
+    def abort(self):
+        if not self.f.closed:
+            self.f.close()
+        if os.path.exists(self.tmp_path):
+            os.remove(self.tmp_path)
+
+
+class AttachmentStore:
+    """Adjuntos direccionados por contenido con conteo de referencias
+
+    attachment_store/ab/cd/<sha256>  contenido
+    attachment_store/tmp/            subidas a medio escribir
+    ticket_attachments enlaza cada ticket con sus contenidos y conserva el
+    nombre guardado (usado en las URLs) y el nombre original.
+    """
+
+    def __init__(self, root=ATTACHMENT_STORE_DIR):
+        self.root = root
+        self.tmp_dir = os.path.join(root, 'tmp')
+        self._installed = False
+        self._lock = threading.Lock()
+        os.makedirs(self.tmp_dir, exist_ok=True)
+
+        self.metrics = {
+            'stored': 0,
+            'deduplicated': 0,
+            'bytes_stored': 0,
+            'bytes_deduplicated': 0,
+        }
+
+    def install(self):
+        if not self._installed:
+            with db_connection() as conn:
+                install_attachment_store(conn)
+            self._installed = True
+
+    def blob_path(self, digest):
+        return os.path.join(self.root, digest[:2], digest[2:4], digest)
+
+    def open_writer(self):
+        return BlobWriter(self)
+
+    def save_stream(self, stream, mime=None):
+        """Guarda el contenido de un stream leído por bloques (memoria constante)"""
+        writer = self.open_writer()
+        try:
+            while True:
+                block = stream.read(STORE_CHUNK_SIZE)
+                if not block:
+                    break
+                writer.write(block)
+            blob = writer.finish(mime)
+        except Exception:
+            writer.abort()
+            raise
+        self.count(blob)
+        return blob
+
+    def count(self, blob):
+        with self._lock:
+            if blob['deduplicated']:
+                self.metrics['deduplicated'] += 1
+                self.metrics['bytes_deduplicated'] += blob['size']
+            else:
+                self.metrics['stored'] += 1
+                self.metrics['bytes_stored'] += blob['size']
+
+    def attach(self, conn, ticket_id, blob, stored_name, original_name):
+        """Registra el contenido (si es nuevo) y lo enlaza al ticket, en la transacción del llamador"""
+        if not self._installed:
+            install_attachment_store(conn)
+            self._installed = True
+        now = time.time()
+        if blob is not None:
+            conn.execute('''
+                INSERT INTO attachments (hash, size, mime, created_at) VALUES (?, ?, ?, ?)
+                ON CONFLICT(hash) DO UPDATE SET unreferenced_at = NULL, local = 1
+            ''', (blob['hash'], blob['size'], blob['mime'], now))
+        conn.execute('''
+            INSERT INTO ticket_attachments (ticket_id, hash, stored_name, original_name, created_at)
+            VALUES (?, ?, ?, ?, ?)
+        ''', (ticket_id, blob['hash'] if blob else None, stored_name, original_name, now))
+
+    def find(self, conn, ticket_id, stored_name):
+        """Adjunto de un ticket por su nombre guardado: dict o None"""
+        row = conn.execute('''
+            SELECT ta.hash, ta.original_name, a.size, a.mime, a.drive_id, a.created_at, a.local
+            FROM ticket_attachments ta
+            LEFT JOIN attachments a ON a.hash = ta.hash
+            WHERE ta.ticket_id = ? AND ta.stored_name = ?
+        ''', (ticket_id, stored_name)).fetchone()
+        if row is None:
+            return None
+        digest, original_name, size, mime, drive_id, created_at, local = row
+        return {
+            'hash': digest,
+            'original_name': original_name,
+            'size': size,
+            'mime': mime,
+            'drive_id': drive_id,
+            'created_at': created_at,
+            'local': bool(local),
+            'path': self.blob_path(digest) if digest else None,
+        }
+
+    def list_for_ticket(self, conn, ticket_id):
+        """Adjuntos de un ticket con metadatos y estado de su vista previa, en una sola consulta
+
+        No toca el disco: la disponibilidad local sale de attachments.local,
+        que se mantiene al subir, al descargar y en refresh_availability().
+        Recorre idx_ticket_attachments_ticket; los nombres guardados llevan
+        la fecha delante, así que el orden es el de subida.
+        """
+        rows = conn.execute('''
+            SELECT ta.stored_name, ta.original_name, ta.hash, a.size, a.mime, a.drive_id,
+                   COALESCE(a.local, 0), p.status
+            FROM ticket_attachments ta
+            LEFT JOIN attachments a ON a.hash = ta.hash
+            LEFT JOIN attachment_previews p ON p.hash = ta.hash
+            WHERE ta.ticket_id = ?
+            ORDER BY ta.stored_name, ta.id
+        ''', (ticket_id,)).fetchall()
+        return [{
+            'stored_name': stored_name,
+            'original_name': original_name,
+            'hash': digest,
+            'size': size,
+            'mime': mime,
+            'drive_id': drive_id,
+            'local': bool(local),
+            'preview_status': preview_status,
+        } for stored_name, original_name, digest, size, mime, drive_id, local, preview_status in rows]
+
+    def set_local(self, conn, digest, local):
+        conn.execute('UPDATE attachments SET local = ? WHERE hash = ?', (1 if local else 0, digest))
+
+    def refresh_availability(self):
+        """Recalcula attachments.local comprobando el disco (tras traer la base de Drive)"""
+        self.install()
+        with db_connection() as conn:
+            rows = conn.execute('SELECT hash, local FROM attachments').fetchall()
+            changed = []
+            for digest, local in rows:
+                present = 1 if os.path.exists(self.blob_path(digest)) else 0
+                if present != local:
+                    changed.append((present, digest))
+            conn.executemany('UPDATE attachments SET local = ? WHERE hash = ?', changed)
+            conn.commit()
+        if changed:
+            print(f"🔎 Disponibilidad local actualizada en {len(changed)} adjuntos")
+        return len(changed)
+
+    def restore_from(self, chunks, digest, mime=None):
+        """Reenvía los bloques de `chunks` y guarda de nuevo el contenido si su hash es `digest`
+
+        Pensado para servir desde Drive un adjunto que falta en local: la
+        siguiente descarga ya sale del disco. Si la descarga se corta o el
+        hash no coincide, el temporal se descarta.
+        """
+        writer = self.open_writer()
+        try:
+            for chunk in chunks:
+                writer.write(chunk)
+                yield chunk
+        except BaseException:
+            writer.abort()
+            raise
+        if writer.sha256.hexdigest() == digest:
+            writer.finish(mime)
+            with db_connection() as conn:
+                self.set_local(conn, digest, True)
+                conn.commit()
+            print(f"📥 Adjunto {digest[:12]} recuperado desde Drive")
+        else:
+            writer.abort()
+            print(f"⚠️ El adjunto descargado de Drive no coincide con {digest[:12]}")
+
+    def set_drive_id(self, conn, digest, drive_id):
+        conn.execute('UPDATE attachments SET drive_id = ? WHERE hash = ?', (drive_id, digest))
+
+    def get_drive_id(self, conn, digest):
+        row = conn.execute('SELECT drive_id FROM attachments WHERE hash = ?', (digest,)).fetchone()
+        return row[0] if row else None
+
+    def migrate_legacy(self, upload_folder):
+        """Pasa al almacén los adjuntos antiguos (lista JSON en tickets.attachments)
+
+        Solo procesa tickets sin enlaces. Los archivos locales se guardan por
+        hash y se borran de upload_folder; los que no existen se enlazan sin
+        contenido (se muestran como no disponibles).
+        """
+        self.install()
+        migrated = 0
+        with db_connection() as conn:
+            rows = conn.execute('''
+                SELECT id, attachments FROM tickets
+                WHERE attachments IS NOT NULL AND attachments NOT IN ('', '[]')
+                  AND NOT EXISTS (SELECT 1 FROM ticket_attachments ta WHERE ta.ticket_id = tickets.id)
+            ''').fetchall()
+        for ticket_id, value in rows:
+            try:
+                names = json.loads(value)
+            except (TypeError, ValueError):
+                continue
+            legacy_files = []
+            with db_connection() as conn:
+                for name in names:
+                    path = os.path.join(upload_folder, name)
+                    blob = None
+                    if os.path.exists(path):
+                        with open(path, 'rb') as f:
+                            blob = self.save_stream(f)
+                        legacy_files.append(path)
+                    original_name = name.split('_', 2)[-1] if name.count('_') >= 2 else name
+                    self.attach(conn, ticket_id, blob, name, original_name)
+                    migrated += 1
+                conn.commit()
+            for path in legacy_files:
+                os.remove(path)
+        if migrated:
+            print(f"📦 {migrated} adjuntos antiguos movidos al almacén por contenido")
+        return migrated
+
+    def collect_garbage(self, grace=STORE_GC_GRACE_SECONDS):
+        """Borra los contenidos sin referencias y los archivos huérfanos; devuelve los bytes liberados"""
+        self.install()
+        cutoff = time.time() - grace
+        freed = 0
+        with db_connection() as conn:
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                rows = conn.execute('''
+                    SELECT hash, size FROM attachments
+                    WHERE refcount <= 0 AND COALESCE(unreferenced_at, created_at) < ?
+                ''', (cutoff,)).fetchall()
+                conn.executemany('DELETE FROM attachments WHERE hash = ?', [(row[0],) for row in rows])
+                known = {row[0] for row in conn.execute('SELECT hash FROM attachments')}
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+
+        for digest, size in rows:
+            path = self.blob_path(digest)
+            if os.path.exists(path) and os.path.getmtime(path) < cutoff:
+                os.remove(path)
+                freed += size
+
+        # Contenidos escritos sin llegar a registrarse (proceso caído) y temporales viejos
+        for directory, _, files in os.walk(self.root):
+            for name in files:
+                path = os.path.join(directory, name)
+                if os.path.getmtime(path) >= cutoff:
+                    continue
+                if directory == self.tmp_dir or name not in known:
+                    freed += os.path.getsize(path)
+                    os.remove(path)
+        if rows or freed:
+            print(f"🗑️ {len(rows)} adjuntos sin referencias eliminados, {freed} bytes liberados")
+        return freed
+
+    def get_stats(self):
+        """Contenidos únicos, referencias y bytes ahorrados por deduplicación"""
+        self.install()
+        with db_connection() as conn:
+            blobs, unique_bytes, references = conn.execute('''
+                SELECT COUNT(*), COALESCE(SUM(size), 0), COALESCE(SUM(refcount), 0) FROM attachments
+            ''').fetchone()
+            logical_bytes = conn.execute('''
+                SELECT COALESCE(SUM(a.size), 0) FROM ticket_attachments ta JOIN attachments a ON a.hash = ta.hash
+            ''').fetchone()[0]
+            unreferenced = conn.execute('SELECT COUNT(*) FROM attachments WHERE refcount <= 0').fetchone()[0]
+        with self._lock:
+            stats = dict(self.metrics)
+        stats.update({
+            'blobs': blobs,
+            'references': references,
+            'unreferenced': unreferenced,
+            'unique_bytes': unique_bytes,
+            'logical_bytes': logical_bytes,
+            'dedup_ratio': round(logical_bytes / unique_bytes, 2) if unique_bytes else None,
+        })
+        return stats
+
+
+# Instancia global
+attachment_store = AttachmentStore()
+
+
+if __name__ == "__main__":
+    # Uso: python attachment_store.py [stats|gc|migrate <carpeta>]
+    command = sys.argv[1] if len(sys.argv) > 1 else 'stats'
+    if command == 'gc':
+        attachment_store.collect_garbage()
+    elif command == 'migrate':
+        attachment_store.migrate_legacy(sys.argv[2] if len(sys.argv) > 2 else 'temp_uploads')
+    print(f"📊 {attachment_store.get_stats()}")
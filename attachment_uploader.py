@@ -0,0 +1,415 @@
+"""
+Subida de archivos adjuntos a Google Drive del Sistema de Tickets
+Las subidas se guardan en attachment_uploads y un grupo acotado de hilos las sube en
+paralelo con sesiones reanudables, fuera de la petición que creó el ticket
+"""
+
+import json
+import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from googleapiclient.errors import HttpError
+
+from attachment_store import attachment_store
+from db_pool import db_connection
+
+# Configuración
+ATTACHMENT_UPLOAD_WORKERS = 3        # Subidas simultáneas
+ATTACHMENT_POLL_INTERVAL = 10.0      # Segundos entre revisiones de la tabla
+ATTACHMENT_MAX_ATTEMPTS = 8
+ATTACHMENT_BACKOFF_BASE = 15.0       # Segundos; se duplica en cada intento
+ATTACHMENT_BACKOFF_MAX = 1800.0
+ATTACHMENT_STALE_SECONDS = 900       # Subidas 'uploading' huérfanas (proceso caído) vuelven a 'pending'
+ATTACHMENT_RETENTION_DAYS = 30
+ATTACHMENT_PURGE_INTERVAL = 86400    # Segundos entre podas de subidas terminadas
+
+
+def install_attachment_uploads(conn, commit=True):
+    """Crea la tabla de subidas de adjuntos pendientes
+
+    commit=False permite crearla dentro de una transacción ya abierta.
+    """
+    cursor = conn.cursor()
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS attachment_uploads (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            ticket_id INTEGER NOT NULL,
+            file_path TEXT NOT NULL,
+            original_name TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'pending',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            next_attempt_at REAL NOT NULL,
+            claimed_at REAL,
+            session_uri TEXT,
+            offset_bytes INTEGER NOT NULL DEFAULT 0,
+            total_bytes INTEGER,
+            drive_id TEXT,
+            content_hash TEXT,
+            last_error TEXT,
+            created_at REAL NOT NULL,
+            finished_at REAL
+        )
+    ''')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_attachment_uploads_due
+        ON attachment_uploads (status, next_attempt_at)
+    ''')
+    # Tablas creadas antes del almacén por contenido
+    cursor.execute('PRAGMA table_info(attachment_uploads)')
+    if 'content_hash' not in [row[1] for row in cursor.fetchall()]:
+        cursor.execute('ALTER TABLE attachment_uploads ADD COLUMN content_hash TEXT')
+    if commit:
+        conn.commit()
+
+
+class AttachmentUploader:
+    """Sube adjuntos en segundo plano con un ThreadPoolExecutor acotado
+
+    Cada subida usa una sesión reanudable de Drive. Tras cada bloque confirmado
+    se guardan la URI de la sesión y el desplazamiento; si falla, el reintento
+    continúa desde ahí en lugar de volver a subir el archivo entero. Un
+    contenido que ya está en Drive (mismo hash) no se vuelve a subir.
+    """
+
+    def __init__(self, drive_manager, workers=ATTACHMENT_UPLOAD_WORKERS):
+        self.drive_manager = drive_manager
+        self.workers = workers
+        self._cond = threading.Condition()
+        self._thread = None
+        self._executor = None
+        self._installed = False
+        self._in_flight = 0
+        self._next_purge = 0.0
+        self._requests = {}      # id de subida → petición reanudable viva (reintentos en el mismo proceso)
+
+        self.metrics = {
+            'enqueued': 0,
+            'uploaded': 0,
+            'bytes_uploaded': 0,
+            'resumed': 0,
+            'deduplicated': 0,
+            'retries': 0,
+            'failed': 0,
+            'last_upload_ms': None,
+        }
+
+    def install(self):
+        if not self._installed:
+            attachment_store.install()
+            with db_connection() as conn:
+                install_attachment_uploads(conn)
+            self._installed = True
+
+    def start(self):
+        """Inicia el despachador y el grupo de hilos (una sola vez)"""
+        with self._cond:
+            if self._thread is not None:
+                return
+            self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='attachment-upload')
+            self._thread = threading.Thread(target=self._dispatcher, name='attachment-uploads', daemon=True)
+        try:
+            self.install()
+        except Exception as e:
+            print(f"❌ Error creando tabla de subidas de adjuntos: {e}")
+        self._thread.start()
+
+    def enqueue(self, ticket_id, attachments, conn=None):
+        """Registra los adjuntos de un ticket para subirlos en segundo plano
+
+        `attachments` es una lista de dicts con 'path', 'original_name' y 'hash'.
+        Con `conn`, las filas se insertan en la transacción del llamador (se
+        suben solo si el ticket llega a guardarse); el llamador hace commit y
+        después llama a wake().
+        """
+        now = time.time()
+        rows = [(ticket_id, item['path'], item['original_name'], item.get('hash'), now, now)
+                for item in attachments if os.path.exists(item['path'])]
+        if not rows:
+            return 0
+
+        sql = '''
+            INSERT INTO attachment_uploads (ticket_id, file_path, original_name, content_hash, status,
+                                            next_attempt_at, created_at)
+            VALUES (?, ?, ?, ?, 'pending', ?, ?)
+        '''
+        if conn is not None:
+            # La conexión del llamador puede tener ya el bloqueo de escritura: nada de otra conexión
+            if not self._installed:
+                install_attachment_uploads(conn, commit=False)
+            conn.executemany(sql, rows)
+        else:
+            self.install()
+            with db_connection() as own_conn:
+                own_conn.executemany(sql, rows)
+                own_conn.commit()
+            self.wake()
+        with self._cond:
+            self.metrics['enqueued'] += len(rows)
+        return len(rows)
+
+    def wake(self):
+        """Avisa al despachador de que hay subidas nuevas"""
+        self.start()
+        with self._cond:
+            self._cond.notify_all()
+
+    def _claim(self, limit):
+        """Toma hasta `limit` subidas vencidas y las marca como 'uploading'
+
+        Nunca dos subidas del mismo contenido a la vez: la segunda espera y
+        reutiliza el archivo de Drive de la primera.
+        """
+        now = time.time()
+        with db_connection() as conn:
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                conn.execute('''
+                    UPDATE attachment_uploads SET status = 'pending'
+                    WHERE status = 'uploading' AND claimed_at < ?
+                ''', (now - ATTACHMENT_STALE_SECONDS,))
+                candidates = conn.execute('''
+                    SELECT id, ticket_id, file_path, original_name, attempts, session_uri, offset_bytes,
+                           content_hash
+                    FROM attachment_uploads
+                    WHERE status = 'pending' AND next_attempt_at <= ?
+                      AND (content_hash IS NULL OR content_hash NOT IN (
+                          SELECT content_hash FROM attachment_uploads
+                          WHERE status = 'uploading' AND content_hash IS NOT NULL))
+                    ORDER BY next_attempt_at, id
+                    LIMIT ?
+                ''', (now, limit)).fetchall()
+                rows, hashes = [], set()
+                for row in candidates:
+                    if row[7] is not None and row[7] in hashes:
+                        continue
+                    hashes.add(row[7])
+                    rows.append(row)
+                conn.executemany('''
+                    UPDATE attachment_uploads
+                    SET status = 'uploading', attempts = attempts + 1, claimed_at = ?
+                    WHERE id = ?
+                ''', [(now, row[0]) for row in rows])
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+        return rows
+
+    def _dispatcher(self):
+        while True:
+            rows = []
+            try:
+                with self._cond:
+                    free = self.workers - self._in_flight
+                if free > 0 and self.drive_manager.authenticated:
+                    rows = self._claim(free)
+            except Exception as e:
+                print(f"❌ Error leyendo subidas de adjuntos: {e}")
+
+            with self._cond:
+                self._in_flight += len(rows)
+            for row in rows:
+                self._executor.submit(self._run, row)
+            if not rows:
+                self._purge_if_due()
+
+            with self._cond:
+                if rows and self._in_flight < self.workers:
+                    continue
+                self._cond.wait(ATTACHMENT_POLL_INTERVAL)
+
+    def _save_progress(self, upload_id, session_uri, offset):
+        with db_connection() as conn:
+            conn.execute('''
+                UPDATE attachment_uploads SET session_uri = ?, offset_bytes = ?, claimed_at = ?
+                WHERE id = ?
+            ''', (session_uri, offset, time.time(), upload_id))
+            conn.commit()
+
+    def _run(self, row):
+        try:
+            self._upload(row)
+        except Exception as e:
+            print(f"❌ Error inesperado subiendo adjunto: {e}")
+        finally:
+            with self._cond:
+                self._in_flight -= 1
+                self._cond.notify_all()
+
+    def _upload(self, row):
+        upload_id, ticket_id, file_path, original_name, attempts, session_uri, offset, content_hash = row
+        attempts += 1
+        if content_hash:
+            with db_connection() as conn:
+                drive_id = attachment_store.get_drive_id(conn, content_hash)
+            if drive_id:
+                # El mismo contenido ya se subió para otro adjunto: se reutiliza
+                self._requests.pop(upload_id, None)
+                drive_info = {
+                    'drive_id': drive_id,
+                    'name': original_name,
+                    'size': str(os.path.getsize(file_path)) if os.path.exists(file_path) else None,
+                    'original_name': original_name
+                }
+                self._complete(upload_id, ticket_id, drive_info, content_hash)
+                with self._cond:
+                    self.metrics['deduplicated'] += 1
+                print(f"♻️ Adjunto {original_name} ya estaba en Drive (ticket #{ticket_id})")
+                self.drive_manager.schedule_sync('attachment')
+                return
+
+        if not os.path.exists(file_path):
+            self._finish(upload_id, 'failed', error='El archivo local ya no existe')
+            with self._cond:
+                self.metrics['failed'] += 1
+            return
+
+        started = time.perf_counter()
+        request = self._requests.pop(upload_id, None)
+        try:
+            if request is None:
+                request = self.drive_manager.attachment_upload_request(
+                    file_path, ticket_id, original_name, session_uri, offset
+                )
+            if getattr(request, 'resumable_progress', 0):
+                with self._cond:
+                    self.metrics['resumed'] += 1
+                print(f"⏯️ Reanudando adjunto {original_name} desde {request.resumable_progress} bytes")
+
+            http = self.drive_manager.thread_http()
+            response = None
+            while response is None:
+                status, response = request.next_chunk(http=http)
+                if status is not None:
+                    self._save_progress(upload_id, request.resumable_uri, status.resumable_progress)
+        except HttpError as e:
+            if getattr(e.resp, 'status', None) in (404, 410):
+                # La sesión reanudable caducó: se empieza de nuevo
+                self._save_progress(upload_id, None, 0)
+            else:
+                self._requests[upload_id] = request
+                if request is not None and getattr(request, 'resumable_uri', None):
+                    self._save_progress(upload_id, request.resumable_uri, request.resumable_progress)
+            self._fail(upload_id, attempts, e)
+            return
+        except Exception as e:
+            if request is not None and getattr(request, 'resumable_uri', None):
+                self._requests[upload_id] = request
+                self._save_progress(upload_id, request.resumable_uri, request.resumable_progress)
+            self._fail(upload_id, attempts, e)
+            return
+
+        drive_info = {
+            'drive_id': response.get('id'),
+            'name': response.get('name'),
+            'size': response.get('size'),
+            'original_name': original_name
+        }
+        self._complete(upload_id, ticket_id, drive_info, content_hash)
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        with self._cond:
+            self.metrics['uploaded'] += 1
+            self.metrics['bytes_uploaded'] += int(drive_info['size'] or 0)
+            self.metrics['last_upload_ms'] = round(elapsed_ms, 1)
+        print(f"✅ Archivo adjunto subido: {original_name} (ticket #{ticket_id}, {elapsed_ms:.0f} ms)")
+        self.drive_manager.schedule_sync('attachment')
+
+    def _complete(self, upload_id, ticket_id, drive_info, content_hash=None):
+        """Añade el adjunto a tickets.drive_attachments y cierra la subida, en una transacción"""
+        with db_connection() as conn:
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                row = conn.execute('SELECT drive_attachments FROM tickets WHERE id = ?', (ticket_id,)).fetchone()
+                if row is not None:
+                    try:
+                        current = json.loads(row[0]) if row[0] else []
+                    except (TypeError, ValueError):
+                        current = []
+                    current.append(drive_info)
+                    conn.execute('UPDATE tickets SET drive_attachments = ? WHERE id = ?',
+                                 (json.dumps(current), ticket_id))
+                conn.execute('''
+                    UPDATE attachment_uploads
+                    SET status = 'done', drive_id = ?, total_bytes = ?, offset_bytes = ?,
+                        session_uri = NULL, last_error = NULL, finished_at = ?
+                    WHERE id = ?
+                ''', (drive_info['drive_id'], drive_info['size'], drive_info['size'], time.time(), upload_id))
+                if content_hash:
+                    attachment_store.set_drive_id(conn, content_hash, drive_info['drive_id'])
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+
+    def _finish(self, upload_id, status, error=None, next_attempt_at=None):
+        with db_connection() as conn:
+            conn.execute('''
+                UPDATE attachment_uploads
+                SET status = ?, last_error = ?, next_attempt_at = COALESCE(?, next_attempt_at),
+                    finished_at = CASE WHEN ? = 'failed' THEN ? ELSE finished_at END
+                WHERE id = ?
+            ''', (status, error, next_attempt_at, status, time.time(), upload_id))
+            conn.commit()
+
+    @staticmethod
+    def backoff(attempts):
+        """Espera exponencial con jitter antes del siguiente intento"""
+        delay = min(ATTACHMENT_BACKOFF_BASE * (2 ** (attempts - 1)), ATTACHMENT_BACKOFF_MAX)
+        return delay * random.uniform(0.8, 1.2)
+
+    def _fail(self, upload_id, attempts, error):
+        if attempts < ATTACHMENT_MAX_ATTEMPTS:
+            delay = self.backoff(attempts)
+            self._finish(upload_id, 'pending', str(error), time.time() + delay)
+            with self._cond:
+                self.metrics['retries'] += 1
+            print(f"⚠️ Adjunto: reintento en {delay:.0f}s ({error})")
+        else:
+            self._requests.pop(upload_id, None)
+            self._finish(upload_id, 'failed', str(error))
+            with self._cond:
+                self.metrics['failed'] += 1
+            print(f"❌ Adjunto descartado tras {attempts} intentos: {error}")
+
+    def _purge_if_due(self):
+        """Poda las subidas terminadas como mucho una vez por ATTACHMENT_PURGE_INTERVAL"""
+        now = time.time()
+        if now < self._next_purge:
+            return
+        self._next_purge = now + ATTACHMENT_PURGE_INTERVAL
+        try:
+            removed = self.purge()
+            if removed:
+                print(f"🗑️ {removed} registros de subidas terminadas eliminados")
+        except Exception as e:
+            print(f"❌ Error podando registros de subidas: {e}")
+
+    def purge(self, days=ATTACHMENT_RETENTION_DAYS):
+        """Elimina los registros de subidas terminadas más antiguos que `days` días"""
+        with db_connection() as conn:
+            cursor = conn.execute('''
+                DELETE FROM attachment_uploads WHERE status = 'done' AND finished_at < ?
+            ''', (time.time() - days * 86400,))
+            conn.commit()
+            return cursor.rowcount
+
+    def get_metrics(self):
+        """Subidas en curso, en cola, reanudadas y fallidas"""
+        with self._cond:
+            metrics = dict(self.metrics)
+            metrics['in_flight'] = self._in_flight
+        metrics['workers'] = self.workers
+        try:
+            self.install()
+            with db_connection() as conn:
+                counts = dict(conn.execute('''
+                    SELECT status, COUNT(*) FROM attachment_uploads GROUP BY status
+                ''').fetchall())
+            metrics['queue_depth'] = counts.get('pending', 0) + counts.get('uploading', 0)
+            metrics['failed_total'] = counts.get('failed', 0)
+        except Exception as e:
+            print(f"⚠️ No se pudieron leer métricas de subidas de adjuntos: {e}")
+        return metrics
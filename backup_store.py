@@ -0,0 +1,285 @@
+"""
+Almacén de backups deduplicado del Sistema de Tickets
+Cada backup es un manifiesto con la lista de bloques del snapshot; cada bloque
+distinto se guarda una sola vez, comprimido y nombrado por su SHA-256
+"""
+
+import hashlib
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+import zlib
+from datetime import datetime
+
+from db_pool import DATABASE
+from db_snapshot import create_snapshot, restore_snapshot
+
+# Configuración
+BACKUP_STORE_DIR = 'backups'
+BACKUP_CHUNK_SIZE = 64 * 1024     # Múltiplo de cualquier tamaño de página de SQLite: bloques alineados
+BACKUP_COMPRESS_LEVEL = 6
+# Retención: todos los de la última hora y el más reciente de cada hora, día y semana
+RETENTION_RECENT_SECONDS = 3600
+RETENTION_HOURLY = 24
+RETENTION_DAILY = 7
+RETENTION_WEEKLY = 8
+
+
+class BackupStoreError(Exception):
+    """Backup inexistente o bloque dañado"""
+
+
+class BackupStore:
+    """Backups por bloques con direccionamiento por contenido
+
+    backups/chunks/ab/<sha256>  bloque comprimido con zlib
+    backups/manifests/<id>.json lista ordenada de bloques, tamaño y SHA-256 del archivo
+    Entre dos backups solo cambian las páginas tocadas, así que casi todos
+    los bloques ya existen y no se vuelven a escribir.
+    """
+
+    def __init__(self, root=BACKUP_STORE_DIR):
+        self.root = root
+        self.chunks_dir = os.path.join(root, 'chunks')
+        self.manifests_dir = os.path.join(root, 'manifests')
+        self._lock = threading.Lock()
+
+    def _chunk_path(self, digest):
+        return os.path.join(self.chunks_dir, digest[:2], digest)
+
+    @staticmethod
+    def _write_atomic(path, data):
+        directory = os.path.dirname(path)
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(prefix='.tmp_', dir=directory)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    def _read_manifest(self, backup_id):
+        path = os.path.join(self.manifests_dir, f'{backup_id}.json')
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            raise BackupStoreError(f'Backup no encontrado: {backup_id}')
+
+    def list_backups(self):
+        """Manifiestos, del más reciente al más antiguo"""
+        if not os.path.isdir(self.manifests_dir):
+            return []
+        manifests = []
+        for name in os.listdir(self.manifests_dir):
+            if name.endswith('.json'):
+                try:
+                    manifests.append(self._read_manifest(name[:-5]))
+                except (ValueError, BackupStoreError) as e:
+                    print(f"⚠️ Manifiesto ilegible {name}: {e}")
+        manifests.sort(key=lambda manifest: manifest['created_at'], reverse=True)
+        return manifests
+
+    def create_backup(self, db_path=DATABASE, label=None):
+        """Guarda un snapshot consistente de db_path; devuelve su manifiesto"""
+        started = time.perf_counter()
+        fd, snapshot_path = tempfile.mkstemp(prefix='.backup_', suffix='.db')
+        os.close(fd)
+        try:
+            create_snapshot(snapshot_path, db_path)
+            chunks = []
+            new_chunks = 0
+            new_bytes = 0
+            file_hash = hashlib.sha256()
+            with self._lock, open(snapshot_path, 'rb') as f:
+                while True:
+                    block = f.read(BACKUP_CHUNK_SIZE)
+                    if not block:
+                        break
+                    file_hash.update(block)
+                    digest = hashlib.sha256(block).hexdigest()
+                    chunks.append(digest)
+                    path = self._chunk_path(digest)
+                    if not os.path.exists(path):
+                        data = zlib.compress(block, BACKUP_COMPRESS_LEVEL)
+                        self._write_atomic(path, data)
+                        new_chunks += 1
+                        new_bytes += len(data)
+
+                now = time.time()
+                manifest = {
+                    'id': datetime.fromtimestamp(now).strftime('%Y%m%d_%H%M%S_%f'),
+                    'created_at': now,
+                    'label': label,
+                    'size': os.path.getsize(snapshot_path),
+                    'sha256': file_hash.hexdigest(),
+                    'chunk_size': BACKUP_CHUNK_SIZE,
+                    'chunks': chunks,
+                    'new_chunks': new_chunks,
+                    'new_bytes': new_bytes,
+                }
+                self._write_atomic(os.path.join(self.manifests_dir, f"{manifest['id']}.json"),
+                                   json.dumps(manifest).encode('utf-8'))
+        finally:
+            os.remove(snapshot_path)
+
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        print(f"📁 Backup {manifest['id']}: {len(chunks)} bloques, {new_chunks} nuevos "
+              f"({new_bytes} bytes escritos, {elapsed_ms:.0f} ms)")
+        return manifest
+
+    def find_backup(self, at=None):
+        """Backup más reciente creado en o antes de `at` (epoch o datetime); None si no hay"""
+        if isinstance(at, datetime):
+            at = at.timestamp()
+        for manifest in self.list_backups():
+            if at is None or manifest['created_at'] <= at:
+                return manifest
+        return None
+
+    def _materialize(self, manifest, target_path):
+        """Reconstruye el archivo de un backup verificando cada bloque y el total"""
+        file_hash = hashlib.sha256()
+        with open(target_path, 'wb') as out:
+            for digest in manifest['chunks']:
+                try:
+                    with open(self._chunk_path(digest), 'rb') as f:
+                        block = zlib.decompress(f.read())
+                except (OSError, zlib.error) as e:
+                    raise BackupStoreError(f'Bloque ilegible {digest[:12]}: {e}')
+                if hashlib.sha256(block).hexdigest() != digest:
+                    raise BackupStoreError(f'Bloque dañado {digest[:12]}')
+                file_hash.update(block)
+                out.write(block)
+        if file_hash.hexdigest() != manifest['sha256']:
+            raise BackupStoreError(f"Backup {manifest['id']} no coincide con su SHA-256")
+
+    def restore(self, backup_id=None, at=None, db_path=DATABASE):
+        """Restaura un backup por id o el vigente en el instante `at` (restauración a un punto en el tiempo)"""
+        manifest = self._read_manifest(backup_id) if backup_id else self.find_backup(at)
+        if manifest is None:
+            raise BackupStoreError('No hay backups anteriores a ese instante')
+
+        fd, tmp_path = tempfile.mkstemp(prefix='.restore_', suffix='.db',
+                                        dir=os.path.dirname(os.path.abspath(db_path)))
+        os.close(fd)
+        try:
+            self._materialize(manifest, tmp_path)
+            restore_snapshot(tmp_path, db_path)
+        finally:
+            os.remove(tmp_path)
+        print(f"🔄 Backup {manifest['id']} restaurado")
+        return manifest
+
+    def select_retained(self, manifests, now=None):
+        """Ids a conservar: los recientes y el último backup de cada hora, día y semana"""
+        now = now or time.time()
+        keep = {manifest['id'] for manifest in manifests
+                if now - manifest['created_at'] < RETENTION_RECENT_SECONDS}
+        if manifests:
+            keep.add(manifests[0]['id'])
+        policies = [
+            (RETENTION_HOURLY, 3600),
+            (RETENTION_DAILY, 86400),
+            (RETENTION_WEEKLY, 7 * 86400),
+        ]
+        for count, span in policies:
+            seen = set()
+            for manifest in manifests:
+                age_bucket = int((now - manifest['created_at']) // span)
+                if age_bucket >= count:
+                    continue
+                bucket = int(manifest['created_at'] // span)
+                if bucket not in seen:
+                    # manifests va del más reciente al más antiguo: el primero de cada franja es el último
+                    seen.add(bucket)
+                    keep.add(manifest['id'])
+        return keep
+
+    def apply_retention(self, now=None):
+        """Borra los manifiestos fuera de la política y recoge los bloques huérfanos"""
+        with self._lock:
+            manifests = self.list_backups()
+            keep = self.select_retained(manifests, now)
+            removed = 0
+            for manifest in manifests:
+                if manifest['id'] not in keep:
+                    os.remove(os.path.join(self.manifests_dir, f"{manifest['id']}.json"))
+                    removed += 1
+            freed = self._collect_garbage()
+        if removed:
+            print(f"🗑️ {removed} backups fuera de la retención eliminados, {freed} bytes liberados")
+        return removed
+
+    def _collect_garbage(self):
+        """Elimina los bloques que ningún manifiesto referencia; devuelve los bytes liberados"""
+        referenced = set()
+        for manifest in self.list_backups():
+            referenced.update(manifest['chunks'])
+        freed = 0
+        if not os.path.isdir(self.chunks_dir):
+            return freed
+        for shard in os.listdir(self.chunks_dir):
+            shard_dir = os.path.join(self.chunks_dir, shard)
+            for name in os.listdir(shard_dir):
+                if name not in referenced:
+                    path = os.path.join(shard_dir, name)
+                    freed += os.path.getsize(path)
+                    os.remove(path)
+        return freed
+
+    def get_stats(self):
+        """Tamaño lógico, tamaño en disco y ratios de deduplicación y compresión"""
+        manifests = self.list_backups()
+        logical = sum(manifest['size'] for manifest in manifests)
+        unique = set()
+        unique_raw = 0
+        for manifest in manifests:
+            for index, digest in enumerate(manifest['chunks']):
+                if digest not in unique:
+                    unique.add(digest)
+                    # El último bloque puede ser más corto que BACKUP_CHUNK_SIZE
+                    unique_raw += min(manifest['chunk_size'], manifest['size'] - index * manifest['chunk_size'])
+        stored = 0
+        for digest in unique:
+            path = self._chunk_path(digest)
+            if os.path.exists(path):
+                stored += os.path.getsize(path)
+        return {
+            'backups': len(manifests),
+            'latest': manifests[0]['id'] if manifests else None,
+            'oldest': manifests[-1]['id'] if manifests else None,
+            'chunks': len(unique),
+            'logical_bytes': logical,
+            'unique_bytes': unique_raw,
+            'stored_bytes': stored,
+            'dedup_ratio': round(logical / unique_raw, 2) if unique_raw else None,
+            'compression_ratio': round(unique_raw / stored, 2) if stored else None,
+            'total_ratio': round(logical / stored, 2) if stored else None,
+        }
+
+
+# Instancia global
+backup_store = BackupStore()
+
+
+if __name__ == "__main__":
+    # Uso: python backup_store.py [backup|list|stats|restore <id>|retention]
+    command = sys.argv[1] if len(sys.argv) > 1 else 'stats'
+    if command == 'backup':
+        backup_store.create_backup(label='manual')
+    elif command == 'list':
+        for manifest in backup_store.list_backups():
+            created = datetime.fromtimestamp(manifest['created_at']).isoformat(timespec='seconds')
+            print(f"   - {manifest['id']}  {created}  {manifest['size']} bytes  {manifest.get('label') or ''}")
+    elif command == 'restore' and len(sys.argv) > 2:
+        backup_store.restore(sys.argv[2])
+    elif command == 'retention':
+        backup_store.apply_retention()
+    print(f"📊 {backup_store.get_stats()}")
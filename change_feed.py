@@ -0,0 +1,156 @@
+"""
+Feed de cambios en vivo del Sistema de Tickets
+Los caminos de escritura publican un evento una sola vez y todos los dashboards abiertos lo reciben
+(Server-Sent Events o long-poll)
+"""
+
+import json
+import threading
+import time
+from collections import deque
+
+# Configuración
+FEED_HISTORY = 500            # Eventos retenidos para reconexiones (Last-Event-ID)
+FEED_HEARTBEAT = 15           # Segundos entre comentarios keep-alive del stream SSE
+FEED_STREAM_MAX_SECONDS = 300  # El navegador reconecta solo; libera el hilo periódicamente
+LONG_POLL_TIMEOUT = 25
+
+# Destinatarios de un evento
+AUDIENCE_ALL = 'all'
+AUDIENCE_DEVELOPERS = 'developers'
+
+
+class ChangeFeed:
+    def __init__(self, history=FEED_HISTORY):
+        self._events = deque(maxlen=history)
+        self._last_id = 0
+        self._cond = threading.Condition(threading.Lock())
+
+        self.metrics = {
+            'published': 0,
+            'delivered': 0,
+            'subscribers': 0,
+            'resets': 0,
+        }
+
+    def publish(self, event_type, data, audience=AUDIENCE_ALL):
+        """Publica un evento; audience es AUDIENCE_ALL, AUDIENCE_DEVELOPERS o el id del dueño del ticket
+
+        El evento se serializa una sola vez, sin importar cuántos suscriptores haya.
+        """
+        with self._cond:
+            self._last_id += 1
+            event = {
+                'id': self._last_id,
+                'type': event_type,
+                'audience': audience,
+                'payload': json.dumps(data, default=str),
+            }
+            self._events.append(event)
+            self.metrics['published'] += 1
+            self._cond.notify_all()
+        return event['id']
+
+    def last_event_id(self):
+        """Id del último evento publicado (punto de partida para un cliente nuevo)"""
+        with self._cond:
+            return self._last_id
+
+    @staticmethod
+    def is_visible(event, user_id, is_developer):
+        """Regla de visibilidad de view_ticket: desarrolladores ven todo, usuarios solo lo suyo"""
+        audience = event['audience']
+        if audience == AUDIENCE_ALL or is_developer:
+            return True
+        if audience == AUDIENCE_DEVELOPERS:
+            return False
+        return audience == user_id
+
+    def wait_for_events(self, last_id, user_id=None, is_developer=False, timeout=LONG_POLL_TIMEOUT):
+        """Espera eventos posteriores a last_id
+
+        Devuelve (eventos, último id visto, reset). reset=True indica que el cliente
+        se perdió eventos que ya no están en el historial y debe recargar.
+        """
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            while self._last_id <= last_id:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return [], self._last_id, False
+                self._cond.wait(remaining)
+
+            if last_id > self._last_id or (self._events and self._events[0]['id'] > last_id + 1):
+                self.metrics['resets'] += 1
+                return [], self._last_id, True
+
+            events = [event for event in self._events
+                      if event['id'] > last_id and self.is_visible(event, user_id, is_developer)]
+            newest = self._last_id
+            self.metrics['delivered'] += len(events)
+        return events, newest, False
+
+    def stream(self, last_id, user_id=None, is_developer=False,
+               heartbeat=FEED_HEARTBEAT, max_seconds=FEED_STREAM_MAX_SECONDS):
+        """Generador de texto Server-Sent Events para un suscriptor"""
+        with self._cond:
+            self.metrics['subscribers'] += 1
+        try:
+            # Le indica al navegador cuánto esperar antes de reconectar
+            yield 'retry: 3000\n\n'
+            ends_at = time.monotonic() + max_seconds
+            while time.monotonic() < ends_at:
+                events, last_id, reset = self.wait_for_events(last_id, user_id, is_developer, timeout=heartbeat)
+                if reset:
+                    yield f'id: {last_id}\nevent: reset\ndata: {{}}\n\n'
+                    continue
+                if not events:
+                    yield ': ping\n\n'
+                    continue
+                for event in events:
+                    yield f"id: {event['id']}\nevent: {event['type']}\ndata: {event['payload']}\n\n"
+        finally:
+            with self._cond:
+                self.metrics['subscribers'] -= 1
+
+    def get_metrics(self):
+        """Métricas del feed"""
+        with self._cond:
+            metrics = dict(self.metrics)
+            metrics['last_event_id'] = self._last_id
+            metrics['retained'] = len(self._events)
+        return metrics
+
+
+# Instancia global del feed
+change_feed = ChangeFeed()
+
+
+def parse_event_id(value, default=0):
+    """Convierte Last-Event-ID / ?since= en entero"""
+    try:
+        return max(0, int(value))
+    except (TypeError, ValueError):
+        return default
+
+
+if __name__ == "__main__":
+    # Demostración: un publicador y varios suscriptores long-poll
+    print("🧪 PROBANDO FEED DE CAMBIOS")
+    received = {}
+
+    def subscriber(name, user_id, is_developer):
+        events, _, _ = change_feed.wait_for_events(0, user_id, is_developer, timeout=5)
+        received[name] = [event['type'] for event in events]
+
+    threads = [threading.Thread(target=subscriber, args=(f'cliente-{i}', i, i == 0)) for i in range(4)]
+    for thread in threads:
+        thread.start()
+    time.sleep(0.2)
+    change_feed.publish('ticket', {'id': 1, 'action': 'new'}, audience=2)
+    for thread in threads:
+        thread.join()
+
+    for name, types in sorted(received.items()):
+        print(f"📡 {name}: {types}")
+    print(f"📊 Métricas: {change_feed.get_metrics()}")
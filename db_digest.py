@@ -0,0 +1,176 @@
+"""
+Huellas de contenido de la base de datos del Sistema de Tickets
+SHA-256 por bloques de filas de las tablas replicadas, recalculado solo donde hubo cambios,
+y MD5/SHA-256 de archivos leídos por bloques
+"""
+
+import hashlib
+import json
+import os
+import sys
+import threading
+
+from db_pool import db_connection
+from drive_changelog import (
+    STATE_APPLIED, STATE_DEVICE_ID, STATE_LAST_PUSHED, SYNC_TABLES, current_seq, get_state, install_changelog
+)
+
+# Configuración
+DIGEST_CHUNK_ROWS = 1000          # Filas (por rango de id) en cada bloque con huella propia
+FILE_CHUNK_SIZE = 1024 * 1024     # Lectura de archivos en bloques de 1 MB
+
+
+class ContentDigest:
+    """Huella SHA-256 del contenido lógico de las tablas replicadas
+
+    Cada bloque de DIGEST_CHUNK_ROWS ids tiene su propia huella; la huella total
+    combina las de los bloques. Solo se recalculan los bloques que el registro
+    de cambios marca como modificados. No depende del archivo en disco (WAL,
+    checkpoints, tablas locales como sync_config o las bandejas de salida).
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._chunks = {}
+        self._seq = None
+        self._marker = None
+        self._digest = None
+
+        self.stats = {
+            'full': 0,
+            'incremental': 0,
+            'cached': 0,
+            'chunks_hashed': 0,
+        }
+
+    @staticmethod
+    def _hash_chunk(conn, table, chunk):
+        low = chunk * DIGEST_CHUNK_ROWS
+        cursor = conn.execute(
+            f'SELECT * FROM {table} WHERE id >= ? AND id < ? ORDER BY id', (low, low + DIGEST_CHUNK_ROWS)
+        )
+        digest = hashlib.sha256()
+        empty = True
+        for row in cursor:
+            empty = False
+            digest.update(json.dumps(row, default=str, separators=(',', ':')).encode('utf-8'))
+            digest.update(b'\n')
+        return None if empty else digest.hexdigest()
+
+    def _rehash(self, conn, keys):
+        for table, chunk in keys:
+            value = self._hash_chunk(conn, table, chunk)
+            if value is None:
+                self._chunks.pop((table, chunk), None)
+            else:
+                self._chunks[(table, chunk)] = value
+        self.stats['chunks_hashed'] += len(keys)
+
+    def _full(self, conn):
+        self._chunks = {}
+        keys = []
+        for table in SYNC_TABLES:
+            keys.extend((table, row[0]) for row in conn.execute(
+                f'SELECT DISTINCT id / {DIGEST_CHUNK_ROWS} FROM {table}'
+            ))
+        self._rehash(conn, keys)
+        self.stats['full'] += 1
+
+    def compute(self, conn):
+        """Huella actual (hex); usa la caché si no hubo cambios desde la última"""
+        with self._lock:
+            conn.execute('BEGIN')
+            try:
+                seq = current_seq(conn)
+                # Los deltas aplicados de otros equipos no pasan por el registro de cambios,
+                # y un snapshot descargado cambia la identidad del equipo
+                marker = (get_state(conn, STATE_DEVICE_ID, ''), get_state(conn, STATE_APPLIED, '{}'))
+                if self._digest is not None and seq == self._seq and marker == self._marker:
+                    self.stats['cached'] += 1
+                    return self._digest
+
+                pushed = get_state(conn, STATE_LAST_PUSHED)
+                # El registro se poda al subir: si se perdieron cambios intermedios, cálculo completo
+                if self._seq is None or marker != self._marker or seq < self._seq or self._seq < pushed:
+                    self._full(conn)
+                else:
+                    dirty = {(table, row_id // DIGEST_CHUNK_ROWS) for table, row_id in conn.execute(
+                        'SELECT table_name, row_id FROM sync_changes WHERE seq > ?', (self._seq,)
+                    )}
+                    self._rehash(conn, sorted(dirty))
+                    self.stats['incremental'] += 1
+
+                combined = hashlib.sha256()
+                for (table, chunk), value in sorted(self._chunks.items()):
+                    combined.update(f'{table}:{chunk}:{value}\n'.encode('utf-8'))
+                self._seq, self._marker, self._digest = seq, marker, combined.hexdigest()
+                return self._digest
+            finally:
+                conn.commit()
+
+    def get_stats(self):
+        with self._lock:
+            stats = dict(self.stats)
+            stats['chunks'] = len(self._chunks)
+            stats['seq'] = self._seq
+        return stats
+
+
+# Instancia global: la caché de bloques vive mientras viva el proceso
+content_digest = ContentDigest()
+
+_file_cache = {}
+_file_cache_lock = threading.Lock()
+
+
+def file_digest(path):
+    """MD5 y SHA-256 de un archivo en una sola lectura por bloques
+
+    Se cachea por (tamaño, mtime, inodo): si el archivo no cambió no se vuelve a leer.
+    """
+    stat = os.stat(path)
+    key = (stat.st_size, stat.st_mtime_ns, stat.st_ino)
+    with _file_cache_lock:
+        cached = _file_cache.get(os.path.abspath(path))
+        if cached and cached[0] == key:
+            return cached[1]
+
+    md5 = hashlib.md5()
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while True:
+            block = f.read(FILE_CHUNK_SIZE)
+            if not block:
+                break
+            md5.update(block)
+            sha256.update(block)
+
+    result = {'md5': md5.hexdigest(), 'sha256': sha256.hexdigest(), 'size': stat.st_size}
+    with _file_cache_lock:
+        _file_cache[os.path.abspath(path)] = (key, result)
+    return result
+
+
+def get_content_digest():
+    """Huella de contenido de la base compartida por el pool"""
+    with db_connection() as conn:
+        return content_digest.compute(conn)
+
+
+if __name__ == "__main__":
+    # Uso: python db_digest.py [archivo]
+    import time
+
+    with db_connection() as conn:
+        install_changelog(conn)
+        started = time.perf_counter()
+        first = content_digest.compute(conn)
+        elapsed_full = (time.perf_counter() - started) * 1000
+        started = time.perf_counter()
+        second = content_digest.compute(conn)
+        elapsed_cached = (time.perf_counter() - started) * 1000
+
+    print(f"🔑 Huella de contenido: {first} ({elapsed_full:.1f} ms; en caché {elapsed_cached:.2f} ms)")
+    print(f"📊 {content_digest.get_stats()}")
+    if len(sys.argv) > 1:
+        print(f"📄 {sys.argv[1]}: {file_digest(sys.argv[1])}")
@@ -0,0 +1,271 @@
+"""
+Pool de conexiones SQLite compartido para el Sistema de Tickets
+Una conexión por hilo, reutilizada entre peticiones y configurada una sola vez
+"""
+
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+# Configuración
+DATABASE = 'tickets.db'
+POOL_MAX_SIZE = 8          # Máximo de conexiones abiertas simultáneamente
+POOL_TIMEOUT = 10.0        # Segundos de espera cuando el pool está agotado
+BUSY_TIMEOUT_MS = 5000     # Espera de SQLite ante bloqueos de escritura
+CACHE_SIZE_KB = 8192       # Caché de páginas por conexión (8 MB)
+MMAP_SIZE = 64 * 1024 * 1024
+
+PRAGMAS = [
+    'PRAGMA journal_mode=WAL',
+    'PRAGMA synchronous=NORMAL',
+    f'PRAGMA busy_timeout={BUSY_TIMEOUT_MS}',
+    f'PRAGMA cache_size=-{CACHE_SIZE_KB}',
+    f'PRAGMA mmap_size={MMAP_SIZE}',
+    'PRAGMA temp_store=MEMORY',
+]
+
+
+class PoolTimeoutError(sqlite3.OperationalError):
+    """No se obtuvo una conexión del pool dentro del tiempo de espera"""
+
+
+class ConnectionPool:
+    def __init__(self, database=DATABASE, max_size=POOL_MAX_SIZE, timeout=POOL_TIMEOUT):
+        self.database = database
+        self.max_size = max_size
+        self.timeout = timeout
+
+        self._idle = []
+        self._open_count = 0
+        self._generation = 0
+        self._exclusive_owner = None   # Hilo que está reemplazando el archivo de la base de datos
+        self._cond = threading.Condition(threading.Lock())
+        self._local = threading.local()
+
+        self.metrics = {
+            'hits': 0,
+            'misses': 0,
+            'waits': 0,
+            'timeouts': 0,
+            'wait_time_ms': 0.0,
+        }
+
+    def _create_connection(self):
+        """Abre una conexión nueva y aplica los PRAGMA una sola vez"""
+        conn = sqlite3.connect(self.database, check_same_thread=False)
+        for pragma in PRAGMAS:
+            conn.execute(pragma)
+        return conn
+
+    def _wait_exclusive(self):
+        """Espera (con el lock tomado) a que termine un reemplazo del archivo en curso"""
+        me = threading.get_ident()
+        if self._exclusive_owner is None or self._exclusive_owner == me:
+            return
+        self.metrics['waits'] += 1
+        deadline = time.perf_counter() + self.timeout
+        while self._exclusive_owner is not None and self._exclusive_owner != me:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                self.metrics['timeouts'] += 1
+                raise PoolTimeoutError('Base de datos en mantenimiento')
+            self._cond.wait(remaining)
+
+    def _acquire(self):
+        """Obtiene una conexión del pool (reutilizada o nueva)"""
+        with self._cond:
+            self._wait_exclusive()
+            if self._idle:
+                self.metrics['hits'] += 1
+                return self._idle.pop(), self._generation
+
+            if self._open_count >= self.max_size:
+                self.metrics['waits'] += 1
+                started = time.perf_counter()
+                deadline = started + self.timeout
+                while not self._idle and self._open_count >= self.max_size:
+                    remaining = deadline - time.perf_counter()
+                    if remaining <= 0:
+                        self.metrics['timeouts'] += 1
+                        raise PoolTimeoutError('Pool de conexiones agotado')
+                    self._cond.wait(remaining)
+                self.metrics['wait_time_ms'] += (time.perf_counter() - started) * 1000
+                if self._idle:
+                    self.metrics['hits'] += 1
+                    return self._idle.pop(), self._generation
+
+            self.metrics['misses'] += 1
+            self._open_count += 1
+            generation = self._generation
+
+        try:
+            return self._create_connection(), generation
+        except Exception:
+            with self._cond:
+                self._open_count -= 1
+                self._cond.notify_all()
+            raise
+
+    def _release(self, conn, generation):
+        """Devuelve una conexión al pool, descartando transacciones pendientes"""
+        try:
+            if conn.in_transaction:
+                conn.rollback()
+        except sqlite3.Error:
+            generation = None  # Conexión inservible: se cierra
+
+        with self._cond:
+            if generation == self._generation:
+                self._idle.append(conn)
+                self._cond.notify()
+                return
+
+        # Se cierra antes de descontarla: exclusive() espera a que no quede ninguna abierta
+        try:
+            conn.close()
+        except sqlite3.Error:
+            pass
+        with self._cond:
+            self._open_count -= 1
+            self._cond.notify_all()
+
+    def get_connection(self):
+        """Conexión del hilo actual; llamadas anidadas comparten la misma"""
+        state = getattr(self._local, 'state', None)
+        if state is None:
+            conn, generation = self._acquire()
+            state = self._local.state = [conn, generation, 0]
+        state[2] += 1
+        return state[0]
+
+    def release_connection(self):
+        """Libera una referencia; al llegar a cero la conexión vuelve al pool"""
+        state = getattr(self._local, 'state', None)
+        if state is None:
+            return
+        state[2] -= 1
+        if state[2] <= 0:
+            self._local.state = None
+            self._release(state[0], state[1])
+
+    @contextmanager
+    def connection(self):
+        """Context manager para usar una conexión fuera del ciclo de Flask"""
+        conn = self.get_connection()
+        try:
+            yield conn
+        finally:
+            self.release_connection()
+
+    def close_all(self):
+        """Cierra las conexiones libres e invalida las que están en uso"""
+        with self._cond:
+            self._generation += 1
+            idle, self._idle = self._idle, []
+            self._open_count -= len(idle)
+            self._cond.notify_all()
+
+        for conn in idle:
+            try:
+                conn.close()
+            except sqlite3.Error:
+                pass
+
+    @contextmanager
+    def exclusive(self, timeout=None):
+        """Acceso exclusivo al archivo de la base de datos (p. ej. para reemplazarlo)
+
+        Deja de entregar conexiones, espera a que se devuelvan las que están en
+        uso y las cierra todas. Al salir, el pool vuelve a abrir conexiones
+        nuevas sobre el archivo que haya en disco.
+        """
+        if getattr(self._local, 'state', None) is not None:
+            raise RuntimeError('El hilo actual tiene una conexión abierta del pool')
+        timeout = self.timeout if timeout is None else timeout
+        deadline = time.perf_counter() + timeout
+        me = threading.get_ident()
+
+        with self._cond:
+            while self._exclusive_owner is not None:
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    raise PoolTimeoutError('Otro hilo tiene acceso exclusivo a la base de datos')
+                self._cond.wait(remaining)
+            self._exclusive_owner = me
+            self._generation += 1
+            idle, self._idle = self._idle, []
+            self._open_count -= len(idle)
+
+        for conn in idle:
+            try:
+                conn.close()
+            except sqlite3.Error:
+                pass
+
+        try:
+            with self._cond:
+                # Las conexiones en uso se cierran al devolverse (generación anterior)
+                while self._open_count > 0:
+                    remaining = deadline - time.perf_counter()
+                    if remaining <= 0:
+                        raise PoolTimeoutError('Hay conexiones en uso que no se devolvieron a tiempo')
+                    self._cond.wait(remaining)
+            yield
+        finally:
+            with self._cond:
+                self._exclusive_owner = None
+                self._generation += 1
+                self._cond.notify_all()
+
+    def get_metrics(self):
+        """Métricas de uso del pool"""
+        with self._cond:
+            metrics = dict(self.metrics)
+            metrics['wait_time_ms'] = round(metrics['wait_time_ms'], 2)
+            metrics.update({
+                'max_size': self.max_size,
+                'open': self._open_count,
+                'idle': len(self._idle),
+                'in_use': self._open_count - len(self._idle),
+            })
+        requests_total = metrics['hits'] + metrics['misses']
+        metrics['hit_ratio'] = round(metrics['hits'] / requests_total, 3) if requests_total else 0.0
+        return metrics
+
+
+# Instancia global del pool
+pool = ConnectionPool()
+
+
+def get_db():
+    """Conexión ligada al contexto de la petición Flask actual"""
+    from flask import g
+    if 'db_conn' not in g:
+        g.db_conn = pool.get_connection()
+    return g.db_conn
+
+
+def close_db(exception=None):
+    """Devuelve al pool la conexión de la petición Flask actual"""
+    from flask import g
+    conn = g.pop('db_conn', None)
+    if conn is not None:
+        pool.release_connection()
+
+
+def init_app(app):
+    """Registra la liberación automática de conexiones al terminar cada petición"""
+    app.teardown_appcontext(close_db)
+
+
+@contextmanager
+def db_connection():
+    """Context manager de conveniencia para hilos en background y módulos auxiliares"""
+    with pool.connection() as conn:
+        yield conn
+
+
+def get_pool_metrics():
+    """Métricas del pool global"""
+    return pool.get_metrics()
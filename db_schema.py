@@ -0,0 +1,218 @@
+"""
+Migraciones versionadas del esquema del Sistema de Tickets
+Índices secundarios, columnas de orden almacenadas y verificación de planes de consulta
+"""
+
+import sys
+
+from db_pool import db_connection
+
+# Orden de la cola de desarrolladores (valores almacenados en tickets.status_rank / priority_rank)
+STATUS_RANKS = {'Abierto': 1, 'En Progreso': 2, 'Resuelto': 3}
+STATUS_RANK_DEFAULT = 4
+PRIORITY_RANKS = {'Critical': 1, 'High': 2, 'Medium': 3, 'Low': 4}
+PRIORITY_RANK_DEFAULT = 5
+
+
+def rank_case(column, ranks, default):
+    """Expresión CASE que traduce un valor de texto a su posición en la cola"""
+    whens = ''.join(f"\n            WHEN '{value}' THEN {rank}" for value, rank in ranks.items())
+    return f"CASE {column}{whens}\n            ELSE {default}\n        END"
+
+
+def _sync_ranks(row):
+    """UPDATE que recalcula los rangos almacenados de un ticket"""
+    return f"""
+        UPDATE tickets
+        SET status_rank = {rank_case(f'{row}.status', STATUS_RANKS, STATUS_RANK_DEFAULT)},
+            priority_rank = {rank_case(f'{row}.priority', PRIORITY_RANKS, PRIORITY_RANK_DEFAULT)}
+        WHERE id = {row}.id;"""
+
+
+def _add_column(cursor, table, column, definition):
+    """ALTER TABLE idempotente (las bases restauradas de Drive pueden traer la columna)"""
+    cursor.execute(f'PRAGMA table_info({table})')
+    if column not in [row[1] for row in cursor.fetchall()]:
+        cursor.execute(f'ALTER TABLE {table} ADD COLUMN {column} {definition}')
+
+
+def _migration_1(cursor):
+    """Rangos de orden almacenados e índices de las consultas frecuentes"""
+    _add_column(cursor, 'tickets', 'status_rank', f'INTEGER NOT NULL DEFAULT {STATUS_RANK_DEFAULT}')
+    _add_column(cursor, 'tickets', 'priority_rank', f'INTEGER NOT NULL DEFAULT {PRIORITY_RANK_DEFAULT}')
+
+    # Los triggers mantienen los rangos sincronizados con status / priority
+    cursor.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS tickets_rank_insert AFTER INSERT ON tickets
+        BEGIN{_sync_ranks('NEW')}
+        END
+    ''')
+    cursor.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS tickets_rank_update AFTER UPDATE OF status, priority ON tickets
+        BEGIN{_sync_ranks('NEW')}
+        END
+    ''')
+    cursor.execute(f'''
+        UPDATE tickets
+        SET status_rank = {rank_case('status', STATUS_RANKS, STATUS_RANK_DEFAULT)},
+            priority_rank = {rank_case('priority', PRIORITY_RANKS, PRIORITY_RANK_DEFAULT)}
+    ''')
+
+    # Cola de desarrolladores: recorre el índice en orden, sin ordenar en memoria
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_tickets_queue
+        ON tickets (status_rank, priority_rank, created_at DESC, id DESC)
+    ''')
+    # Tickets de un usuario, más recientes primero
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_tickets_user_created
+        ON tickets (user_id, created_at DESC, id DESC)
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_tickets_assigned ON tickets (assigned_to)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_tickets_status ON tickets (status)')
+    # Comentarios de un ticket en orden cronológico
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_comments_ticket_created
+        ON comments (ticket_id, created_at)
+    ''')
+
+
+# Lista ordenada de migraciones: (versión, descripción, función)
+MIGRATIONS = [
+    (1, 'Rangos de orden almacenados e índices de tickets/comentarios', _migration_1),
+]
+
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+
+def get_schema_version(conn):
+    """Versión del esquema guardada en PRAGMA user_version"""
+    return conn.execute('PRAGMA user_version').fetchone()[0]
+
+
+def migrate(conn):
+    """Aplica en orden las migraciones pendientes, cada una en su propia transacción"""
+    current = get_schema_version(conn)
+    applied = []
+
+    for version, description, migration in MIGRATIONS:
+        if version <= current:
+            continue
+        cursor = conn.cursor()
+        # sqlite3 no abre transacción antes del DDL: sin BEGIN, cada ALTER/CREATE se confirmaría solo
+        cursor.execute('BEGIN')
+        try:
+            migration(cursor)
+            cursor.execute(f'PRAGMA user_version = {int(version)}')
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        cursor.execute('ANALYZE')
+        applied.append(version)
+        print(f"🔧 Migración de esquema {version} aplicada: {description}")
+
+    return applied
+
+
+# Consultas frecuentes y el índice que debe resolverlas
+HOT_QUERIES = [
+    ('cola de desarrolladores', 'idx_tickets_queue', '''
+        SELECT t.id, t.title, u.username, d.username
+        FROM tickets t
+        LEFT JOIN users u ON t.user_id = u.id
+        LEFT JOIN users d ON t.assigned_to = d.id
+        ORDER BY t.status_rank, t.priority_rank, t.created_at DESC, t.id DESC
+        LIMIT 26
+    ''', ()),
+    ('tickets de un usuario', 'idx_tickets_user_created', '''
+        SELECT t.id, t.title, u.username, d.username
+        FROM tickets t
+        LEFT JOIN users u ON t.user_id = u.id
+        LEFT JOIN users d ON t.assigned_to = d.id
+        WHERE t.user_id = ?
+        ORDER BY t.created_at DESC, t.id DESC
+        LIMIT 26
+    ''', (1,)),
+    ('comentarios de un ticket', 'idx_comments_ticket_created', '''
+        SELECT c.*, u.username
+        FROM comments c
+        JOIN users u ON c.user_id = u.id
+        WHERE c.ticket_id = ?
+        ORDER BY c.created_at ASC
+    ''', (1,)),
+    ('tickets asignados', 'idx_tickets_assigned', '''
+        SELECT COUNT(*) FROM tickets WHERE assigned_to = ?
+    ''', (1,)),
+    ('tickets por estado', 'idx_tickets_status', '''
+        SELECT COUNT(*) FROM tickets WHERE status = ?
+    ''', ('Abierto',)),
+]
+
+
+def explain_hot_queries(conn):
+    """Ejecuta EXPLAIN QUERY PLAN sobre las consultas frecuentes
+
+    Una consulta pasa si usa su índice, no recorre tickets/comentarios completos
+    y no necesita un B-tree temporal para ordenar.
+    """
+    results = []
+    for name, index, sql, params in HOT_QUERIES:
+        plan = [row[3] for row in conn.execute('EXPLAIN QUERY PLAN ' + sql, params).fetchall()]
+        problems = []
+        if not any(index in detail for detail in plan):
+            problems.append(f'no usa {index}')
+        if any('TEMP B-TREE' in detail for detail in plan):
+            problems.append('ordena en memoria')
+        if any(detail.startswith('SCAN') and 'INDEX' not in detail for detail in plan):
+            problems.append('recorre la tabla completa')
+        results.append({
+            'query': name,
+            'index': index,
+            'plan': plan,
+            'covering': any('COVERING INDEX' in detail for detail in plan),
+            'ok': not problems,
+            'problems': problems,
+        })
+    return results
+
+
+def get_schema_status():
+    """Versión del esquema y resultado de la verificación de planes"""
+    with db_connection() as conn:
+        plans = explain_hot_queries(conn)
+        version = get_schema_version(conn)
+    return {
+        'version': version,
+        'expected_version': SCHEMA_VERSION,
+        'queries_ok': all(result['ok'] for result in plans),
+        'plans': plans,
+    }
+
+
+if __name__ == "__main__":
+    # Uso: python db_schema.py [check|migrate]
+    command = sys.argv[1] if len(sys.argv) > 1 else 'check'
+
+    with db_connection() as conn:
+        if command == 'migrate':
+            applied = migrate(conn)
+            if not applied:
+                print("ℹ️ El esquema ya está actualizado")
+
+        version = get_schema_version(conn)
+        print(f"📋 Versión del esquema: {version} (esperada {SCHEMA_VERSION})")
+
+        failed = False
+        for result in explain_hot_queries(conn):
+            icon = "✅" if result['ok'] else "❌"
+            print(f"{icon} {result['query']}:")
+            for detail in result['plan']:
+                print(f"   - {detail}")
+            for problem in result['problems']:
+                print(f"   ⚠️ {problem}")
+            failed = failed or not result['ok']
+
+    if failed or version < SCHEMA_VERSION:
+        print("💡 Ejecuta: python db_schema.py migrate")
+        sys.exit(1)
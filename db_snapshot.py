@@ -0,0 +1,201 @@
+"""
+Snapshots consistentes de la base de datos del Sistema de Tickets
+Copia en caliente con la API de backup de SQLite (por pasos de páginas), opcionalmente
+comprimida, usada por los backups locales y por la subida a Google Drive
+"""
+
+import glob
+import gzip
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+
+from db_pool import BUSY_TIMEOUT_MS, DATABASE, pool
+
+# Configuración
+SNAPSHOT_PAGES_PER_STEP = 256     # Páginas copiadas por paso (1 MB con páginas de 4 KB)
+SNAPSHOT_STEP_SLEEP = 0.005       # Pausa entre pasos para dejar pasar a los escritores
+SNAPSHOT_MAX_RESTARTS = 3         # Reinicios tolerados antes de copiar en un solo paso
+COPY_CHUNK_SIZE = 1024 * 1024
+BACKUP_PREFIX = 'tickets_backup_'
+BACKUP_PATTERNS = [f'{BACKUP_PREFIX}*.db', f'{BACKUP_PREFIX}*.db.gz']
+BACKUP_COMPRESS = True            # Los backups locales se guardan con gzip
+
+
+class SnapshotRestarted(Exception):
+    """La copia por pasos se reinició demasiadas veces por escrituras concurrentes"""
+
+
+def _connect(path):
+    conn = sqlite3.connect(path)
+    conn.execute(f'PRAGMA busy_timeout={BUSY_TIMEOUT_MS}')
+    return conn
+
+
+def _copy_pages(source, target, stats):
+    """Copia por pasos; si las escrituras reinician la copia una y otra vez, copia en un paso
+
+    SQLite reinicia la copia cuando otra conexión modifica el origen entre
+    pasos. Con WAL, un único paso es una lectura consistente que no bloquea a
+    los escritores, así que es la alternativa segura.
+    """
+    last_remaining = None
+
+    def progress(status, remaining, total):
+        nonlocal last_remaining
+        stats['steps'] += 1
+        stats['pages'] = total
+        if last_remaining is not None and remaining > last_remaining:
+            stats['restarts'] += 1
+            if stats['restarts'] > SNAPSHOT_MAX_RESTARTS:
+                raise SnapshotRestarted()
+        last_remaining = remaining
+
+    try:
+        source.backup(target, pages=SNAPSHOT_PAGES_PER_STEP, progress=progress, sleep=SNAPSHOT_STEP_SLEEP)
+    except SnapshotRestarted:
+        stats['single_step'] = True
+        source.backup(target)
+
+
+def _gzip_file(source_path, target_path):
+    with open(source_path, 'rb') as src, gzip.open(target_path, 'wb', compresslevel=6) as dst:
+        shutil.copyfileobj(src, dst, COPY_CHUNK_SIZE)
+
+
+def create_snapshot(target_path, source_path=DATABASE, compress=False):
+    """Crea un snapshot consistente de source_path en target_path
+
+    El archivo se escribe primero como temporal y se renombra al final, así
+    nunca queda una copia a medias con el nombre definitivo. Devuelve un dict
+    con la ruta, el tamaño y las estadísticas de la copia.
+    """
+    started = time.perf_counter()
+    stats = {'steps': 0, 'pages': 0, 'restarts': 0, 'single_step': False}
+    directory = os.path.dirname(os.path.abspath(target_path))
+    fd, tmp_path = tempfile.mkstemp(prefix='.snapshot_', suffix='.db', dir=directory)
+    os.close(fd)
+    try:
+        source = _connect(source_path)
+        target = sqlite3.connect(tmp_path)
+        try:
+            _copy_pages(source, target, stats)
+            # Archivo autónomo: sin WAL pendiente
+            target.execute('PRAGMA journal_mode=DELETE')
+        finally:
+            target.close()
+            source.close()
+
+        if compress:
+            gz_path = tmp_path + '.gz'
+            try:
+                _gzip_file(tmp_path, gz_path)
+                os.replace(gz_path, target_path)
+            finally:
+                if os.path.exists(gz_path):
+                    os.remove(gz_path)
+        else:
+            os.replace(tmp_path, target_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+    stats.update({
+        'path': target_path,
+        'size': os.path.getsize(target_path),
+        'compressed': compress,
+        'elapsed_ms': round((time.perf_counter() - started) * 1000, 1),
+    })
+    return stats
+
+
+def replace_database_file(new_path, db_path=DATABASE):
+    """Mueve new_path sobre db_path de forma atómica, sin conexiones abiertas
+
+    Si es la base del pool, se espera a que se devuelvan las conexiones en uso
+    y no se entregan nuevas hasta terminar. El WAL y el índice compartido del
+    archivo anterior se eliminan: aplicados al archivo nuevo lo dañarían.
+    """
+    def swap():
+        for suffix in ('-wal', '-shm'):
+            if os.path.exists(db_path + suffix):
+                os.remove(db_path + suffix)
+        os.replace(new_path, db_path)
+
+    if os.path.abspath(db_path) == os.path.abspath(pool.database):
+        with pool.exclusive():
+            swap()
+    else:
+        swap()
+
+
+def _replace_file(source_path, db_path):
+    """Reemplazo del archivo completo cuando el destino no es una base de datos válida"""
+    fd, tmp_path = tempfile.mkstemp(prefix='.restore_', suffix='.db', dir=os.path.dirname(os.path.abspath(db_path)))
+    os.close(fd)
+    try:
+        shutil.copyfile(source_path, tmp_path)
+        replace_database_file(tmp_path, db_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def restore_snapshot(snapshot_path, db_path=DATABASE):
+    """Restaura un snapshot (comprimido o no) sobre la base de datos con la API de backup
+
+    La base de destino se sobrescribe dentro de su propio bloqueo, así las
+    conexiones del pool ven los datos restaurados sin reabrir el archivo. Si el
+    destino quedó dañado (descarga interrumpida), se reemplaza el archivo.
+    """
+    tmp_path = None
+    source_path = snapshot_path
+    if snapshot_path.endswith('.gz'):
+        fd, tmp_path = tempfile.mkstemp(prefix='.restore_', suffix='.db',
+                                        dir=os.path.dirname(os.path.abspath(db_path)))
+        with os.fdopen(fd, 'wb') as dst, gzip.open(snapshot_path, 'rb') as src:
+            shutil.copyfileobj(src, dst, COPY_CHUNK_SIZE)
+        source_path = tmp_path
+    try:
+        source = sqlite3.connect(source_path)
+        try:
+            target = _connect(db_path)
+            try:
+                source.backup(target)
+            finally:
+                target.close()
+        except sqlite3.DatabaseError as e:
+            print(f"⚠️ Base de datos dañada ({e}), reemplazando el archivo completo")
+            _replace_file(source_path, db_path)
+        finally:
+            source.close()
+    finally:
+        if tmp_path and os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def list_backups():
+    """Backups locales (comprimidos o no), del más reciente al más antiguo"""
+    backups = []
+    for pattern in BACKUP_PATTERNS:
+        backups.extend(glob.glob(pattern))
+    backups.sort(key=os.path.getmtime, reverse=True)
+    return backups
+
+
+def backup_path_for(moment=None, compress=BACKUP_COMPRESS):
+    """Nombre del backup local para un instante dado"""
+    moment = moment or time.localtime()
+    suffix = '.db.gz' if compress else '.db'
+    return f"{BACKUP_PREFIX}{time.strftime('%Y%m%d_%H%M%S', moment)}{suffix}"
+
+
+if __name__ == "__main__":
+    # Uso: python db_snapshot.py [destino]
+    target = sys.argv[1] if len(sys.argv) > 1 else backup_path_for()
+    info = create_snapshot(target, compress=target.endswith('.gz'))
+    print(f"📸 Snapshot creado: {info['path']} ({info['size']} bytes, {info['pages']} páginas, "
+          f"{info['steps']} pasos, {info['elapsed_ms']} ms)")
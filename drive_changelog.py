@@ -0,0 +1,537 @@
+"""
+Registro de cambios para la sincronización incremental con Google Drive
+Triggers anotan cada fila modificada con un número de secuencia; la sincronización
+sube solo los deltas desde la última vez y compacta periódicamente en un snapshot
+"""
+
+import gzip
+import json
+import sqlite3
+import sys
+import time
+import uuid
+
+from db_pool import db_connection
+
+# Tablas replicadas, en orden de aplicación (padres antes que hijos)
+SYNC_TABLES = ('users', 'tickets', 'comments', 'attachments', 'ticket_attachments')
+
+# Clave estable de cada fila entre equipos: los id AUTOINCREMENT de dos equipos pueden coincidir
+SYNC_UID_COLUMN = 'sync_uid'
+SYNC_KEYS = {'attachments': 'hash'}             # Tablas con clave natural propia (por defecto sync_uid)
+# Claves foráneas que se traducen al id local del padre (por su sync_uid)
+SYNC_REFERENCES = {
+    'tickets': {'user_id': 'users', 'assigned_to': 'users'},
+    'comments': {'ticket_id': 'tickets', 'user_id': 'users'},
+    'ticket_attachments': {'ticket_id': 'tickets'},
+}
+# Columnas únicas: una fila remota con el mismo valor es la misma fila local (usuarios por defecto de cada equipo,
+# enlaces de adjuntos que migrate_legacy creó sin contenido)
+SYNC_NATURAL_KEYS = {
+    'users': ('username',),
+    'ticket_attachments': ('ticket_id', 'stored_name'),
+}
+# Estado propio de cada equipo: no se replica (las referencias las cuentan los triggers al aplicar)
+SYNC_LOCAL_COLUMNS = {
+    'attachments': ('refcount', 'local', 'unreferenced_at'),
+}
+# Valores de las columnas locales en filas llegadas de otro equipo (el contenido no está en este disco)
+SYNC_INSERT_DEFAULTS = {
+    'attachments': {'local': 0},
+}
+# Columnas que un valor remoto NULL no borra (copia en Drive, contenido de un enlace)
+SYNC_COALESCE_COLUMNS = {
+    'attachments': ('drive_id',),
+    'ticket_attachments': ('hash',),
+}
+# Cambios que se registran en UPDATE (por defecto, cualquier columna)
+SYNC_UPDATE_COLUMNS = {
+    'attachments': ('size', 'mime', 'drive_id'),
+}
+# Borrados remotos que solo se aplican si la fila local cumple la condición
+SYNC_DELETE_GUARDS = {
+    'attachments': 'refcount <= 0',
+}
+
+# Compactación: se sube un snapshot completo en lugar de otro delta cuando...
+SNAPSHOT_EVERY_DELTAS = 50      # ...ya hay esta cantidad de deltas desde el último snapshot
+SNAPSHOT_DELTA_RATIO = 0.5      # ...o los deltas acumulados pesan más que esta fracción de la base
+
+DELTA_PREFIX = 'delta_'
+DELTA_SUFFIX = '.json.gz'
+
+# Claves de estado en sync_config
+STATE_DEVICE_ID = 'sync_device_id'
+STATE_LAST_PUSHED = 'sync_last_pushed_seq'
+STATE_APPLIED = 'sync_applied'             # JSON {origen: última secuencia aplicada}
+STATE_SNAPSHOT_SEQ = 'sync_snapshot_seq'
+STATE_DELTAS_SINCE_SNAPSHOT = 'sync_deltas_since_snapshot'
+STATE_DELTA_BYTES = 'sync_delta_bytes_since_snapshot'
+# Fila presente solo dentro de la transacción que aplica un delta: los triggers no registran esos cambios
+STATE_APPLYING = 'sync_applying_delta'
+
+
+class SyncConflictError(Exception):
+    """Un delta remoto choca con filas locales distintas (mismo id u otra clave única)"""
+
+
+def sync_key(table):
+    return SYNC_KEYS.get(table, SYNC_UID_COLUMN)
+
+
+def legacy_uid(table, row_id):
+    """Clave de las filas anteriores a sync_uid: todas venían de la misma base compartida"""
+    return f'legacy:{table}:{row_id}'
+
+
+def _changelog_trigger(table, event, row):
+    op = 'delete' if event == 'DELETE' else 'upsert'
+    columns = SYNC_UPDATE_COLUMNS.get(table) if event == 'UPDATE' else None
+    event_sql = f'{event} OF {", ".join(columns)}' if columns else event
+    # Los borrados guardan la clave estable: la fila ya no existe cuando se arma el delta
+    return f'''
+        CREATE TRIGGER changelog_{table}_{event.lower()} AFTER {event_sql} ON {table}
+        WHEN NOT EXISTS (SELECT 1 FROM sync_config WHERE key = '{STATE_APPLYING}')
+        BEGIN
+            INSERT INTO sync_changes (table_name, row_id, row_uid, op, changed_at)
+            VALUES ('{table}', {row}.rowid, {row}.{sync_key(table)}, '{op}', strftime('%s', 'now'));
+        END
+    '''
+
+
+def _uid_trigger(table):
+    """Asigna un sync_uid aleatorio a las filas creadas en este equipo"""
+    return f'''
+        CREATE TRIGGER IF NOT EXISTS sync_uid_{table} AFTER INSERT ON {table}
+        WHEN NEW.{SYNC_UID_COLUMN} IS NULL
+        BEGIN
+            UPDATE {table} SET {SYNC_UID_COLUMN} = lower(hex(randomblob(16))) WHERE rowid = NEW.rowid;
+        END
+    '''
+
+
+def _table_exists(conn, table):
+    return conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (table,)).fetchone() is not None
+
+
+def install_changelog(conn):
+    """Crea sync_changes, sync_config, las claves sync_uid y los triggers de las tablas replicadas
+
+    Las tablas que aún no existen se omiten (se instalan al volver a llamar).
+    """
+    cursor = conn.cursor()
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS sync_config (
+            key TEXT PRIMARY KEY,
+            value TEXT,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    # AUTOINCREMENT: los números de secuencia nunca se reutilizan tras podar la tabla
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS sync_changes (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            table_name TEXT NOT NULL,
+            row_id INTEGER NOT NULL,
+            row_uid TEXT,
+            op TEXT NOT NULL,
+            changed_at INTEGER NOT NULL
+        )
+    ''')
+    if 'row_uid' not in _table_columns(conn, 'sync_changes'):
+        cursor.execute('ALTER TABLE sync_changes ADD COLUMN row_uid TEXT')
+    # Las claves asignadas aquí no son cambios que haya que subir
+    set_state(conn, STATE_APPLYING, 1)
+    for table in SYNC_TABLES:
+        if not _table_exists(conn, table):
+            continue
+        if sync_key(table) == SYNC_UID_COLUMN:
+            if SYNC_UID_COLUMN not in _table_columns(conn, table):
+                cursor.execute(f'ALTER TABLE {table} ADD COLUMN {SYNC_UID_COLUMN} TEXT')
+            # Filas existentes: clave derivada del id (la base era una sola copia compartida)
+            cursor.execute(f'''
+                UPDATE {table} SET {SYNC_UID_COLUMN} = 'legacy:{table}:' || rowid WHERE {SYNC_UID_COLUMN} IS NULL
+            ''')
+            cursor.execute(f'CREATE UNIQUE INDEX IF NOT EXISTS idx_{table}_sync_uid ON {table} ({SYNC_UID_COLUMN})')
+            cursor.execute(_uid_trigger(table))
+        # Se recrean siempre: versiones anteriores no guardaban row_uid
+        for event, row in (('INSERT', 'NEW'), ('UPDATE', 'NEW'), ('DELETE', 'OLD')):
+            cursor.execute(f'DROP TRIGGER IF EXISTS changelog_{table}_{event.lower()}')
+            cursor.execute(_changelog_trigger(table, event, row))
+    cursor.execute('DELETE FROM sync_config WHERE key = ?', (STATE_APPLYING,))
+    # Filas remotas enlazadas a una local existente por clave natural
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS sync_aliases (
+            table_name TEXT NOT NULL,
+            uid TEXT NOT NULL,
+            local_id INTEGER NOT NULL,
+            PRIMARY KEY (table_name, uid)
+        )
+    ''')
+    cursor.execute(
+        'INSERT OR IGNORE INTO sync_config (key, value) VALUES (?, ?)', (STATE_DEVICE_ID, uuid.uuid4().hex)
+    )
+    conn.commit()
+
+
+def get_state(conn, key, default=0):
+    row = conn.execute('SELECT value FROM sync_config WHERE key = ?', (key,)).fetchone()
+    if row is None or row[0] is None:
+        return default
+    return int(row[0]) if isinstance(default, int) else row[0]
+
+
+def set_state(conn, key, value):
+    """Guarda un valor de estado (dentro de la transacción actual)"""
+    conn.execute('''
+        INSERT OR REPLACE INTO sync_config (key, value, updated_at)
+        VALUES (?, ?, CURRENT_TIMESTAMP)
+    ''', (key, str(value)))
+
+
+def get_applied(conn):
+    """Última secuencia aplicada de cada equipo de origen"""
+    try:
+        return json.loads(get_state(conn, STATE_APPLIED, '{}'))
+    except ValueError:
+        return {}
+
+
+def set_applied(conn, applied):
+    set_state(conn, STATE_APPLIED, json.dumps(applied, sort_keys=True))
+
+
+def reset_origin(conn, snapshot_origin, snapshot_seq):
+    """Nueva identidad tras reemplazar la base con el snapshot de otro equipo
+
+    Cada equipo numera sus cambios desde 1. La copia descargada trae el
+    registro y el contador del equipo que subió el snapshot; se vacían y se
+    anota que ya se aplicó ese snapshot.
+    """
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        conn.execute('DELETE FROM sync_changes')
+        conn.execute("DELETE FROM sqlite_sequence WHERE name = 'sync_changes'")
+        applied = get_applied(conn)
+        applied[snapshot_origin] = snapshot_seq
+        set_applied(conn, applied)
+        set_state(conn, STATE_DEVICE_ID, uuid.uuid4().hex)
+        for key in (STATE_LAST_PUSHED, STATE_SNAPSHOT_SEQ, STATE_DELTAS_SINCE_SNAPSHOT, STATE_DELTA_BYTES):
+            set_state(conn, key, 0)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+
+
+def current_seq(conn):
+    """Último número de secuencia asignado"""
+    row = conn.execute("SELECT seq FROM sqlite_sequence WHERE name = 'sync_changes'").fetchone()
+    return row[0] if row else 0
+
+
+def _table_columns(conn, table):
+    return [row[1] for row in conn.execute(f'PRAGMA table_info({table})').fetchall()]
+
+
+def _sync_columns(conn, table):
+    """Columnas que viajan en los deltas"""
+    local = SYNC_LOCAL_COLUMNS.get(table, ())
+    return [column for column in _table_columns(conn, table) if column not in local]
+
+
+def build_delta(conn, since_seq):
+    """Arma el delta de los cambios posteriores a since_seq
+
+    Varios cambios de una misma fila se reducen al estado final: se lee la
+    fila actual (o se marca como borrada). Cada cambio lleva la clave estable
+    de la fila ('uid') y, en 'refs', la de los padres a los que apunta, para
+    que el equipo que lo aplica traduzca los id. Devuelve None si no hay cambios.
+    """
+    conn.execute('BEGIN')
+    try:
+        to_seq = current_seq(conn)
+        if to_seq <= since_seq:
+            return None
+
+        latest = {}
+        for table, row_id, row_uid, op in conn.execute('''
+            SELECT table_name, row_id, row_uid, op FROM sync_changes
+            WHERE seq > ? AND seq <= ?
+            ORDER BY seq
+        ''', (since_seq, to_seq)):
+            latest[(table, row_id)] = (op, row_uid)
+
+        changes = []
+        for table in SYNC_TABLES:
+            ids = [row_id for (name, row_id), (op, _) in latest.items() if name == table and op == 'upsert']
+            columns = _sync_columns(conn, table)
+            key = sync_key(table)
+            rows = {}
+            # Lecturas por lotes para no superar el límite de parámetros de SQLite
+            for start in range(0, len(ids), 500):
+                chunk = ids[start:start + 500]
+                for row in conn.execute(
+                    f'SELECT rowid, {", ".join(columns)} FROM {table} '
+                    f'WHERE rowid IN ({", ".join("?" * len(chunk))})', chunk
+                ):
+                    rows[row[0]] = dict(zip(columns, row[1:]))
+            for (name, row_id), (op, row_uid) in latest.items():
+                if name != table:
+                    continue
+                if op == 'upsert' and row_id in rows:
+                    row = rows[row_id]
+                    changes.append({'table': table, 'id': row_id, 'uid': row[key], 'op': 'upsert',
+                                    'row': row, 'refs': _parent_uids(conn, table, row)})
+                else:
+                    # Insertada y borrada dentro del mismo delta, o borrada
+                    changes.append({'table': table, 'id': row_id, 'uid': row_uid, 'op': 'delete'})
+
+        return {
+            'from_seq': since_seq,
+            'to_seq': to_seq,
+            'origin': get_state(conn, STATE_DEVICE_ID, ''),
+            'created_at': time.time(),
+            'changes': changes,
+        }
+    finally:
+        conn.commit()
+
+
+def _parent_uids(conn, table, row):
+    """Claves estables de los padres a los que apunta una fila"""
+    refs = {}
+    for column, parent in SYNC_REFERENCES.get(table, {}).items():
+        if row.get(column) is None:
+            continue
+        found = conn.execute(f'SELECT {SYNC_UID_COLUMN} FROM {parent} WHERE id = ?', (row[column],)).fetchone()
+        refs[column] = found[0] if found else None
+    return refs
+
+
+def encode_delta(delta):
+    """Serializa y comprime un delta (JSON + gzip)"""
+    return gzip.compress(json.dumps(delta, default=str, separators=(',', ':')).encode('utf-8'))
+
+
+def decode_delta(data):
+    return json.loads(gzip.decompress(data).decode('utf-8'))
+
+
+def delta_name(delta):
+    """Nombre del archivo en Drive: equipo de origen y rango de secuencias"""
+    return f"{DELTA_PREFIX}{delta['origin'][:12]}_{delta['from_seq']:012d}_{delta['to_seq']:012d}{DELTA_SUFFIX}"
+
+
+def plan_deltas(deltas, applied, own_origin):
+    """Ordena por equipo los deltas pendientes de aplicar
+
+    deltas: lista de dicts con origin, from_seq, to_seq (de appProperties).
+    Devuelve (deltas a aplicar en orden, orígenes con huecos). Un hueco
+    significa que esos cambios ya se compactaron en un snapshot.
+    """
+    by_origin = {}
+    for delta in deltas:
+        if delta['origin'] != own_origin:
+            by_origin.setdefault(delta['origin'], []).append(delta)
+
+    plan = []
+    gaps = []
+    for origin, items in by_origin.items():
+        position = applied.get(origin, 0)
+        for delta in sorted(items, key=lambda item: item['to_seq']):
+            if delta['to_seq'] <= position:
+                continue
+            if delta['from_seq'] > position:
+                gaps.append(origin)
+            plan.append(delta)
+            position = delta['to_seq']
+    plan.sort(key=lambda item: item.get('created_at', 0))
+    return plan, gaps
+
+
+def _resolve(conn, table, uid):
+    """Id local de la fila con esa clave estable (o None)"""
+    row = conn.execute(f'SELECT rowid FROM {table} WHERE {sync_key(table)} = ?', (uid,)).fetchone()
+    if row is None:
+        row = conn.execute('SELECT local_id FROM sync_aliases WHERE table_name = ? AND uid = ?',
+                           (table, uid)).fetchone()
+    return row[0] if row else None
+
+
+def _local_row(conn, table, change, local_columns):
+    """Fila remota con los id de sus padres traducidos a los locales"""
+    row = {column: value for column, value in change['row'].items() if column in local_columns}
+    refs = change.get('refs')
+    for column, parent in SYNC_REFERENCES.get(table, {}).items():
+        if row.get(column) is None:
+            continue
+        # Deltas sin 'refs' (versión anterior): el id remoto se interpreta como fila compartida
+        parent_uid = refs.get(column) if refs is not None else legacy_uid(parent, row[column])
+        local_id = _resolve(conn, parent, parent_uid) if parent_uid else None
+        if local_id is None:
+            if refs is None:
+                continue
+            raise SyncConflictError(
+                f'{table} {change["uid"]}: {column} apunta a {parent} {parent_uid} que no existe en este equipo'
+            )
+        row[column] = local_id
+    return row
+
+
+def _apply_upsert(conn, table, change, local_columns):
+    """Inserta o actualiza una fila remota sin pisar filas locales distintas
+
+    La fila se busca por su clave estable y luego por sus claves naturales
+    (se registra un alias). Si no existe y su id ya está ocupado localmente
+    por otra fila, se inserta con un id nuevo en lugar de sobrescribirla.
+    """
+    key = sync_key(table)
+    uid = change.get('uid') or change['row'].get(key) or legacy_uid(table, change['id'])
+    row = _local_row(conn, table, change, local_columns)
+    row[key] = uid
+    local_id = _resolve(conn, table, uid)
+
+    natural = SYNC_NATURAL_KEYS.get(table)
+    if local_id is None and natural and all(row.get(column) is not None for column in natural):
+        found = conn.execute(
+            f'SELECT rowid FROM {table} WHERE {" AND ".join(f"{column} = ?" for column in natural)}',
+            [row[column] for column in natural]
+        ).fetchone()
+        if found:
+            local_id = found[0]
+            conn.execute('INSERT OR REPLACE INTO sync_aliases (table_name, uid, local_id) VALUES (?, ?, ?)',
+                         (table, uid, local_id))
+            print(f"🔗 {table}: {uid} enlazado con la fila local {local_id} ({', '.join(natural)})")
+
+    values = {column: value for column, value in row.items() if column not in ('id', key)}
+    coalesce = SYNC_COALESCE_COLUMNS.get(table, ())
+    try:
+        if local_id is not None:
+            if values:
+                assignments = ', '.join(f'{column} = COALESCE(?, {column})' if column in coalesce else f'{column} = ?'
+                                        for column in values)
+                conn.execute(f'UPDATE {table} SET {assignments} WHERE rowid = ?', list(values.values()) + [local_id])
+            return local_id
+        row.update(SYNC_INSERT_DEFAULTS.get(table, {}))
+        if 'id' in row and conn.execute(f'SELECT 1 FROM {table} WHERE id = ?', (row['id'],)).fetchone():
+            # El id remoto lo usa otra fila de este equipo: la remota recibe un id nuevo
+            print(f"🔀 {table} #{row['id']} de otro equipo ya existe aquí con otra clave: se inserta con un id nuevo")
+            del row['id']
+        cursor = conn.execute(f'INSERT INTO {table} ({", ".join(row)}) VALUES ({", ".join("?" * len(row))})',
+                              list(row.values()))
+        return cursor.lastrowid
+    except sqlite3.IntegrityError as e:
+        raise SyncConflictError(f'{table} {uid}: {e}')
+
+
+def _apply_delete(conn, table, change):
+    uid = change.get('uid') or legacy_uid(table, change['id'])
+    local_id = _resolve(conn, table, uid)
+    if local_id is None:
+        return
+    guard = SYNC_DELETE_GUARDS.get(table)
+    conn.execute(f'DELETE FROM {table} WHERE rowid = ?{f" AND {guard}" if guard else ""}', (local_id,))
+    conn.execute('DELETE FROM sync_aliases WHERE table_name = ? AND local_id = ?', (table, local_id))
+
+
+def apply_delta(conn, delta):
+    """Aplica un delta descargado en una sola transacción
+
+    Upserts en orden padres → hijos y borrados en orden inverso, emparejando
+    las filas por su clave estable (nunca por el id local). Los triggers de
+    búsqueda, contadores y rangos se disparan normalmente; los del registro
+    de cambios no, para no volver a subir lo que llegó de otro equipo.
+    Lanza SyncConflictError (y no aplica nada) si el delta no encaja.
+    """
+    by_table = {}
+    for change in delta['changes']:
+        by_table.setdefault(change['table'], []).append(change)
+
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        set_state(conn, STATE_APPLYING, 1)
+        for table in SYNC_TABLES:
+            if table not in by_table:
+                continue
+            # Solo columnas que existen en el esquema local y no son propias de este equipo
+            local_columns = set(_sync_columns(conn, table))
+            for change in by_table[table]:
+                if change['op'] == 'upsert':
+                    _apply_upsert(conn, table, change, local_columns)
+
+        for table in reversed(SYNC_TABLES):
+            for change in by_table.get(table, []):
+                if change['op'] == 'delete':
+                    _apply_delete(conn, table, change)
+
+        conn.execute('DELETE FROM sync_config WHERE key = ?', (STATE_APPLYING,))
+        applied = get_applied(conn)
+        applied[delta['origin']] = max(applied.get(delta['origin'], 0), delta['to_seq'])
+        set_applied(conn, applied)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return len(delta['changes'])
+
+
+def mark_pushed(conn, to_seq, delta_bytes=None):
+    """Registra un delta (delta_bytes) o un snapshot (None) subido y poda el registro"""
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        set_state(conn, STATE_LAST_PUSHED, to_seq)
+        if delta_bytes is None:
+            set_state(conn, STATE_SNAPSHOT_SEQ, to_seq)
+            set_state(conn, STATE_DELTAS_SINCE_SNAPSHOT, 0)
+            set_state(conn, STATE_DELTA_BYTES, 0)
+        else:
+            set_state(conn, STATE_DELTAS_SINCE_SNAPSHOT, get_state(conn, STATE_DELTAS_SINCE_SNAPSHOT) + 1)
+            set_state(conn, STATE_DELTA_BYTES, get_state(conn, STATE_DELTA_BYTES) + delta_bytes)
+        # Lo subido ya no se necesita localmente
+        conn.execute('DELETE FROM sync_changes WHERE seq <= ?', (to_seq,))
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+
+
+def needs_snapshot(conn, db_size):
+    """True cuando conviene compactar los deltas en un snapshot completo"""
+    deltas = get_state(conn, STATE_DELTAS_SINCE_SNAPSHOT)
+    delta_bytes = get_state(conn, STATE_DELTA_BYTES)
+    return deltas >= SNAPSHOT_EVERY_DELTAS or delta_bytes > db_size * SNAPSHOT_DELTA_RATIO
+
+
+def get_changelog_status():
+    """Estado del registro de cambios (panel / diagnóstico)"""
+    with db_connection() as conn:
+        seq = current_seq(conn)
+        pushed = get_state(conn, STATE_LAST_PUSHED)
+        return {
+            'current_seq': seq,
+            'last_pushed_seq': pushed,
+            'pending_changes': conn.execute('SELECT COUNT(*) FROM sync_changes WHERE seq > ?', (pushed,)).fetchone()[0],
+            'device_id': get_state(conn, STATE_DEVICE_ID, ''),
+            'applied': get_applied(conn),
+            'snapshot_seq': get_state(conn, STATE_SNAPSHOT_SEQ),
+            'deltas_since_snapshot': get_state(conn, STATE_DELTAS_SINCE_SNAPSHOT),
+            'delta_bytes_since_snapshot': get_state(conn, STATE_DELTA_BYTES),
+        }
+
+
+if __name__ == "__main__":
+    # Uso: python drive_changelog.py [status|delta]
+    command = sys.argv[1] if len(sys.argv) > 1 else 'status'
+
+    with db_connection() as conn:
+        install_changelog(conn)
+        if command == 'delta':
+            delta = build_delta(conn, get_state(conn, STATE_LAST_PUSHED))
+            if delta is None:
+                print("ℹ️ No hay cambios pendientes")
+            else:
+                data = encode_delta(delta)
+                print(f"📦 {delta_name(delta)}: {len(delta['changes'])} filas, {len(data)} bytes comprimidos")
+
+    print(f"📊 Estado: {get_changelog_status()}")
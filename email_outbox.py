@@ -0,0 +1,567 @@
+"""
+Bandeja de salida de correos del Sistema de Tickets
+Los correos se guardan en email_outbox y un worker los envía por lotes reutilizando
+una única sesión SMTP autenticada; los avisos para un mismo destinatario se combinan
+"""
+
+import random
+import smtplib
+import socketserver
+import ssl
+import sys
+import threading
+import time
+from email.mime.text import MIMEText
+from email.utils import formatdate, make_msgid
+
+from db_pool import db_connection
+
+# Configuración
+EMAIL_BATCH_SIZE = 50               # Destinatarios por lote (una sola sesión SMTP por lote)
+EMAIL_POLL_INTERVAL = 5.0           # Segundos entre revisiones de la tabla
+EMAIL_COALESCE_WINDOW = 60          # Segundos que espera un aviso por otros para el mismo destinatario
+EMAIL_MAX_ATTEMPTS = 6
+EMAIL_BACKOFF_BASE = 30.0           # Segundos; se duplica en cada intento
+EMAIL_BACKOFF_MAX = 3600.0
+EMAIL_STALE_SECONDS = 300           # Correos 'sending' huérfanos (proceso caído) vuelven a 'pending'
+EMAIL_RETENTION_DAYS = 7
+EMAIL_PURGE_INTERVAL = 3600         # Segundos entre podas de correos enviados
+EMAIL_DIGEST_SEPARATOR = '\n' + '─' * 40 + '\n'
+SMTP_TIMEOUT = 20
+SMTP_IDLE_SECONDS = 60              # Sesión sin uso que se cierra
+SMTP_MAX_MESSAGES_PER_SESSION = 100  # Muchos servidores cortan la sesión tras N mensajes
+
+
+class EmailDeliveryError(Exception):
+    """Fallo al enviar; retryable=False para rechazos permanentes (5xx)"""
+
+    def __init__(self, message, retryable=True):
+        super().__init__(message)
+        self.retryable = retryable
+
+
+def install_email_outbox(conn):
+    """Crea la tabla de la bandeja de salida de correos"""
+    cursor = conn.cursor()
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS email_outbox (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            recipient TEXT NOT NULL,
+            ticket_id INTEGER,
+            action TEXT,
+            subject TEXT NOT NULL,
+            body TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'pending',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            next_attempt_at REAL NOT NULL,
+            claimed_at REAL,
+            last_error TEXT,
+            created_at REAL NOT NULL,
+            sent_at REAL
+        )
+    ''')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_email_outbox_due
+        ON email_outbox (status, next_attempt_at)
+    ''')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_email_outbox_recipient
+        ON email_outbox (recipient, status)
+    ''')
+    conn.commit()
+
+
+class SMTPSession:
+    """Sesión SMTP autenticada que se reutiliza entre mensajes y lotes
+
+    Conecta, hace STARTTLS y login una sola vez; reconecta si el servidor
+    corta la sesión, tras SMTP_MAX_MESSAGES_PER_SESSION mensajes o tras
+    SMTP_IDLE_SECONDS sin uso.
+    """
+
+    def __init__(self, config, smtp_class=smtplib.SMTP):
+        self.config = config
+        self.smtp_class = smtp_class
+        self._server = None
+        self._sent_in_session = 0
+        self.last_used = 0.0
+
+        self.metrics = {
+            'connections': 0,
+            'reconnects': 0,
+            'messages': 0,
+        }
+
+    def _connect(self):
+        server = self.smtp_class(self.config['smtp_server'], self.config['smtp_port'], timeout=SMTP_TIMEOUT)
+        try:
+            if self.config.get('use_tls', True):
+                server.starttls(context=ssl.create_default_context())
+            if self.config.get('password'):
+                server.login(self.config['email'], self.config['password'])
+        except Exception:
+            server.close()
+            raise
+        self._server = server
+        self._sent_in_session = 0
+        self.metrics['connections'] += 1
+
+    @property
+    def is_open(self):
+        return self._server is not None
+
+    def is_idle(self, now=None):
+        return self.is_open and (now or time.monotonic()) - self.last_used > SMTP_IDLE_SECONDS
+
+    def send(self, sender, recipients, message):
+        """Envía un mensaje ya serializado; lanza EmailDeliveryError"""
+        if self._server is not None and self._sent_in_session >= SMTP_MAX_MESSAGES_PER_SESSION:
+            self.close()
+
+        for attempt in range(2):
+            try:
+                if self._server is None:
+                    self._connect()
+                refused = self._server.sendmail(sender, recipients, message)
+                break
+            except smtplib.SMTPServerDisconnected as e:
+                # El servidor cerró una sesión inactiva: se reconecta una vez
+                self._server = None
+                if attempt:
+                    raise EmailDeliveryError(f"Servidor SMTP desconectado: {e}")
+                self.metrics['reconnects'] += 1
+            except smtplib.SMTPRecipientsRefused as e:
+                raise EmailDeliveryError(f"Destinatario rechazado: {e.recipients}", retryable=False)
+            except smtplib.SMTPAuthenticationError as e:
+                self.close()
+                raise EmailDeliveryError(f"Autenticación SMTP fallida: {e.smtp_code}")
+            except smtplib.SMTPResponseException as e:
+                # 4xx es transitorio; 5xx no mejora reintentando
+                raise EmailDeliveryError(f"SMTP {e.smtp_code}: {e.smtp_error!r}", retryable=e.smtp_code < 500)
+            except (smtplib.SMTPException, OSError) as e:
+                self.close()
+                raise EmailDeliveryError(f"Error de conexión SMTP: {e}")
+
+        self._sent_in_session += 1
+        self.metrics['messages'] += 1
+        self.last_used = time.monotonic()
+        if refused:
+            raise EmailDeliveryError(f"Destinatario rechazado: {refused}", retryable=False)
+
+    def close(self):
+        server, self._server = self._server, None
+        if server is None:
+            return
+        try:
+            server.quit()
+        except Exception:
+            try:
+                server.close()
+            except Exception:
+                pass
+
+
+class EmailOutbox:
+    def __init__(self, config, smtp_class=smtplib.SMTP):
+        self.config = config
+        self.session = SMTPSession(config, smtp_class)
+        self.coalesce_window = config.get('coalesce_window', EMAIL_COALESCE_WINDOW)
+        self._cond = threading.Condition()
+        self._session_lock = threading.Lock()
+        self._thread = None
+        self._installed = False
+        self._next_purge = 0.0
+
+        self.metrics = {
+            'enqueued': 0,
+            'emails_sent': 0,
+            'notifications_sent': 0,
+            'coalesced': 0,
+            'failed': 0,
+            'retries': 0,
+            'batches': 0,
+            'last_batch_rate': 0.0,
+        }
+
+    def install(self):
+        if not self._installed:
+            with db_connection() as conn:
+                install_email_outbox(conn)
+            self._installed = True
+
+    def start(self):
+        """Inicia el worker (uno solo: una sesión SMTP compartida por todos los lotes)"""
+        with self._cond:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._worker, name='email-outbox', daemon=True)
+        try:
+            self.install()
+        except Exception as e:
+            print(f"❌ Error creando bandeja de salida de correos: {e}")
+        self._thread.start()
+
+    def enqueue(self, recipients, subject, body, ticket_id=None, action=None):
+        """Guarda un aviso por destinatario; se envían tras la ventana de agrupación"""
+        self.install()
+        now = time.time()
+        unique = []
+        for recipient in recipients:
+            recipient = (recipient or '').strip().lower()
+            if recipient and recipient not in unique:
+                unique.append(recipient)
+        if not unique:
+            return 0
+
+        with db_connection() as conn:
+            conn.executemany('''
+                INSERT INTO email_outbox (recipient, ticket_id, action, subject, body, status,
+                                          next_attempt_at, created_at)
+                VALUES (?, ?, ?, ?, ?, 'pending', ?, ?)
+            ''', [(recipient, ticket_id, action, subject, body, now + self.coalesce_window, now)
+                  for recipient in unique])
+            conn.commit()
+        with self._cond:
+            self.metrics['enqueued'] += len(unique)
+            self._cond.notify()
+        return len(unique)
+
+    def _claim_batch(self, due_before=None):
+        """Toma los destinatarios con avisos vencidos y todos sus avisos pendientes
+
+        Devuelve {destinatario: [(id, ticket_id, subject, body, attempts), ...]}.
+        Los avisos del mismo destinatario que aún no vencieron viajan en el mismo
+        correo; los que esperan un reintento no se adelantan.
+        """
+        now = time.time()
+        due_before = now if due_before is None else due_before
+        batch = {}
+        with db_connection() as conn:
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                conn.execute('''
+                    UPDATE email_outbox SET status = 'pending'
+                    WHERE status = 'sending' AND claimed_at < ?
+                ''', (now - EMAIL_STALE_SECONDS,))
+                recipients = [row[0] for row in conn.execute('''
+                    SELECT recipient FROM email_outbox
+                    WHERE status = 'pending' AND next_attempt_at <= ?
+                    GROUP BY recipient
+                    ORDER BY MIN(next_attempt_at)
+                    LIMIT ?
+                ''', (due_before, EMAIL_BATCH_SIZE)).fetchall()]
+
+                if recipients:
+                    placeholders = ', '.join('?' * len(recipients))
+                    rows = conn.execute(f'''
+                        SELECT id, recipient, ticket_id, subject, body, attempts FROM email_outbox
+                        WHERE status = 'pending' AND recipient IN ({placeholders})
+                          AND (attempts = 0 OR next_attempt_at <= ?)
+                        ORDER BY id
+                    ''', recipients + [due_before]).fetchall()
+                    conn.executemany('''
+                        UPDATE email_outbox
+                        SET status = 'sending', attempts = attempts + 1, claimed_at = ?
+                        WHERE id = ?
+                    ''', [(now, row[0]) for row in rows])
+                    for outbox_id, recipient, ticket_id, subject, body, attempts in rows:
+                        batch.setdefault(recipient, []).append((outbox_id, ticket_id, subject, body, attempts + 1))
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+        return batch
+
+    def _finish(self, ids, status, error=None, next_attempt_at=None):
+        now = time.time()
+        with db_connection() as conn:
+            if status == 'sent':
+                conn.executemany('''
+                    UPDATE email_outbox SET status = 'sent', sent_at = ?, last_error = NULL
+                    WHERE id = ?
+                ''', [(now, outbox_id) for outbox_id in ids])
+            else:
+                conn.executemany('''
+                    UPDATE email_outbox SET status = ?, last_error = ?, next_attempt_at = COALESCE(?, next_attempt_at)
+                    WHERE id = ?
+                ''', [(status, error, next_attempt_at, outbox_id) for outbox_id in ids])
+            conn.commit()
+
+    @staticmethod
+    def backoff(attempts):
+        """Espera exponencial con jitter antes del siguiente intento"""
+        delay = min(EMAIL_BACKOFF_BASE * (2 ** (attempts - 1)), EMAIL_BACKOFF_MAX)
+        return delay * random.uniform(0.8, 1.2)
+
+    def compose(self, recipient, notifications):
+        """Un correo por destinatario; varios avisos se combinan en un resumen"""
+        if len(notifications) == 1:
+            _, _, subject, body, _ = notifications[0]
+        else:
+            tickets = sorted({ticket_id for _, ticket_id, _, _, _ in notifications if ticket_id})
+            subject = f"[{len(notifications)} NOTIFICACIONES] Tickets " + ', '.join(f'#{t}' for t in tickets)
+            body = EMAIL_DIGEST_SEPARATOR.join(
+                f"{subject_line}\n{body_text.strip()}" for _, _, subject_line, body_text, _ in notifications
+            )
+
+        msg = MIMEText(body, 'plain', 'utf-8')
+        msg['From'] = self.config['email']
+        msg['To'] = recipient
+        msg['Subject'] = subject
+        msg['Date'] = formatdate(localtime=True)
+        msg['Message-ID'] = make_msgid()
+        return msg.as_string()
+
+    def process_batch(self, due_before=None):
+        """Envía un lote con la sesión compartida; devuelve los correos enviados"""
+        with self._session_lock:
+            batch = self._claim_batch(due_before)
+            if not batch:
+                return 0
+
+            started = time.perf_counter()
+            sent = 0
+            sent_ids = []
+            pending = list(batch.items())
+            while pending:
+                recipient, notifications = pending.pop(0)
+                ids = [notification[0] for notification in notifications]
+                attempts = max(notification[4] for notification in notifications)
+                try:
+                    message = self.compose(recipient, notifications)
+                    self.session.send(self.config['email'], [recipient], message)
+                except EmailDeliveryError as e:
+                    self._fail(ids, attempts, e)
+                    if not self.session.is_open and pending:
+                        # Sin conexión: el resto del lote espera sin gastar un intento
+                        remaining = [n[0] for _, group in pending for n in group]
+                        self._defer(remaining, str(e), time.time() + self.backoff(attempts))
+                        break
+                    continue
+                except Exception as e:
+                    print(f"❌ Error componiendo correo para {recipient}: {e}")
+                    self._fail(ids, attempts, EmailDeliveryError(str(e), retryable=False))
+                    continue
+
+                sent_ids.extend(ids)
+                sent += 1
+                with self._cond:
+                    self.metrics['emails_sent'] += 1
+                    self.metrics['notifications_sent'] += len(ids)
+                    self.metrics['coalesced'] += len(ids) - 1
+
+            # Una sola escritura para todo el lote enviado
+            if sent_ids:
+                self._finish(sent_ids, 'sent')
+            elapsed = time.perf_counter() - started
+            with self._cond:
+                self.metrics['batches'] += 1
+                self.metrics['last_batch_rate'] = round(sent / elapsed, 1) if elapsed > 0 else 0.0
+            print(f"📧 Lote de correos: {sent} enviados en {elapsed:.2f}s")
+            return sent
+
+    def _fail(self, ids, attempts, error):
+        if error.retryable and attempts < EMAIL_MAX_ATTEMPTS:
+            delay = self.backoff(attempts)
+            self._finish(ids, 'pending', str(error), time.time() + delay)
+            with self._cond:
+                self.metrics['retries'] += len(ids)
+            print(f"⚠️ Correo: reintento de {len(ids)} aviso(s) en {delay:.0f}s ({error})")
+        else:
+            self._finish(ids, 'failed', str(error))
+            with self._cond:
+                self.metrics['failed'] += len(ids)
+            print(f"❌ Correo descartado tras {attempts} intentos: {error}")
+
+    def _defer(self, ids, error, next_attempt_at):
+        with db_connection() as conn:
+            conn.executemany('''
+                UPDATE email_outbox
+                SET status = 'pending', attempts = attempts - 1, last_error = ?, next_attempt_at = ?
+                WHERE id = ?
+            ''', [(error, next_attempt_at, outbox_id) for outbox_id in ids])
+            conn.commit()
+
+    def drain(self):
+        """Envía todo lo pendiente sin esperar la ventana (cierre ordenado y benchmark)"""
+        total = 0
+        while True:
+            sent = self.process_batch(due_before=float('inf'))
+            if not sent:
+                return total
+            total += sent
+
+    def _worker(self):
+        while True:
+            sent = 0
+            try:
+                sent = self.process_batch()
+            except Exception as e:
+                print(f"❌ Error leyendo bandeja de salida de correos: {e}")
+
+            if sent:
+                continue
+            with self._session_lock:
+                if self.session.is_idle():
+                    self.session.close()
+            self._purge_if_due()
+            with self._cond:
+                self._cond.wait(EMAIL_POLL_INTERVAL)
+
+    def _purge_if_due(self):
+        """Poda los enviados como mucho una vez por EMAIL_PURGE_INTERVAL"""
+        now = time.time()
+        if now < self._next_purge:
+            return
+        self._next_purge = now + EMAIL_PURGE_INTERVAL
+        try:
+            removed = self.purge()
+            if removed:
+                print(f"🗑️ {removed} correos enviados eliminados de la bandeja de salida")
+        except Exception as e:
+            print(f"❌ Error podando bandeja de salida de correos: {e}")
+
+    def purge(self, days=EMAIL_RETENTION_DAYS):
+        """Elimina los correos enviados más antiguos que `days` días"""
+        with db_connection() as conn:
+            cursor = conn.execute('''
+                DELETE FROM email_outbox WHERE status = 'sent' AND sent_at < ?
+            ''', (time.time() - days * 86400,))
+            conn.commit()
+            return cursor.rowcount
+
+    def get_metrics(self):
+        """Profundidad de la cola, correos combinados y sesiones SMTP abiertas"""
+        with self._cond:
+            metrics = dict(self.metrics)
+        metrics.update(self.session.metrics)
+        metrics['coalesce_window'] = self.coalesce_window
+        try:
+            with db_connection() as conn:
+                counts = dict(conn.execute('''
+                    SELECT status, COUNT(*) FROM email_outbox GROUP BY status
+                ''').fetchall())
+            metrics['queue_depth'] = counts.get('pending', 0) + counts.get('sending', 0)
+            metrics['failed_total'] = counts.get('failed', 0)
+        except Exception as e:
+            print(f"⚠️ No se pudieron leer métricas de la bandeja de correos: {e}")
+        return metrics
+
+
+class LocalSMTPServer(socketserver.ThreadingTCPServer):
+    """Servidor SMTP mínimo en memoria para medir el envío sin un servidor real
+
+    Acepta EHLO, AUTH, MAIL, RCPT, DATA, RSET, NOOP y QUIT; no hace TLS
+    (usar 'use_tls': False). Cuenta conexiones y mensajes recibidos.
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address=('127.0.0.1', 0), latency=0.0):
+        super().__init__(address, _LocalSMTPHandler)
+        self.latency = latency
+        self.connections = 0
+        self.messages = 0
+        self._lock = threading.Lock()
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, name='local-smtp', daemon=True).start()
+        return self
+
+
+class _LocalSMTPHandler(socketserver.StreamRequestHandler):
+    def reply(self, line):
+        if self.server.latency:
+            # Simula el ida y vuelta de red de cada comando
+            time.sleep(self.server.latency)
+        self.wfile.write(line.encode() + b'\r\n')
+
+    def handle(self):
+        with self.server._lock:
+            self.server.connections += 1
+        self.reply('220 localhost ESMTP')
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command = line.decode(errors='replace').strip().upper()
+            if command.startswith('EHLO'):
+                self.wfile.write(b'250-localhost\r\n250-AUTH PLAIN LOGIN\r\n')
+                self.reply('250 8BITMIME')
+            elif command.startswith('HELO'):
+                self.reply('250 localhost')
+            elif command.startswith('AUTH'):
+                self.reply('235 2.7.0 Authentication successful')
+            elif command == 'DATA':
+                self.reply('354 End data with <CR><LF>.<CR><LF>')
+                while self.rfile.readline() not in (b'.\r\n', b''):
+                    pass
+                with self.server._lock:
+                    self.server.messages += 1
+                self.reply('250 OK')
+            elif command == 'QUIT':
+                self.reply('221 Bye')
+                return
+            else:
+                # MAIL, RCPT, RSET, NOOP
+                self.reply('250 OK')
+
+
+if __name__ == "__main__":
+    # Benchmark: python email_outbox.py [cantidad] [latencia_ms]
+    # Compara una sesión SMTP por correo (envío anterior) con la sesión compartida
+    import os
+    import tempfile
+
+    import db_pool
+
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    latency = float(sys.argv[2]) / 1000 if len(sys.argv) > 2 else 0.002
+
+    print("🧪 BENCHMARK DE ENVÍO DE CORREOS")
+    server = LocalSMTPServer(latency=latency).start()
+    config = {
+        'smtp_server': '127.0.0.1',
+        'smtp_port': server.port,
+        'email': 'tickets@localhost',
+        'password': 'x',
+        'use_tls': False,
+        'coalesce_window': 0,
+    }
+
+    # Una conexión, login y quit por correo, como hacía send_email_notification
+    started = time.perf_counter()
+    for index in range(count):
+        smtp = smtplib.SMTP(config['smtp_server'], config['smtp_port'], timeout=SMTP_TIMEOUT)
+        smtp.login(config['email'], config['password'])
+        smtp.sendmail(config['email'], [f'user{index}@localhost'], f'Subject: prueba {index}\r\n\r\nhola')
+        smtp.quit()
+    direct = time.perf_counter() - started
+    print(f"📨 Sesión por correo: {count / direct:.0f} correos/s ({server.connections} conexiones)")
+
+    # Base temporal para no tocar tickets.db
+    database = os.path.join(tempfile.mkdtemp(), 'email_benchmark.db')
+    db_pool.pool = db_pool.ConnectionPool(database)
+    outbox = EmailOutbox(config)
+    for index in range(count):
+        outbox.enqueue([f'user{index}@localhost'], f'prueba {index}', 'hola', ticket_id=index)
+    connections_before = server.connections
+    started = time.perf_counter()
+    sent = outbox.drain()
+    pooled = time.perf_counter() - started
+    outbox.session.close()
+    print(f"📨 Sesión compartida: {sent / pooled:.0f} correos/s "
+          f"({server.connections - connections_before} conexiones)")
+
+    # Agrupación: 5 avisos para el mismo destinatario viajan en un correo
+    for ticket_id in range(5):
+        outbox.enqueue(['admin@localhost'], f'ticket {ticket_id}', 'actualizado', ticket_id=ticket_id)
+    outbox.drain()
+    outbox.session.close()
+    print(f"📊 Métricas: {outbox.get_metrics()}")
+    print(f"⚡ Mejora: x{direct / pooled:.1f}")
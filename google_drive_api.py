@@ -6,24 +6,57 @@ OPTIMIZADO: Gestión inteligente de backups y verificación de cambios
 
 import os
 import json
-import sqlite3
+import hashlib
 import pickle
-import glob
 from datetime import datetime
 from googleapiclient.discovery import build
 from google_auth_oauthlib.flow import InstalledAppFlow
 from google.auth.transport.requests import Request
-from googleapiclient.http import MediaFileUpload, MediaIoBaseDownload
+from googleapiclient.http import MediaFileUpload, MediaIoBaseDownload, MediaIoBaseUpload
 from googleapiclient.errors import HttpError
+import google_auth_httplib2
+import httplib2
 import io
+import tempfile
+import threading
+import time
 import webbrowser
+from db_pool import db_connection
+from drive_changelog import (
+    DELTA_PREFIX, STATE_DEVICE_ID, STATE_LAST_PUSHED, STATE_SNAPSHOT_SEQ, SyncConflictError,
+    apply_delta, build_delta, current_seq, decode_delta, delta_name, encode_delta,
+    get_applied, get_changelog_status, get_state, install_changelog, mark_pushed,
+    needs_snapshot, plan_deltas, reset_origin
+)
+from db_digest import content_digest, file_digest
+from attachment_uploader import AttachmentUploader
+from backup_store import backup_store
+from db_snapshot import create_snapshot, list_backups, replace_database_file
+from sync_scheduler import SyncScheduler
 
 # Configuración
 SCOPES = ['https://www.googleapis.com/auth/drive.file']
 CREDENTIALS_FILE = 'credentials.json'
 TOKEN_FILE = 'token.pickle'
 FOLDER_NAME = 'Sistema-Tickets-Data'
-MAX_BACKUPS = 3  # Máximo número de backups a mantener
+MAX_BACKUPS = 3  # Copias completas antiguas (tickets_backup_*.db) a mantener
+DRIVE_BATCH_SIZE = 100  # Máximo de operaciones por petición batch de la API
+DOWNLOAD_CHUNK_SIZE = 4 * 1024 * 1024  # Bytes por petición de descarga (memoria usada)
+DOWNLOAD_RETRIES = 3
+ATTACHMENT_CHUNK_SIZE = 5 * 1024 * 1024  # Bloque de subida reanudable (múltiplo de 256 KB)
+
+class HashingWriter:
+    """Archivo de destino para MediaIoBaseDownload que calcula el MD5 al escribir"""
+    
+    def __init__(self, f):
+        self.f = f
+        self.md5 = hashlib.md5()
+        self.size = 0
+    
+    def write(self, data):
+        self.md5.update(data)
+        self.size += len(data)
+        return self.f.write(data)
 
 class GoogleDriveManager:
     def __init__(self):
@@ -31,6 +64,16 @@ class GoogleDriveManager:
         self.authenticated = False
         self.folder_id = None
         self.auth_error = None
+        self.credentials = None
+        self._changelog_ready = False
+        # Una sola sincronización (subida o bajada) a la vez
+        self._sync_lock = threading.Lock()
+        self.sync_scheduler = SyncScheduler(self.sync_tickets_to_drive, name='drive-sync')
+        # Carpeta de adjuntos: se busca una vez y se reutiliza
+        self._attachments_folder_id = None
+        self._attachments_folder_lock = threading.Lock()
+        self._thread_local = threading.local()
+        self.attachment_uploader = AttachmentUploader(self)
         self.init_drive_connection()
     
     def init_drive_connection(self):
@@ -112,6 +155,7 @@ class GoogleDriveManager:
                     print("💾 Token guardado para futuras ejecuciones")
             
             # Construir servicio
+            self.credentials = creds
             self.service = build('drive', 'v3', credentials=creds)
             self.authenticated = True
             
@@ -120,6 +164,9 @@ class GoogleDriveManager:
             if not success:
                 return False
             
+            # Retoma las subidas de adjuntos que quedaron pendientes
+            self.attachment_uploader.start()
+            
             print("✅ Google Drive conectado exitosamente")
             return True
             
@@ -192,66 +239,84 @@ class GoogleDriveManager:
             return False, f"Error: {e}"
     
     def get_local_db_hash(self, db_path='tickets.db'):
-        """Obtiene un hash simple del contenido de la base de datos local"""
+        """Huella SHA-256 del contenido de la base de datos local
+
+        Se calcula sobre las filas replicadas (no sobre el archivo) y solo se
+        recalculan los bloques modificados desde la última vez.
+        """
         try:
             if not os.path.exists(db_path):
                 return None
             
-            # Usar el tamaño y fecha de modificación como "hash" simple
-            stat = os.stat(db_path)
-            return f"{stat.st_size}_{int(stat.st_mtime)}"
+            self.ensure_changelog()
+            with db_connection() as conn:
+                return content_digest.compute(conn)
         except Exception as e:
             print(f"❌ Error obteniendo hash local: {e}")
             return None
     
+    @staticmethod
+    def latest_drive_hash(snapshot, deltas):
+        """Huella del estado más reciente publicado en Drive (snapshot o último delta)"""
+        if snapshot is None:
+            return None
+        
+        props = snapshot.get('appProperties') or {}
+        latest = {
+            'content_sha256': props.get('content_sha256'),
+            'md5': snapshot.get('md5Checksum'),
+            'created_at': float(props.get('created_at', 0)),
+            'source': snapshot.get('name', 'tickets.db'),
+        }
+        for delta in deltas:
+            if delta.get('content_sha256') and delta['created_at'] > latest['created_at']:
+                latest = {
+                    'content_sha256': delta['content_sha256'],
+                    'md5': None,
+                    'created_at': delta['created_at'],
+                    'source': delta['name'],
+                }
+        return latest
+    
     def get_drive_db_hash(self):
-        """Obtiene el hash del archivo en Google Drive"""
+        """Obtiene la huella de los datos en Google Drive con una sola consulta de metadatos"""
         try:
             if not self.authenticated:
                 return None
-                
-            # Buscar archivo en Drive
-            results = self.service.files().list(
-                q=f"name='tickets.db' and parents='{self.folder_id}' and trashed=false",
-                fields="files(id, size, modifiedTime)"
-            ).execute()
-            
-            files = results.get('files', [])
-            if not files:
-                return None
-            
-            file_info = files[0]
-            # Usar tamaño y fecha de modificación como "hash"
-            size = file_info.get('size', '0')
-            modified_time = file_info.get('modifiedTime', '')
             
-            # Convertir timestamp de Drive a epoch
-            try:
-                from datetime import datetime
-                import dateutil.parser
-                dt = dateutil.parser.parse(modified_time)
-                epoch_time = int(dt.timestamp())
-                return f"{size}_{epoch_time}"
-            except:
-                return f"{size}_{modified_time}"
+            snapshot, deltas = self.list_sync_files()
+            return self.latest_drive_hash(snapshot, deltas)
                 
         except Exception as e:
             print(f"❌ Error obteniendo hash de Drive: {e}")
             return None
     
+    def local_matches_drive(self, drive_hash, db_path='tickets.db'):
+        """Compara la base local con la huella de Drive
+
+        Usa content_sha256 de appProperties; los archivos subidos por versiones
+        anteriores solo tienen el md5Checksum de Drive, que se compara con el
+        MD5 del archivo local.
+        """
+        if drive_hash.get('content_sha256'):
+            return self.get_local_db_hash(db_path) == drive_hash['content_sha256']
+        if drive_hash.get('md5'):
+            with db_connection() as conn:
+                conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+            return file_digest(db_path)['md5'] == drive_hash['md5']
+        return False
+    
     def cleanup_old_backups(self):
-        """Limpia backups antiguos, manteniendo solo los más recientes"""
+        """Aplica la retención del almacén de backups y limpia las copias completas antiguas"""
         try:
-            # Buscar todos los archivos de backup
-            backup_pattern = "tickets_backup_*.db"
-            backup_files = glob.glob(backup_pattern)
+            backup_store.apply_retention()
+            
+            # Copias completas de versiones anteriores (tickets_backup_*.db)
+            backup_files = list_backups()
             
             if len(backup_files) <= MAX_BACKUPS:
                 return  # No hay nada que limpiar
             
-            # Ordenar por fecha de modificación (más reciente primero)
-            backup_files.sort(key=lambda x: os.path.getmtime(x), reverse=True)
-            
             # Eliminar los backups más antiguos
             files_to_delete = backup_files[MAX_BACKUPS:]
             
@@ -265,16 +330,18 @@ class GoogleDriveManager:
         except Exception as e:
             print(f"❌ Error limpiando backups: {e}")
     
-    def should_create_backup(self, db_path='tickets.db'):
-        """Determina si se debe crear un backup basado en cambios reales"""
+    def should_create_backup(self, db_path='tickets.db', drive_hash=None):
+        """Determina si se debe crear un backup basado en cambios reales
+
+        drive_hash permite reutilizar metadatos ya consultados (ver latest_drive_hash).
+        """
         try:
             # Si no existe DB local, no hay nada que respaldar
             if not os.path.exists(db_path):
                 return False
             
-            # Obtener hashes para comparar
-            local_hash = self.get_local_db_hash(db_path)
-            drive_hash = self.get_drive_db_hash()
+            if drive_hash is None:
+                drive_hash = self.get_drive_db_hash()
             
             # Si no podemos obtener el hash de Drive, es mejor hacer backup por seguridad
             if drive_hash is None:
@@ -282,8 +349,8 @@ class GoogleDriveManager:
                 return True
             
             # Si los hashes son diferentes, hay cambios reales
-            if local_hash != drive_hash:
-                print(f"📊 Cambios detectados - Local: {local_hash}, Drive: {drive_hash}")
+            if not self.local_matches_drive(drive_hash, db_path):
+                print(f"📊 Cambios detectados respecto a {drive_hash['source']} en Drive")
                 return True
             else:
                 print("ℹ️ No hay cambios en la base de datos, omitiendo backup")
@@ -294,30 +361,28 @@ class GoogleDriveManager:
             return True  # En caso de error, mejor hacer backup por seguridad
     
     def create_backup(self, db_path='tickets.db'):
-        """Crea un backup de la base de datos local con gestión inteligente"""
+        """Guarda un backup en el almacén deduplicado; devuelve su id"""
         try:
             if not os.path.exists(db_path):
                 return None
             
-            # Limpiar backups antiguos primero
-            self.cleanup_old_backups()
-            
-            # Crear nuevo backup
-            backup_path = f"tickets_backup_{datetime.now().strftime('%Y%m%d_%H%M%S')}.db"
-            
-            # Copiar archivo en lugar de renombrar para no perder el original
-            import shutil
-            shutil.copy2(db_path, backup_path)
+            # Solo se escriben los bloques que cambiaron desde el backup anterior
+            manifest = backup_store.create_backup(db_path, label='sync')
             
-            print(f"📁 Backup creado: {backup_path}")
-            return backup_path
+            # Limpiar según la retención (por hora, día y semana)
+            self.cleanup_old_backups()
+            return manifest['id']
             
         except Exception as e:
             print(f"❌ Error creando backup: {e}")
             return None
     
-    def upload_database(self, db_path='tickets.db'):
-        """Sube la base de datos a Google Drive"""
+    def upload_database(self, db_path='tickets.db', app_properties=None):
+        """Sube la base de datos a Google Drive
+
+        app_properties se guarda en el archivo (secuencia y equipo del snapshot).
+        """
+        snapshot_path = None
         try:
             if not self.authenticated or not os.path.exists(db_path):
                 return False
@@ -330,13 +395,18 @@ class GoogleDriveManager:
             
             files = results.get('files', [])
             
-            media = MediaFileUpload(db_path, mimetype='application/octet-stream')
+            # Se sube un snapshot consistente, no el archivo vivo (que puede estar cambiando)
+            fd, snapshot_path = tempfile.mkstemp(prefix='tickets_upload_', suffix='.db')
+            os.close(fd)
+            create_snapshot(snapshot_path, db_path)
+            media = MediaFileUpload(snapshot_path, mimetype='application/octet-stream')
             
             if files:
                 # Actualizar archivo existente
                 file_id = files[0]['id']
                 updated_file = self.service.files().update(
                     fileId=file_id,
+                    body={'appProperties': app_properties} if app_properties else None,
                     media_body=media
                 ).execute()
                 print("✅ Base de datos actualizada en Google Drive")
@@ -346,6 +416,8 @@ class GoogleDriveManager:
                     'name': 'tickets.db',
                     'parents': [self.folder_id]
                 }
+                if app_properties:
+                    file_metadata['appProperties'] = app_properties
                 
                 created_file = self.service.files().create(
                     body=file_metadata,
@@ -362,9 +434,18 @@ class GoogleDriveManager:
         except Exception as e:
             print(f"❌ Error subiendo base de datos: {e}")
             return False
+        finally:
+            if snapshot_path and os.path.exists(snapshot_path):
+                os.remove(snapshot_path)
     
-    def download_database(self, db_path='tickets.db'):
-        """Descarga la base de datos desde Google Drive"""
+    def download_database(self, db_path='tickets.db', progress=None):
+        """Descarga la base de datos desde Google Drive
+
+        Se escribe por bloques en un temporal junto a db_path (memoria constante),
+        se verifica tamaño, MD5 y cabecera SQLite, y solo entonces se mueve sobre
+        el archivo local sin conexiones abiertas. progress(descargado, total) es opcional.
+        """
+        tmp_path = None
         try:
             if not self.authenticated:
                 return False
@@ -372,7 +453,7 @@ class GoogleDriveManager:
             # Buscar archivo
             results = self.service.files().list(
                 q=f"name='tickets.db' and parents='{self.folder_id}' and trashed=false",
-                fields="files(id, name, modifiedTime)"
+                fields="files(id, name, size, md5Checksum)"
             ).execute()
             
             files = results.get('files', [])
@@ -381,22 +462,45 @@ class GoogleDriveManager:
                 print("⚠️ No se encontró base de datos en Google Drive")
                 return False
             
-            file_id = files[0]['id']
-            
-            # Descargar archivo
-            request = self.service.files().get_media(fileId=file_id)
-            fh = io.BytesIO()
-            downloader = MediaIoBaseDownload(fh, request)
-            
-            done = False
-            while done is False:
-                status, done = downloader.next_chunk()
-            
-            # Guardar archivo
-            with open(db_path, 'wb') as f:
-                f.write(fh.getvalue())
-            
-            print("✅ Base de datos descargada desde Google Drive")
+            file_info = files[0]
+            expected_size = int(file_info.get('size', 0))
+            
+            # Descargar archivo directamente a disco
+            fd, tmp_path = tempfile.mkstemp(prefix='.download_', suffix='.db',
+                                            dir=os.path.dirname(os.path.abspath(db_path)))
+            with os.fdopen(fd, 'wb') as f:
+                writer = HashingWriter(f)
+                request = self.service.files().get_media(fileId=file_info['id'])
+                downloader = MediaIoBaseDownload(writer, request, chunksize=DOWNLOAD_CHUNK_SIZE)
+                
+                done = False
+                last_reported = -1
+                while done is False:
+                    status, done = downloader.next_chunk(num_retries=DOWNLOAD_RETRIES)
+                    if progress:
+                        progress(writer.size, expected_size)
+                    elif status and expected_size > DOWNLOAD_CHUNK_SIZE:
+                        percent = int(status.progress() * 100)
+                        if percent // 10 > last_reported:
+                            last_reported = percent // 10
+                            print(f"⬇️ Descargando base de datos: {percent}%")
+                f.flush()
+                os.fsync(f.fileno())
+            
+            # Verificar antes de tocar la base local
+            if expected_size and writer.size != expected_size:
+                raise ValueError(f"tamaño {writer.size} distinto del esperado {expected_size}")
+            if file_info.get('md5Checksum') and writer.md5.hexdigest() != file_info['md5Checksum']:
+                raise ValueError("el MD5 no coincide con el de Drive")
+            with open(tmp_path, 'rb') as f:
+                if f.read(16) != b'SQLite format 3\x00':
+                    raise ValueError("el archivo descargado no es una base de datos SQLite")
+            
+            # Reemplazo atómico cuando no queda ninguna conexión abierta
+            replace_database_file(tmp_path, db_path)
+            tmp_path = None
+            
+            print(f"✅ Base de datos descargada desde Google Drive ({writer.size} bytes)")
             return True
             
         except HttpError as e:
@@ -405,30 +509,268 @@ class GoogleDriveManager:
         except Exception as e:
             print(f"❌ Error descargando base de datos: {e}")
             return False
+        finally:
+            if tmp_path and os.path.exists(tmp_path):
+                os.remove(tmp_path)
+    
+    def ensure_changelog(self):
+        """Instala el registro de cambios una vez por base de datos abierta"""
+        if not self._changelog_ready:
+            with db_connection() as conn:
+                install_changelog(conn)
+            self._changelog_ready = True
+    
+    def list_sync_files(self):
+        """Snapshot (tickets.db) y deltas de la carpeta, con sus appProperties"""
+        snapshot = None
+        deltas = []
+        page_token = None
+        while True:
+            results = self.service.files().list(
+                q=f"parents='{self.folder_id}' and trashed=false and "
+                  f"(name='tickets.db' or name contains '{DELTA_PREFIX}')",
+                fields="nextPageToken, files(id, name, size, modifiedTime, md5Checksum, appProperties)",
+                pageSize=1000,
+                pageToken=page_token
+            ).execute()
+            
+            for file_info in results.get('files', []):
+                props = file_info.get('appProperties') or {}
+                if file_info['name'] == 'tickets.db':
+                    snapshot = snapshot or file_info
+                elif file_info['name'].startswith(DELTA_PREFIX) and 'to_seq' in props:
+                    deltas.append({
+                        'file_id': file_info['id'],
+                        'name': file_info['name'],
+                        'origin': props.get('origin', ''),
+                        'from_seq': int(props['from_seq']),
+                        'to_seq': int(props['to_seq']),
+                        'created_at': float(props.get('created_at', 0)),
+                        'content_sha256': props.get('content_sha256'),
+                        'size': int(file_info.get('size', 0)),
+                    })
+            
+            page_token = results.get('nextPageToken')
+            if not page_token:
+                return snapshot, deltas
+    
+    def upload_delta(self, delta):
+        """Sube un delta comprimido; devuelve su tamaño en bytes"""
+        data = encode_delta(delta)
+        file_metadata = {
+            'name': delta_name(delta),
+            'parents': [self.folder_id],
+            'appProperties': {
+                'origin': delta['origin'],
+                'from_seq': str(delta['from_seq']),
+                'to_seq': str(delta['to_seq']),
+                'created_at': str(delta['created_at']),
+                'content_sha256': delta.get('content_sha256', ''),
+            }
+        }
+        media = MediaIoBaseUpload(io.BytesIO(data), mimetype='application/gzip')
+        self.service.files().create(body=file_metadata, media_body=media, fields='id').execute()
+        return len(data)
+    
+    def download_delta(self, file_id):
+        """Descarga y descomprime un delta (archivos pequeños, en memoria)"""
+        request = self.service.files().get_media(fileId=file_id)
+        fh = io.BytesIO()
+        downloader = MediaIoBaseDownload(fh, request)
+        done = False
+        while done is False:
+            status, done = downloader.next_chunk()
+        return decode_delta(fh.getvalue())
+    
+    def delete_files(self, file_ids):
+        """Borra archivos de Drive en peticiones batch"""
+        def on_response(request_id, response, exception):
+            if exception is not None:
+                print(f"⚠️ No se pudo borrar delta compactado: {exception}")
+        
+        for start in range(0, len(file_ids), DRIVE_BATCH_SIZE):
+            batch = self.service.new_batch_http_request(callback=on_response)
+            for file_id in file_ids[start:start + DRIVE_BATCH_SIZE]:
+                batch.add(self.service.files().delete(fileId=file_id))
+            batch.execute()
+    
+    def push_changes(self, db_path='tickets.db'):
+        """Sube los cambios locales: un delta o, al compactar, un snapshot completo"""
+        self.ensure_changelog()
+        with db_connection() as conn:
+            pushed = get_state(conn, STATE_LAST_PUSHED)
+            seq = current_seq(conn)
+            origin = get_state(conn, STATE_DEVICE_ID, '')
+            has_base = get_state(conn, STATE_SNAPSHOT_SEQ, None) is not None
+            snapshot_due = needs_snapshot(conn, os.path.getsize(db_path))
+            applied = get_applied(conn)
+            digest = content_digest.compute(conn)
+        
+        if seq <= pushed and has_base:
+            print("ℹ️ Sin cambios locales desde la última sincronización")
+            return True
+        
+        snapshot, deltas = self.list_sync_files()
+        props = (snapshot or {}).get('appProperties') or {}
+        
+        if snapshot is None or 'sync_seq' not in props or snapshot_due:
+            # Compactación: snapshot completo y borrado de los deltas que ya incluye
+            if not self.upload_database(db_path, {'sync_seq': str(seq), 'origin': origin,
+                                                  'created_at': str(time.time()), 'content_sha256': digest}):
+                return False
+            with db_connection() as conn:
+                mark_pushed(conn, seq)
+            covered = [delta['file_id'] for delta in deltas
+                       if (delta['origin'] == origin and delta['to_seq'] <= seq)
+                       or delta['to_seq'] <= applied.get(delta['origin'], 0)]
+            if covered:
+                self.delete_files(covered)
+            print(f"📦 Snapshot subido (secuencia {seq}), {len(covered)} deltas compactados")
+            return True
+        
+        with db_connection() as conn:
+            delta = build_delta(conn, pushed)
+        if delta is None:
+            return True
+        delta['content_sha256'] = digest
+        size = self.upload_delta(delta)
+        with db_connection() as conn:
+            mark_pushed(conn, delta['to_seq'], size)
+        print(f"📤 Delta subido: {len(delta['changes'])} filas, {size} bytes")
+        return True
+    
+    def pull_changes(self):
+        """Trae los cambios de otros equipos: deltas o, si faltan, el snapshot completo"""
+        self.ensure_changelog()
+        with db_connection() as conn:
+            origin = get_state(conn, STATE_DEVICE_ID, '')
+            applied = get_applied(conn)
+        
+        snapshot, deltas = self.list_sync_files()
+        if snapshot is None:
+            print("⚠️ No se encontró base de datos en Google Drive")
+            return False
+        
+        props = snapshot.get('appProperties') or {}
+        plan, gaps = plan_deltas(deltas, applied, origin)
+        
+        if 'sync_seq' in props:
+            snapshot_origin = props.get('origin', '')
+            snapshot_seq = int(props['sync_seq'])
+            reached = dict(applied)
+            for delta in plan:
+                reached[delta['origin']] = delta['to_seq']
+            # Hace falta el snapshot si nunca se recibió nada de ese equipo o si los deltas no alcanzan
+            needs_full = snapshot_origin != origin and (
+                snapshot_origin not in applied or reached[snapshot_origin] < snapshot_seq or gaps
+            )
+        else:
+            # Snapshot sin secuencia (versión anterior): decide la comparación de hashes
+            snapshot_origin, snapshot_seq = 'legacy', 0
+            needs_full = self.should_create_backup(drive_hash=self.latest_drive_hash(snapshot, []))
+        
+        if needs_full:
+            plan = self.replace_with_base(snapshot_origin, snapshot_seq, deltas)
+            if plan is None:
+                return False
+        
+        if not plan:
+            if not needs_full:
+                print("ℹ️ Los datos locales están actualizados, no se necesita sincronización")
+            return True
+        
+        try:
+            rows = self.apply_plan(plan)
+        except SyncConflictError as e:
+            # No se pisa nada: el delta se descarta entero y se parte del snapshot de Drive
+            print(f"⚠️ Conflicto de sincronización: {e}")
+            if needs_full:
+                print("❌ El conflicto persiste sobre el snapshot de Drive; sincronización detenida")
+                return False
+            print("🔄 Se reemplaza la base local por el snapshot de Drive")
+            plan = self.replace_with_base(snapshot_origin, snapshot_seq, deltas)
+            if plan is None:
+                return False
+            try:
+                rows = self.apply_plan(plan)
+            except SyncConflictError as e:
+                print(f"❌ El conflicto persiste sobre el snapshot de Drive ({e}); sincronización detenida")
+                return False
+        print(f"📥 {len(plan)} deltas aplicados ({rows} filas)")
+        return True
+    
+    def apply_plan(self, plan):
+        """Descarga y aplica los deltas en orden; devuelve las filas aplicadas"""
+        rows = 0
+        for delta_info in plan:
+            delta = self.download_delta(delta_info['file_id'])
+            try:
+                with db_connection() as conn:
+                    rows += apply_delta(conn, delta)
+            except SyncConflictError as e:
+                raise SyncConflictError(f"{delta_info['name']}: {e}") from e
+        return rows
+    
+    def replace_with_base(self, snapshot_origin, snapshot_seq, deltas):
+        """Reemplaza la base por el snapshot y devuelve los deltas que faltan aplicar (None si falla)"""
+        if not self.replace_with_snapshot():
+            return None
+        self._changelog_ready = False
+        self.ensure_changelog()
+        with db_connection() as conn:
+            reset_origin(conn, snapshot_origin, snapshot_seq)
+            origin = get_state(conn, STATE_DEVICE_ID, '')
+            applied = get_applied(conn)
+        plan, gaps = plan_deltas(deltas, applied, origin)
+        if gaps:
+            print(f"⚠️ Deltas compactados no incluidos en el snapshot: {', '.join(gaps)}")
+        return plan
+    
+    def thread_http(self):
+        """Cliente HTTP autorizado propio del hilo actual (httplib2 no es seguro entre hilos)"""
+        if self.credentials is None:
+            return None
+        http = getattr(self._thread_local, 'http', None)
+        if http is None:
+            http = self._thread_local.http = google_auth_httplib2.AuthorizedHttp(
+                self.credentials, http=httplib2.Http()
+            )
+        return http
+    
+    def attachment_upload_request(self, file_path, ticket_id, original_name=None,
+                                  resumable_uri=None, offset=0):
+        """Petición de subida reanudable de un adjunto; con resumable_uri continúa una sesión previa"""
+        filename = original_name or os.path.basename(file_path)
+        file_metadata = {
+            'name': f"ticket_{ticket_id}_{filename}",
+            'parents': [self.get_or_create_attachments_folder()]
+        }
+        media = MediaFileUpload(file_path, resumable=True, chunksize=ATTACHMENT_CHUNK_SIZE)
+        request = self.service.files().create(
+            body=file_metadata,
+            media_body=media,
+            fields='id,name,size'
+        )
+        if resumable_uri:
+            request.resumable_uri = resumable_uri
+            request.resumable_progress = offset
+        return request
     
     def upload_attachment(self, file_path, ticket_id):
-        """Sube un archivo adjunto a Google Drive"""
+        """Sube un archivo adjunto a Google Drive (en el hilo actual)
+
+        Para no bloquear peticiones web, usar attachment_uploader.enqueue().
+        """
         try:
             if not self.authenticated or not os.path.exists(file_path):
                 return None
             
             filename = os.path.basename(file_path)
-            
-            # Crear subcarpeta para attachments si no existe
-            attachments_folder_id = self.get_or_create_attachments_folder()
-            
-            file_metadata = {
-                'name': f"ticket_{ticket_id}_{filename}",
-                'parents': [attachments_folder_id]
-            }
-            
-            media = MediaFileUpload(file_path, resumable=True)
-            
-            uploaded_file = self.service.files().create(
-                body=file_metadata,
-                media_body=media,
-                fields='id,name,size'
-            ).execute()
+            request = self.attachment_upload_request(file_path, ticket_id, filename)
+            http = self.thread_http()
+            uploaded_file = None
+            while uploaded_file is None:
+                status, uploaded_file = request.next_chunk(http=http)
             
             print(f"✅ Archivo adjunto subido: {filename}")
             
@@ -446,53 +788,77 @@ class GoogleDriveManager:
             print(f"❌ Error subiendo archivo adjunto: {e}")
             return None
     
+    def iter_attachment(self, drive_id, chunk_size=DOWNLOAD_CHUNK_SIZE):
+        """Contenido de un adjunto de Drive bloque a bloque (memoria acotada a chunk_size)"""
+        request = self.service.files().get_media(fileId=drive_id)
+        http = self.thread_http()
+        if http is not None:
+            request.http = http
+        buffer = io.BytesIO()
+        downloader = MediaIoBaseDownload(buffer, request, chunksize=chunk_size)
+        done = False
+        while not done:
+            status, done = downloader.next_chunk(num_retries=DOWNLOAD_RETRIES)
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    
     def get_or_create_attachments_folder(self):
-        """Obtiene o crea la carpeta de archivos adjuntos"""
-        try:
-            # Buscar carpeta existente
-            results = self.service.files().list(
-                q=f"name='attachments' and parents='{self.folder_id}' and mimeType='application/vnd.google-apps.folder' and trashed=false",
-                fields="files(id, name)"
-            ).execute()
-            
-            folders = results.get('files', [])
-            
-            if folders:
-                return folders[0]['id']
-            else:
-                # Crear carpeta
-                folder_metadata = {
-                    'name': 'attachments',
-                    'parents': [self.folder_id],
-                    'mimeType': 'application/vnd.google-apps.folder'
-                }
-                
-                folder = self.service.files().create(
-                    body=folder_metadata,
-                    fields='id'
+        """Obtiene o crea la carpeta de archivos adjuntos (consulta a Drive solo la primera vez)"""
+        if self._attachments_folder_id:
+            return self._attachments_folder_id
+        
+        with self._attachments_folder_lock:
+            if self._attachments_folder_id:
+                return self._attachments_folder_id
+            try:
+                # Buscar carpeta existente
+                results = self.service.files().list(
+                    q=f"name='attachments' and parents='{self.folder_id}' and mimeType='application/vnd.google-apps.folder' and trashed=false",
+                    fields="files(id, name)"
                 ).execute()
                 
-                return folder.get('id')
+                folders = results.get('files', [])
                 
-        except Exception as e:
-            print(f"❌ Error con carpeta attachments: {e}")
-            return self.folder_id  # Fallback a carpeta principal
+                if folders:
+                    self._attachments_folder_id = folders[0]['id']
+                else:
+                    # Crear carpeta
+                    folder_metadata = {
+                        'name': 'attachments',
+                        'parents': [self.folder_id],
+                        'mimeType': 'application/vnd.google-apps.folder'
+                    }
+                    
+                    folder = self.service.files().create(
+                        body=folder_metadata,
+                        fields='id'
+                    ).execute()
+                    
+                    self._attachments_folder_id = folder.get('id')
+                
+                return self._attachments_folder_id
+                    
+            except Exception as e:
+                print(f"❌ Error con carpeta attachments: {e}")
+                return self.folder_id  # Fallback a carpeta principal (no se guarda en caché)
+    
+    def schedule_sync(self, reason=None):
+        """Anota cambios locales; el planificador sube una vez tras el debounce"""
+        if self.authenticated:
+            self.sync_scheduler.mark_dirty(reason)
     
     def sync_tickets_to_drive(self):
-        """Sincroniza todos los datos a Google Drive"""
+        """Sincroniza todos los datos a Google Drive (lo llama el planificador)"""
         try:
             if not self.authenticated:
                 print("⚠️ Google Drive no autenticado")
                 return False
             
-            # Probar conexión antes de sincronizar
-            success, message = self.test_connection()
-            if not success:
-                print(f"❌ Error de conexión: {message}")
-                return False
-            
-            # Subir base de datos
-            success = self.upload_database()
+            # Subir solo los cambios desde la última sincronización; un error de red
+            # aparece en la primera llamada, sin una prueba de conexión previa
+            with self._sync_lock:
+                success = self.push_changes()
             
             if success:
                 # Actualizar timestamp de última sincronización
@@ -518,53 +884,57 @@ class GoogleDriveManager:
                 print(f"❌ Error de conexión: {message}")
                 return False
             
-            # Verificar si realmente necesitamos hacer backup y sincronizar
-            if not self.should_create_backup():
-                print("ℹ️ Los datos locales están actualizados, no se necesita sincronización")
-                return True
-            
-            # Solo hacer backup si realmente hay cambios
-            backup_path = self.create_backup()
-            if not backup_path:
-                print("❌ No se pudo crear backup, abortando sincronización")
-                return False
-            
-            try:
-                # Descargar datos de Drive
-                success = self.download_database()
+            with self._sync_lock:
+                # Los cambios locales pendientes se suben primero: así sobreviven a un reemplazo completo
+                self.ensure_changelog()
+                with db_connection() as conn:
+                    pending = current_seq(conn) > get_state(conn, STATE_LAST_PUSHED)
+                if pending:
+                    self.push_changes()
                 
-                if success:
-                    print("🔄 Sincronización desde Drive completada")
-                    return True
-                else:
-                    # Restaurar backup si falla
-                    if os.path.exists(backup_path):
-                        import shutil
-                        shutil.copy2(backup_path, 'tickets.db')
-                        print("🔄 Backup restaurado debido a error en descarga")
-                    return False
-                    
-            except Exception as e:
-                print(f"❌ Error durante descarga: {e}")
-                # Restaurar backup
-                if os.path.exists(backup_path):
-                    import shutil
-                    shutil.copy2(backup_path, 'tickets.db')
-                    print("🔄 Backup restaurado debido a error")
-                return False
+                success = self.pull_changes()
+            if success:
+                print("🔄 Sincronización desde Drive completada")
+            return success
                 
         except Exception as e:
             print(f"❌ Error en sincronización desde Drive: {e}")
             return False
     
+    def replace_with_snapshot(self, db_path='tickets.db'):
+        """Reemplaza la base local por el snapshot de Drive, con backup y restauración"""
+        # Solo hacer backup si realmente hay cambios
+        backup_id = self.create_backup(db_path)
+        if not backup_id:
+            print("❌ No se pudo crear backup, abortando sincronización")
+            return False
+        
+        try:
+            # Descargar datos de Drive
+            success = self.download_database(db_path)
+            
+            if success:
+                return True
+            else:
+                # Restaurar backup si falla
+                backup_store.restore(backup_id, db_path=db_path)
+                print("🔄 Backup restaurado debido a error en descarga")
+                return False
+                
+        except Exception as e:
+            print(f"❌ Error durante descarga: {e}")
+            # Restaurar backup
+            backup_store.restore(backup_id, db_path=db_path)
+            print("🔄 Backup restaurado debido a error")
+            return False
+    
     def check_drive_has_newer_data(self):
-        """Verifica si Google Drive tiene datos más recientes - MEJORADO"""
+        """Verifica si Google Drive tiene datos distintos de los locales (una consulta de metadatos)"""
         try:
-            local_hash = self.get_local_db_hash()
             drive_hash = self.get_drive_db_hash()
             
             # Si no hay archivo local, Drive tiene datos "más nuevos"
-            if local_hash is None:
+            if not os.path.exists('tickets.db'):
                 return drive_hash is not None
             
             # Si no hay archivo en Drive, local es más reciente
@@ -572,7 +942,7 @@ class GoogleDriveManager:
                 return False
             
             # Comparar hashes
-            return local_hash != drive_hash
+            return not self.local_matches_drive(drive_hash)
             
         except Exception as e:
             print(f"❌ Error verificando fechas: {e}")
@@ -581,26 +951,25 @@ class GoogleDriveManager:
     def update_sync_timestamp(self):
         """Actualiza el timestamp de última sincronización"""
         try:
-            conn = sqlite3.connect('tickets.db')
-            cursor = conn.cursor()
-            
-            # Crear tabla de configuración si no existe
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS sync_config (
-                    key TEXT PRIMARY KEY,
-                    value TEXT,
-                    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                )
-            ''')
-            
-            # Actualizar timestamp
-            cursor.execute('''
-                INSERT OR REPLACE INTO sync_config (key, value, updated_at)
-                VALUES ('last_sync', ?, CURRENT_TIMESTAMP)
-            ''', (datetime.now().isoformat(),))
-            
-            conn.commit()
-            conn.close()
+            with db_connection() as conn:
+                cursor = conn.cursor()
+            
+                # Crear tabla de configuración si no existe
+                cursor.execute('''
+                    CREATE TABLE IF NOT EXISTS sync_config (
+                        key TEXT PRIMARY KEY,
+                        value TEXT,
+                        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                    )
+                ''')
+            
+                # Actualizar timestamp
+                cursor.execute('''
+                    INSERT OR REPLACE INTO sync_config (key, value, updated_at)
+                    VALUES ('last_sync', ?, CURRENT_TIMESTAMP)
+                ''', (datetime.now().isoformat(),))
+            
+                conn.commit()
             
         except Exception as e:
             print(f"❌ Error actualizando timestamp: {e}")
@@ -625,24 +994,26 @@ class GoogleDriveManager:
                 }
             
             # Obtener último sync
-            conn = sqlite3.connect('tickets.db')
-            cursor = conn.cursor()
-            cursor.execute('SELECT value FROM sync_config WHERE key = "last_sync"')
-            result = cursor.fetchone()
-            last_sync = result[0] if result else 'Nunca'
-            conn.close()
+            with db_connection() as conn:
+                cursor = conn.cursor()
+                cursor.execute('SELECT value FROM sync_config WHERE key = "last_sync"')
+                result = cursor.fetchone()
+                last_sync = result[0] if result else 'Nunca'
             
             # Obtener información de backups
-            backup_files = glob.glob("tickets_backup_*.db")
-            backup_count = len(backup_files)
+            store_stats = backup_store.get_stats()
             
             return {
                 'status': 'Conectado',
                 'folder_id': self.folder_id,
                 'last_sync': last_sync,
                 'folder_name': FOLDER_NAME,
-                'backup_count': backup_count,
-                'max_backups': MAX_BACKUPS
+                'backup_count': store_stats['backups'],
+                'backup_store': store_stats,
+                'changelog': get_changelog_status(),
+                'content_digest': content_digest.get_stats(),
+                'sync_scheduler': self.sync_scheduler.get_stats(),
+                'attachment_uploads': self.attachment_uploader.get_metrics()
             }
             
         except Exception as e:
@@ -675,10 +1046,11 @@ if __name__ == "__main__":
         print(f"🔍 Test de conexión: {message}")
         
         # Mostrar información de backups
-        backup_files = glob.glob("tickets_backup_*.db")
-        print(f"📁 Backups existentes: {len(backup_files)}")
-        for backup in backup_files:
-            print(f"   - {backup}")
+        backups = backup_store.list_backups()
+        print(f"📁 Backups existentes: {len(backups)}")
+        for backup in backups:
+            print(f"   - {backup['id']} ({backup['size']} bytes)")
+        print(f"📊 Deduplicación: {backup_store.get_stats()['dedup_ratio']}x")
         
         # Probar sincronización
         if os.path.exists('tickets.db'):
@@ -0,0 +1,506 @@
+"""
+Registro de notificaciones del Sistema de Tickets
+Registros JSON-lines escritos en background por lotes, con rotación comprimida,
+índice por segmento para consultas y buffer circular en memoria para las lecturas frecuentes
+"""
+
+import atexit
+import glob
+import gzip
+import json
+import os
+import queue
+import re
+import shutil
+import sys
+import threading
+import time
+from collections import deque
+from datetime import datetime
+
+# Configuración
+NOTIFICATIONS_LOG = 'notifications.jsonl'
+LEGACY_LOG = 'notifications.log'           # Formato de texto anterior (se convierte a segmento al arrancar)
+INDEX_FILE = 'notifications.index.json'    # Índice de los segmentos rotados
+RING_BUFFER_SIZE = 100     # Notificaciones recientes que se mantienen en memoria
+TAIL_BLOCK_SIZE = 8192     # Bytes leídos por bloque desde el final del archivo
+ROTATE_MAX_BYTES = 5 * 1024 * 1024
+ROTATE_MAX_AGE = 24 * 3600
+RETAINED_SEGMENTS = 30
+BATCH_MAX = 200            # Registros por escritura
+FLUSH_INTERVAL = 0.5       # Segundos máximos que un registro espera en la cola
+QUERY_LIMIT = 100
+LOG_TO_CONSOLE = True      # Eco en consola, desde el hilo escritor
+
+TIMESTAMP_FORMAT = '%Y-%m-%d %H:%M:%S'
+LEGACY_LINE = re.compile(r'^\[(?P<timestamp>[^\]]+)\] TICKET #(?P<ticket_id>\d+) - (?P<action>[^:]+): (?P<details>.*)$')
+
+
+def tail_lines(path, count, block_size=TAIL_BLOCK_SIZE, encoding='utf-8'):
+    """Devuelve las últimas `count` líneas de un archivo leyendo bloques desde el final
+
+    El costo depende del tamaño de las líneas pedidas, no del tamaño del archivo.
+    Las líneas conservan su salto de línea final, igual que readlines().
+    """
+    if count <= 0:
+        return []
+
+    with open(path, 'rb') as f:
+        f.seek(0, os.SEEK_END)
+        position = f.tell()
+        data = b''
+        # Hacen falta count + 1 saltos para asegurar que la primera línea está completa
+        while position > 0 and data.count(b'\n') <= count:
+            step = min(block_size, position)
+            position -= step
+            f.seek(position)
+            data = f.read(step) + data
+
+    lines = data.splitlines(keepends=True)
+    # Si no se llegó al inicio del archivo, la primera línea está cortada
+    if position > 0 and lines:
+        lines = lines[1:]
+    return [line.decode(encoding, errors='replace') for line in lines[-count:]]
+
+
+def format_record(record):
+    """Línea legible de un registro (mismo formato que el log de texto original)"""
+    if 'message' in record:
+        return record['message']
+    return (f"[{record['timestamp']}] TICKET #{record['ticket_id']} - "
+            f"{str(record['action']).upper()}: {record['details']}")
+
+
+def parse_line(line):
+    """Registro de una línea JSON; las líneas del formato anterior se envuelven como mensaje"""
+    line = line.strip()
+    if not line:
+        return None
+    try:
+        return json.loads(line)
+    except json.JSONDecodeError:
+        return {'message': line}
+
+
+def parse_legacy_line(line):
+    """Registro estructurado de una línea del log de texto anterior"""
+    line = line.strip()
+    if not line:
+        return None
+    match = LEGACY_LINE.match(line)
+    if not match:
+        return {'message': line}
+    return {
+        'timestamp': match['timestamp'],
+        'ticket_id': int(match['ticket_id']),
+        'action': match['action'].lower(),
+        'actor': None,
+        'details': match['details'],
+    }
+
+
+def _new_segment_index():
+    return {'min_ts': None, 'max_ts': None, 'count': 0, 'tickets': set(), 'actions': set()}
+
+
+def _index_record(index, record):
+    """Agrega un registro al índice de su segmento"""
+    timestamp = record.get('timestamp')
+    if timestamp:
+        if index['min_ts'] is None or timestamp < index['min_ts']:
+            index['min_ts'] = timestamp
+        if index['max_ts'] is None or timestamp > index['max_ts']:
+            index['max_ts'] = timestamp
+    index['count'] += 1
+    if record.get('ticket_id') is not None:
+        index['tickets'].add(str(record['ticket_id']))
+    if record.get('action'):
+        index['actions'].add(record['action'])
+
+
+def _segment_matches(index, ticket_id=None, action=None, since=None, until=None):
+    """Decide con el índice si un segmento puede contener registros que cumplan el filtro"""
+    if not index['count']:
+        return False
+    if ticket_id is not None and str(ticket_id) not in index['tickets']:
+        return False
+    if action and action not in index['actions']:
+        return False
+    if since and index['max_ts'] and index['max_ts'] < since:
+        return False
+    if until and index['min_ts'] and index['min_ts'] > until:
+        return False
+    return True
+
+
+def _record_matches(record, ticket_id=None, action=None, since=None, until=None):
+    if ticket_id is not None and str(record.get('ticket_id')) != str(ticket_id):
+        return False
+    if action and record.get('action') != action:
+        return False
+    timestamp = record.get('timestamp') or ''
+    if since and timestamp < since:
+        return False
+    if until and timestamp > until:
+        return False
+    return True
+
+
+class NotificationLog:
+    def __init__(self, path=NOTIFICATIONS_LOG, capacity=RING_BUFFER_SIZE, index_path=INDEX_FILE,
+                 max_bytes=ROTATE_MAX_BYTES, max_age=ROTATE_MAX_AGE, retained=RETAINED_SEGMENTS):
+        self.path = path
+        self.capacity = capacity
+        self.index_path = index_path
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.retained = retained
+
+        self._buffer = deque(maxlen=capacity)
+        self._loaded = False
+        self._lock = threading.Lock()           # Buffer en memoria
+        self._files_lock = threading.Lock()     # Archivos e índices (escritor y consultas)
+
+        # Cola de escritura y contador de registros aún no escritos
+        self._queue = queue.Queue()
+        self._pending = 0
+        self._pending_cond = threading.Condition()
+        self._writer = None
+
+        # Índices: segmentos rotados (persistidos) y segmento activo (en memoria)
+        self._segments = None
+        self._active_index = None
+        self._active_started = None
+
+        self.metrics = {
+            'memory_reads': 0,
+            'disk_reads': 0,
+            'written': 0,
+            'batches': 0,
+            'rotations': 0,
+            'queries': 0,
+            'segments_scanned': 0,
+            'write_errors': 0,
+        }
+
+    # ==================== ESCRITURA ====================
+
+    def log(self, ticket_id, action, details, actor=None):
+        """Registra una notificación sin bloquear: memoria inmediata, disco en background"""
+        record = {
+            'timestamp': datetime.now().strftime(TIMESTAMP_FORMAT),
+            'ticket_id': ticket_id,
+            'action': action,
+            'actor': actor,
+            'details': details,
+        }
+        with self._lock:
+            self._load()
+            self._buffer.append(format_record(record) + '\n')
+            self._ensure_writer()
+        with self._pending_cond:
+            self._pending += 1
+        self._queue.put(record)
+        return record
+
+    def _ensure_writer(self):
+        if self._writer is None or not self._writer.is_alive():
+            self._writer = threading.Thread(target=self._run, name='notification-log-writer', daemon=True)
+            self._writer.start()
+
+    def _run(self):
+        """Hilo escritor: agrupa los registros de la cola y los escribe en lote"""
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + FLUSH_INTERVAL
+            while len(batch) < BATCH_MAX:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+
+            records = [record for record in batch if record is not None]
+            try:
+                if records:
+                    self._write_batch(records)
+            except Exception as e:
+                self.metrics['write_errors'] += 1
+                print(f"❌ Error escribiendo log de notificaciones: {e}")
+            finally:
+                with self._pending_cond:
+                    self._pending -= len(records)
+                    self._pending_cond.notify_all()
+
+            if None in batch:
+                return
+
+    def _write_batch(self, records):
+        data = ''.join(json.dumps(record, ensure_ascii=False) + '\n' for record in records)
+
+        with self._files_lock:
+            self._load_indexes()
+            if self._should_rotate():
+                self._rotate()
+
+            with open(self.path, 'a', encoding='utf-8') as f:
+                f.write(data)
+
+            for record in records:
+                _index_record(self._active_index, record)
+            if self._active_started is None:
+                self._active_started = time.time()
+
+        if LOG_TO_CONSOLE:
+            for record in records:
+                print(f"📧 NOTIFICACIÓN: {format_record(record)}")
+
+        self.metrics['written'] += len(records)
+        self.metrics['batches'] += 1
+
+    def flush(self, timeout=5.0):
+        """Espera a que todos los registros encolados estén en disco"""
+        deadline = time.monotonic() + timeout
+        with self._pending_cond:
+            while self._pending > 0:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self._pending_cond.wait(remaining)
+        return True
+
+    def close(self, timeout=5.0):
+        """Vacía la cola y detiene el hilo escritor (registrado con atexit)"""
+        if self._writer is not None and self._writer.is_alive():
+            self._queue.put(None)
+            self._writer.join(timeout)
+
+    # ==================== ROTACIÓN ====================
+
+    def _should_rotate(self):
+        if not os.path.exists(self.path) or not self._active_index['count']:
+            return False
+        if os.path.getsize(self.path) >= self.max_bytes:
+            return True
+        return self._active_started is not None and time.time() - self._active_started >= self.max_age
+
+    def _rotate(self):
+        """Comprime el segmento activo, lo agrega al índice y elimina los más antiguos"""
+        stamp = datetime.now().strftime('%Y%m%d-%H%M%S-%f')
+        base = os.path.splitext(self.path)[0]
+        segment = f"{base}-{stamp}.jsonl.gz"
+
+        with open(self.path, 'rb') as source, gzip.open(segment, 'wb') as target:
+            shutil.copyfileobj(source, target)
+        os.remove(self.path)
+
+        entry = dict(self._active_index, file=segment)
+        self._segments.append(entry)
+        while len(self._segments) > self.retained:
+            oldest = self._segments.pop(0)
+            try:
+                os.remove(oldest['file'])
+            except OSError:
+                pass
+        self._save_indexes()
+
+        self._active_index = _new_segment_index()
+        self._active_started = None
+        self.metrics['rotations'] += 1
+        print(f"🗜️ Log de notificaciones rotado: {segment}")
+
+    # ==================== ÍNDICES ====================
+
+    def _load_indexes(self):
+        """Carga el índice de segmentos y reconstruye el del segmento activo (una vez)"""
+        if self._segments is not None:
+            return
+        segments = []
+        if os.path.exists(self.index_path):
+            try:
+                with open(self.index_path, 'r', encoding='utf-8') as f:
+                    for entry in json.load(f):
+                        entry['tickets'] = set(entry['tickets'])
+                        entry['actions'] = set(entry['actions'])
+                        if os.path.exists(entry['file']):
+                            segments.append(entry)
+            except (OSError, ValueError, KeyError) as e:
+                print(f"⚠️ Índice de notificaciones inválido, se reconstruye: {e}")
+                segments = []
+
+        self._convert_legacy()
+
+        # Segmentos presentes en disco pero ausentes del índice
+        known = {entry['file'] for entry in segments}
+        base = os.path.splitext(self.path)[0]
+        discovered = [self._index_segment(segment) for segment in sorted(glob.glob(f"{base}-*.jsonl.gz"))
+                      if segment not in known]
+        segments.extend(discovered)
+        segments.sort(key=lambda entry: entry['file'])
+        self._segments = segments
+        if discovered:
+            self._save_indexes()
+
+        self._active_index = _new_segment_index()
+        if os.path.exists(self.path):
+            with open(self.path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    record = parse_line(line)
+                    if record:
+                        _index_record(self._active_index, record)
+            self._active_started = os.path.getmtime(self.path) if not self._active_index['min_ts'] else \
+                datetime.strptime(self._active_index['min_ts'], TIMESTAMP_FORMAT).timestamp()
+
+    def _convert_legacy(self):
+        """Pasa notifications.log a un segmento rotado JSON-lines (una sola vez)
+
+        El segmento toma la fecha del primer registro, así que queda ordenado
+        antes que los posteriores y las consultas lo indexan como a los demás.
+        El archivo original se conserva renombrado como .migrated.
+        """
+        legacy = os.path.join(os.path.dirname(self.path), LEGACY_LOG)
+        if not os.path.exists(legacy):
+            return
+        with open(legacy, 'r', encoding='utf-8', errors='replace') as f:
+            records = [record for record in map(parse_legacy_line, f) if record]
+        first = next((record['timestamp'] for record in records if 'timestamp' in record), None)
+        try:
+            started = datetime.strptime(first, TIMESTAMP_FORMAT) if first else \
+                datetime.fromtimestamp(os.path.getmtime(legacy))
+        except ValueError:
+            started = datetime.fromtimestamp(os.path.getmtime(legacy))
+
+        base = os.path.splitext(self.path)[0]
+        segment = f"{base}-{started.strftime('%Y%m%d-%H%M%S')}-000000.jsonl.gz"
+        if records:
+            temp_path = segment + '.tmp'
+            with gzip.open(temp_path, 'wt', encoding='utf-8') as f:
+                for record in records:
+                    f.write(json.dumps(record, ensure_ascii=False) + '\n')
+            os.replace(temp_path, segment)
+        os.replace(legacy, legacy + '.migrated')
+        print(f"📦 {len(records)} notificaciones de {LEGACY_LOG} convertidas a {segment}")
+
+    def _index_segment(self, segment):
+        index = _new_segment_index()
+        for record in self._read_segment(segment):
+            _index_record(index, record)
+        index['file'] = segment
+        return index
+
+    def _save_indexes(self):
+        entries = [dict(entry, tickets=sorted(entry['tickets']), actions=sorted(entry['actions']))
+                   for entry in self._segments]
+        temp_path = self.index_path + '.tmp'
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump(entries, f)
+        os.replace(temp_path, self.index_path)
+
+    @staticmethod
+    def _read_segment(path):
+        opener = gzip.open if path.endswith('.gz') else open
+        with opener(path, 'rt', encoding='utf-8') as f:
+            for line in f:
+                record = parse_line(line)
+                if record:
+                    yield record
+
+    # ==================== LECTURA ====================
+
+    def _load(self):
+        """Llena el buffer con los últimos registros (una sola vez por proceso)
+
+        Lee la cola del segmento activo y, si no alcanza, los segmentos rotados
+        más recientes (entre ellos el del log de texto anterior).
+        """
+        if self._loaded:
+            return
+        with self._files_lock:
+            self._load_indexes()
+            sources = [entry['file'] for entry in self._segments]
+            if os.path.exists(self.path):
+                sources.append(self.path)
+        lines = []
+        for source in reversed(sources):
+            if len(lines) >= self.capacity:
+                break
+            needed = self.capacity - len(lines)
+            if source == self.path:
+                records = [record for record in map(parse_line, tail_lines(source, needed)) if record]
+            else:
+                records = list(self._read_segment(source))
+            lines = [format_record(record) + '\n' for record in records[-needed:]] + lines
+            self.metrics['disk_reads'] += 1
+        self._buffer.extend(lines)
+        self._loaded = True
+
+    def recent(self, limit=10):
+        """Últimas `limit` notificaciones formateadas, de la más antigua a la más reciente"""
+        with self._lock:
+            self._load()
+            if limit <= len(self._buffer) or len(self._buffer) < self.capacity:
+                self.metrics['memory_reads'] += 1
+                return list(self._buffer)[-limit:] if limit > 0 else []
+
+        # Pedido mayor que el buffer: se consulta el registro completo
+        records = self.query(limit=limit)
+        return [format_record(record) + '\n' for record in reversed(records)]
+
+    def query(self, ticket_id=None, action=None, since=None, until=None, limit=QUERY_LIMIT):
+        """Consulta registros por ticket, acción y rango de fechas ('YYYY-MM-DD HH:MM:SS')
+
+        Devuelve los más recientes primero. El índice descarta los segmentos que no
+        pueden contener coincidencias, así que solo se descomprimen los necesarios.
+        """
+        self.flush()
+        filters = {'ticket_id': ticket_id, 'action': action, 'since': since, 'until': until}
+
+        results = []
+        with self._files_lock:
+            self._load_indexes()
+            candidates = [entry['file'] for entry in self._segments if _segment_matches(entry, **filters)]
+            if os.path.exists(self.path) and _segment_matches(self._active_index, **filters):
+                candidates.append(self.path)
+            self.metrics['queries'] += 1
+
+            for segment in reversed(candidates):
+                self.metrics['segments_scanned'] += 1
+                matches = [record for record in self._read_segment(segment) if _record_matches(record, **filters)]
+                results.extend(reversed(matches))
+                if len(results) >= limit:
+                    break
+        return results[:limit]
+
+    def get_metrics(self):
+        """Métricas del buffer, la cola y los segmentos"""
+        with self._lock:
+            metrics = dict(self.metrics)
+            metrics['buffered'] = len(self._buffer)
+            metrics['capacity'] = self.capacity
+        with self._files_lock:
+            metrics['segments'] = len(self._segments) if self._segments is not None else None
+        metrics['pending'] = self._pending
+        return metrics
+
+
+# Instancia global del registro
+notification_log = NotificationLog()
+atexit.register(notification_log.close)
+
+
+if __name__ == "__main__":
+    # Uso: python notification_log.py [--ticket N] [--action X] [--since FECHA] [--until FECHA] [--limit N]
+    args = sys.argv[1:]
+    options = dict(zip(args[::2], args[1::2]))
+    records = notification_log.query(
+        ticket_id=options.get('--ticket'),
+        action=options.get('--action'),
+        since=options.get('--since'),
+        until=options.get('--until'),
+        limit=int(options.get('--limit', 20))
+    )
+    for record in reversed(records):
+        print(format_record(record))
+    print(f"📊 {len(records)} registros - {notification_log.get_metrics()}")
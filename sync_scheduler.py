@@ -0,0 +1,195 @@
+"""
+Planificador de sincronización del Sistema de Tickets
+Agrupa las señales de "hay cambios" (debounce) y garantiza una sola subida a la vez;
+lo que llega durante una subida se combina en una única subida posterior
+"""
+
+import threading
+import time
+
+# Configuración
+SYNC_DEBOUNCE_SECONDS = 5.0     # Silencio requerido tras el último cambio antes de subir
+SYNC_MAX_DELAY_SECONDS = 30.0   # Una ráfaga continua de cambios no retrasa la subida más que esto
+SYNC_RETRY_SECONDS = 60.0       # Espera tras una sincronización fallida
+SYNC_WAIT_TIMEOUT = 120.0       # Espera máxima de sync_now
+
+
+class SyncScheduler:
+    """Ejecuta sync_func en un único hilo, como máximo una vez a la vez
+
+    mark_dirty() solo anota que hay cambios; el hilo espera SYNC_DEBOUNCE_SECONDS
+    sin cambios nuevos (o SYNC_MAX_DELAY_SECONDS desde el primero) y sube una vez.
+    Con `interval`, además sincroniza periódicamente aunque no haya señales.
+    """
+
+    def __init__(self, sync_func, name='sync', debounce=SYNC_DEBOUNCE_SECONDS,
+                 max_delay=SYNC_MAX_DELAY_SECONDS, interval=None):
+        self.sync_func = sync_func
+        self.name = name
+        self.debounce = debounce
+        self.max_delay = max_delay
+        self.interval = interval
+        self._cond = threading.Condition()
+        self._thread = None
+        self._dirty = False
+        self._first_dirty = None
+        self._last_dirty = None
+        self._not_before = 0.0
+        self._in_flight = False
+        self._run_id = 0            # Sincronizaciones iniciadas
+        self._done_id = 0           # Sincronizaciones terminadas
+        self._last_run_at = time.monotonic()
+
+        self.stats = {
+            'requests': 0,          # Señales recibidas
+            'merged': 0,            # Señales absorbidas por una subida ya pendiente
+            'merged_in_flight': 0,  # Señales llegadas durante una subida (una sola subida posterior)
+            'runs': 0,
+            'periodic_runs': 0,
+            'failures': 0,
+            'last_latency_ms': None,
+            'last_sync_at': None,
+            'last_result': None,
+            'last_error': None,
+        }
+
+    def start(self, interval=None):
+        """Inicia el hilo (una sola vez); interval activa la sincronización periódica"""
+        with self._cond:
+            if interval is not None:
+                self.interval = interval
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._worker, name=self.name, daemon=True)
+                self._thread.start()
+            self._cond.notify_all()
+
+    def mark_dirty(self, reason=None):
+        """Anota que hay cambios locales; no bloquea ni sube nada"""
+        self.start()
+        now = time.monotonic()
+        with self._cond:
+            self.stats['requests'] += 1
+            if self._dirty:
+                self.stats['merged'] += 1
+            elif self._in_flight:
+                self.stats['merged_in_flight'] += 1
+            if not self._dirty:
+                self._first_dirty = now
+            self._dirty = True
+            self._last_dirty = now
+            self._cond.notify_all()
+
+    def sync_now(self, timeout=SYNC_WAIT_TIMEOUT):
+        """Pide una sincronización inmediata y espera su resultado
+
+        Si hay una subida en curso, espera a la siguiente (la que incluye los
+        cambios actuales) en lugar de lanzar otra en paralelo.
+        """
+        self.start()
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            self.stats['requests'] += 1
+            # La sincronización que cubra esta petición tiene que empezar después de ahora
+            target = self._run_id + 1
+            self._dirty = True
+            self._first_dirty = self._last_dirty = time.monotonic() - self.max_delay
+            self._not_before = 0.0
+            self._cond.notify_all()
+            while self._done_id < target:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+            return bool(self.stats['last_result'])
+
+    def _next_wakeup(self, now):
+        """Segundos hasta la próxima acción, o 0 si hay que sincronizar ya"""
+        waits = []
+        if self._dirty:
+            due = max(min(self._last_dirty + self.debounce, self._first_dirty + self.max_delay),
+                      self._not_before)
+            waits.append(due - now)
+        if self.interval:
+            waits.append(self._last_run_at + self.interval - now)
+        if not waits:
+            return None
+        return max(0.0, min(waits))
+
+    def _worker(self):
+        while True:
+            with self._cond:
+                while True:
+                    wait = self._next_wakeup(time.monotonic())
+                    if wait == 0:
+                        break
+                    self._cond.wait(wait)
+                periodic = not self._dirty
+                self._dirty = False
+                self._first_dirty = self._last_dirty = None
+                self._in_flight = True
+                self._run_id += 1
+
+            started = time.perf_counter()
+            error = None
+            try:
+                result = bool(self.sync_func())
+            except Exception as e:
+                result = False
+                error = str(e)
+                print(f"❌ Error en sincronización ({self.name}): {e}")
+            elapsed_ms = (time.perf_counter() - started) * 1000
+
+            with self._cond:
+                self._in_flight = False
+                self._done_id = self._run_id
+                self._last_run_at = time.monotonic()
+                self.stats['runs'] += 1
+                if periodic:
+                    self.stats['periodic_runs'] += 1
+                self.stats['last_latency_ms'] = round(elapsed_ms, 1)
+                self.stats['last_sync_at'] = time.time()
+                self.stats['last_result'] = result
+                self.stats['last_error'] = error
+                if not result:
+                    self.stats['failures'] += 1
+                    # Reintento: los cambios siguen pendientes
+                    if not self._dirty:
+                        self._first_dirty = self._last_dirty = time.monotonic()
+                    self._dirty = True
+                    self._not_before = time.monotonic() + SYNC_RETRY_SECONDS
+                self._cond.notify_all()
+
+    def get_stats(self):
+        """Latencia de la última sincronización y señales combinadas"""
+        with self._cond:
+            stats = dict(self.stats)
+            stats['pending'] = self._dirty
+            stats['in_flight'] = self._in_flight
+            stats['running'] = self._thread is not None and self._thread.is_alive()
+        stats['skipped'] = stats['merged'] + stats['merged_in_flight']
+        stats['debounce_seconds'] = self.debounce
+        stats['interval_seconds'] = self.interval
+        return stats
+
+
+if __name__ == "__main__":
+    # Demostración: diez cambios rápidos producen una sola subida
+    print("🧪 PROBANDO PLANIFICADOR DE SINCRONIZACIÓN")
+    uploads = []
+
+    def fake_upload():
+        uploads.append(time.monotonic())
+        time.sleep(0.3)
+        return True
+
+    scheduler = SyncScheduler(fake_upload, debounce=0.2, max_delay=1.0)
+    for _ in range(10):
+        scheduler.mark_dirty()
+        time.sleep(0.02)
+    time.sleep(0.35)
+    # Llegan durante la subida: se combinan en una sola subida posterior
+    for _ in range(5):
+        scheduler.mark_dirty()
+    print(f"⏳ sync_now: {scheduler.sync_now(timeout=5)}")
+    print(f"📤 Subidas: {len(uploads)}")
+    print(f"📊 Estadísticas: {scheduler.get_stats()}")
@@ -1,89 +1,704 @@
 """
 Sistema de Notificaciones por Telegram para Sistema de Tickets
 Versión completa con todas las funciones necesarias
+Los mensajes pasan por una bandeja de salida persistente (telegram_outbox) que
+procesa un pool fijo de workers con reintentos y backoff exponencial
 """
 
+import atexit
+import html
 import json
+import random
 import sqlite3
+import time
 from datetime import datetime
 import threading
 import ssl
 import urllib3
+from db_pool import db_connection
 urllib3.disable_warnings()
 
+# Configuración de la bandeja de salida
+OUTBOX_WORKERS = 2              # Workers que envían mensajes en paralelo
+OUTBOX_POLL_INTERVAL = 5.0      # Segundos entre revisiones de la tabla (reintentos y otros procesos)
+OUTBOX_MAX_ATTEMPTS = 8
+OUTBOX_BACKOFF_BASE = 2.0       # Segundos; se duplica en cada intento
+OUTBOX_BACKOFF_MAX = 600.0
+OUTBOX_STALE_SECONDS = 120      # Mensajes 'sending' huérfanos (proceso caído) vuelven a 'pending'
+OUTBOX_RETENTION_DAYS = 7       # Antigüedad de los mensajes enviados que se conservan
+OUTBOX_PURGE_INTERVAL = 3600    # Segundos entre podas de mensajes enviados
+HTTP_TIMEOUT = 10
+
+# Agrupación de eventos y límite de envío (configurables desde /admin/configure_telegram)
+COALESCE_WINDOW = 30            # Segundos en que se acumulan los eventos antes de enviarlos
+DIGEST_THRESHOLD = 3            # Tickets por ventana a partir de los cuales se envía un resumen
+DIGEST_MAX_LINES = 15
+RATE_PER_MINUTE = 20            # Mensajes por minuto y chat (límite de Telegram para grupos)
+RATE_BURST = 5
+
+# Caché de configuración
+CONFIG_REFRESH_INTERVAL = 10    # Segundos máximos hasta ver un cambio hecho por otro proceso
+CONFIG_VERSION_KEY = 'config_version'
+
+# Ajustes de entrega: nombre -> (clave en notification_config, valor por defecto, mínimo, máximo)
+DELIVERY_SETTINGS = {
+    'coalesce_window': ('telegram_coalesce_window', COALESCE_WINDOW, 0, 3600),
+    'digest_threshold': ('telegram_digest_threshold', DIGEST_THRESHOLD, 1, 1000),
+    'rate_per_minute': ('telegram_rate_per_minute', RATE_PER_MINUTE, 1, 1800),
+    'rate_burst': ('telegram_rate_burst', RATE_BURST, 1, 100),
+}
+
+PRIORITY_EMOJI = {
+    'Critical': '🔴',
+    'High': '🟠',
+    'Medium': '🟡',
+    'Low': '🟢'
+}
+
+STATUS_EMOJI = {
+    'Abierto': '🆕',
+    'En Progreso': '⚙️',
+    'Resuelto': '✅'
+}
+
+# Pool HTTP compartido por todos los envíos (conexiones keep-alive a api.telegram.org)
+_http = None
+_http_lock = threading.Lock()
+
+
+def get_http_pool():
+    """PoolManager único del proceso, creado la primera vez que se usa"""
+    global _http
+    with _http_lock:
+        if _http is None:
+            _http = urllib3.PoolManager(
+                num_pools=2,
+                maxsize=OUTBOX_WORKERS + 1,
+                block=False,
+                cert_reqs='CERT_NONE',
+                retries=False,
+                timeout=urllib3.Timeout(connect=5, read=HTTP_TIMEOUT)
+            )
+        return _http
+
+
+class TelegramDeliveryError(Exception):
+    """Fallo al enviar; retry_after indica la espera pedida por Telegram (HTTP 429)"""
+
+    def __init__(self, message, retryable=True, retry_after=None):
+        super().__init__(message)
+        self.retryable = retryable
+        self.retry_after = retry_after
+
+
+def install_outbox(conn):
+    """Crea la tabla de la bandeja de salida"""
+    cursor = conn.cursor()
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS telegram_outbox (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            kind TEXT NOT NULL,
+            message TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'pending',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            next_attempt_at REAL NOT NULL,
+            claimed_at REAL,
+            last_error TEXT,
+            created_at REAL NOT NULL,
+            sent_at REAL
+        )
+    ''')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_telegram_outbox_due
+        ON telegram_outbox (status, next_attempt_at)
+    ''')
+    conn.commit()
+
+
+class TelegramOutbox:
+    def __init__(self, notifier, workers=OUTBOX_WORKERS):
+        self.notifier = notifier
+        self.workers = workers
+        self._threads = []
+        self._cond = threading.Condition()
+        self._claim_lock = threading.Lock()
+        self._started = False
+        self._next_purge = 0.0
+
+        self.metrics = {
+            'enqueued': 0,
+            'sent': 0,
+            'failed': 0,
+            'retries': 0,
+            'rate_limited': 0,
+            'in_flight': 0,
+            'last_latency_ms': 0.0,
+            'total_latency_ms': 0.0,
+        }
+
+    def start(self):
+        """Inicia el pool fijo de workers (una sola vez)"""
+        with self._cond:
+            if self._started:
+                return
+            self._started = True
+        try:
+            with db_connection() as conn:
+                install_outbox(conn)
+        except Exception as e:
+            print(f"❌ Error creando bandeja de salida Telegram: {e}")
+        for index in range(self.workers):
+            thread = threading.Thread(target=self._worker, name=f'telegram-outbox-{index}', daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def enqueue(self, message, kind='message'):
+        """Guarda el mensaje en la bandeja; sobrevive a reinicios del proceso"""
+        self.start()
+        now = time.time()
+        with db_connection() as conn:
+            conn.execute('''
+                INSERT INTO telegram_outbox (kind, message, status, next_attempt_at, created_at)
+                VALUES (?, ?, 'pending', ?, ?)
+            ''', (kind, message, now, now))
+            conn.commit()
+        with self._cond:
+            self.metrics['enqueued'] += 1
+            self._cond.notify()
+        return True
+
+    def _claim(self):
+        """Toma el siguiente mensaje vencido y lo marca como 'sending'"""
+        now = time.time()
+        with self._claim_lock, db_connection() as conn:
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                # Recuperar mensajes de workers que murieron a mitad de envío
+                conn.execute('''
+                    UPDATE telegram_outbox SET status = 'pending'
+                    WHERE status = 'sending' AND claimed_at < ?
+                ''', (now - OUTBOX_STALE_SECONDS,))
+                row = conn.execute('''
+                    SELECT id, kind, message, attempts FROM telegram_outbox
+                    WHERE status = 'pending' AND next_attempt_at <= ?
+                    ORDER BY next_attempt_at, id
+                    LIMIT 1
+                ''', (now,)).fetchone()
+                if row:
+                    conn.execute('''
+                        UPDATE telegram_outbox
+                        SET status = 'sending', attempts = attempts + 1, claimed_at = ?
+                        WHERE id = ?
+                    ''', (now, row[0]))
+                    row = (row[0], row[1], row[2], row[3] + 1)
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+        return row
+
+    def _finish(self, outbox_id, status, error=None, next_attempt_at=None):
+        with db_connection() as conn:
+            if status == 'sent':
+                conn.execute('''
+                    UPDATE telegram_outbox SET status = 'sent', sent_at = ?, last_error = NULL
+                    WHERE id = ?
+                ''', (time.time(), outbox_id))
+            else:
+                conn.execute('''
+                    UPDATE telegram_outbox SET status = ?, last_error = ?, next_attempt_at = COALESCE(?, next_attempt_at)
+                    WHERE id = ?
+                ''', (status, error, next_attempt_at, outbox_id))
+            conn.commit()
+
+    @staticmethod
+    def backoff(attempts, retry_after=None):
+        """Espera antes del siguiente intento: retry_after de Telegram o exponencial con jitter"""
+        if retry_after:
+            return float(retry_after)
+        delay = min(OUTBOX_BACKOFF_BASE * (2 ** (attempts - 1)), OUTBOX_BACKOFF_MAX)
+        return delay * random.uniform(0.8, 1.2)
+
+    def _worker(self):
+        while True:
+            row = None
+            chat_id = self.notifier.chat_id
+            try:
+                if self.notifier.enabled:
+                    # El token se toma antes de reclamar un mensaje y se devuelve si no había ninguno
+                    self.notifier.rate_limiter.acquire(chat_id)
+                    row = self._claim()
+                    if row is None:
+                        self.notifier.rate_limiter.refund(chat_id)
+            except Exception as e:
+                print(f"❌ Error leyendo bandeja de salida Telegram: {e}")
+
+            if row is None:
+                self._purge_if_due()
+                with self._cond:
+                    self._cond.wait(OUTBOX_POLL_INTERVAL)
+                continue
+
+            self._process(*row)
+
+    def _process(self, outbox_id, kind, message, attempts):
+        with self._cond:
+            self.metrics['in_flight'] += 1
+        started = time.perf_counter()
+        try:
+            self.notifier.deliver(message)
+            elapsed_ms = (time.perf_counter() - started) * 1000
+            self._finish(outbox_id, 'sent')
+            with self._cond:
+                self.metrics['sent'] += 1
+                self.metrics['last_latency_ms'] = round(elapsed_ms, 1)
+                self.metrics['total_latency_ms'] += elapsed_ms
+            print(f"📱 Mensaje Telegram enviado ({kind} #{outbox_id})")
+        except TelegramDeliveryError as e:
+            if e.retryable and attempts < OUTBOX_MAX_ATTEMPTS:
+                delay = self.backoff(attempts, e.retry_after)
+                self._finish(outbox_id, 'pending', str(e), time.time() + delay)
+                if e.retry_after:
+                    # Todos los workers respetan la pausa pedida por Telegram
+                    self.notifier.rate_limiter.pause(self.notifier.chat_id, float(e.retry_after))
+                with self._cond:
+                    self.metrics['retries'] += 1
+                    if e.retry_after:
+                        self.metrics['rate_limited'] += 1
+                print(f"⚠️ Telegram: reintento de #{outbox_id} en {delay:.0f}s ({e})")
+            else:
+                self._finish(outbox_id, 'failed', str(e))
+                with self._cond:
+                    self.metrics['failed'] += 1
+                print(f"❌ Mensaje Telegram #{outbox_id} descartado tras {attempts} intentos: {e}")
+        except Exception as e:
+            print(f"❌ Error procesando mensaje Telegram #{outbox_id}: {e}")
+        finally:
+            with self._cond:
+                self.metrics['in_flight'] -= 1
+
+    def _purge_if_due(self):
+        """Poda los enviados como mucho una vez por OUTBOX_PURGE_INTERVAL (la tabla viaja en cada snapshot)"""
+        now = time.time()
+        with self._cond:
+            if now < self._next_purge:
+                return
+            self._next_purge = now + OUTBOX_PURGE_INTERVAL
+        try:
+            removed = self.purge()
+            if removed:
+                print(f"🗑️ {removed} mensajes Telegram enviados eliminados de la bandeja de salida")
+        except Exception as e:
+            print(f"❌ Error podando bandeja de salida Telegram: {e}")
+
+    def purge(self, days=OUTBOX_RETENTION_DAYS):
+        """Elimina los mensajes enviados más antiguos que `days` días"""
+        with db_connection() as conn:
+            cursor = conn.execute('''
+                DELETE FROM telegram_outbox WHERE status = 'sent' AND sent_at < ?
+            ''', (time.time() - days * 86400,))
+            conn.commit()
+            return cursor.rowcount
+
+    def get_metrics(self):
+        """Profundidad de la cola, latencia de envío y fallos"""
+        with self._cond:
+            metrics = dict(self.metrics)
+        sent = metrics['sent']
+        metrics['avg_latency_ms'] = round(metrics.pop('total_latency_ms') / sent, 1) if sent else 0.0
+        metrics['workers'] = self.workers
+        try:
+            with db_connection() as conn:
+                counts = dict(conn.execute('''
+                    SELECT status, COUNT(*) FROM telegram_outbox GROUP BY status
+                ''').fetchall())
+                oldest = conn.execute('''
+                    SELECT MIN(created_at) FROM telegram_outbox WHERE status IN ('pending', 'sending')
+                ''').fetchone()[0]
+        except sqlite3.Error:
+            counts, oldest = {}, None
+        metrics['queue_depth'] = counts.get('pending', 0) + counts.get('sending', 0)
+        metrics['failed_total'] = counts.get('failed', 0)
+        metrics['oldest_pending_seconds'] = round(time.time() - oldest, 1) if oldest else 0
+        return metrics
+
+
+class TokenBucket:
+    """Límite de envío por chat: `rate_per_minute` mensajes con ráfagas de hasta `burst`"""
+
+    def __init__(self, rate_per_minute=RATE_PER_MINUTE, burst=RATE_BURST):
+        self._lock = threading.Lock()
+        self._buckets = {}
+        self.configure(rate_per_minute, burst)
+
+    def configure(self, rate_per_minute, burst):
+        with self._lock:
+            self.rate = rate_per_minute / 60.0
+            self.burst = float(burst)
+
+    def _refill(self, key, now):
+        tokens, updated = self._buckets.get(key, (self.burst, now))
+        tokens = min(self.burst, tokens + (now - updated) * self.rate)
+        return tokens
+
+    def reserve(self, key):
+        """Toma un token si hay; si no, devuelve los segundos que faltan para el próximo"""
+        with self._lock:
+            now = time.monotonic()
+            tokens = self._refill(key, now)
+            if tokens >= 1:
+                self._buckets[key] = (tokens - 1, now)
+                return 0.0
+            self._buckets[key] = (tokens, now)
+            return (1 - tokens) / self.rate
+
+    def acquire(self, key):
+        """Bloquea hasta obtener un token"""
+        while True:
+            wait = self.reserve(key)
+            if wait <= 0:
+                return
+            time.sleep(wait)
+
+    def refund(self, key):
+        with self._lock:
+            now = time.monotonic()
+            self._buckets[key] = (min(self.burst, self._refill(key, now) + 1), now)
+
+    def pause(self, key, seconds):
+        """Vacía el balde para que el próximo token llegue dentro de `seconds` (HTTP 429)"""
+        with self._lock:
+            self._buckets[key] = (1 - seconds * self.rate, time.monotonic())
+
+    def get_state(self, key):
+        with self._lock:
+            return round(self._refill(key, time.monotonic()), 2)
+
+
+class NotificationCoalescer:
+    """Acumula eventos por ticket durante una ventana y los envía combinados
+
+    Si en una ventana cambian muchos tickets se envía un único resumen en lugar
+    de un mensaje por ticket. Los eventos viven en memoria hasta el envío; al
+    salir del proceso se vacía la ventana en la bandeja de salida.
+    """
+
+    def __init__(self, notifier, window=COALESCE_WINDOW, digest_threshold=DIGEST_THRESHOLD):
+        self.notifier = notifier
+        self.window = window
+        self.digest_threshold = digest_threshold
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._timer = None
+
+        self.metrics = {
+            'events': 0,
+            'messages': 0,
+            'digests': 0,
+        }
+
+    def configure(self, window, digest_threshold):
+        with self._lock:
+            self.window = window
+            self.digest_threshold = digest_threshold
+
+    def add(self, ticket_id, event, **fields):
+        """Registra un evento ('new', 'update' o 'comment') de un ticket"""
+        with self._lock:
+            self.metrics['events'] += 1
+            state = self._pending.get(ticket_id)
+            if state is None:
+                state = self._pending[ticket_id] = {
+                    'ticket_id': ticket_id,
+                    'title': fields.get('title'),
+                    'created': False,
+                    'old_status': None,
+                    'new_status': None,
+                    'assigned_to': None,
+                    'comment_authors': [],
+                }
+            state['title'] = fields.get('title') or state['title']
+
+            if event == 'new':
+                state['created'] = True
+                state.update(username=fields.get('username'),
+                             priority=fields.get('priority'),
+                             category=fields.get('category'))
+            elif event == 'update':
+                if state['old_status'] is None:
+                    state['old_status'] = fields.get('old_status')
+                state['new_status'] = fields.get('new_status')
+                state['assigned_to'] = fields.get('assigned_to') or state['assigned_to']
+            elif event == 'comment':
+                state['comment_authors'].append(fields.get('comment_author'))
+
+            if self.window <= 0:
+                immediate = True
+            else:
+                immediate = False
+                if self._timer is None:
+                    self._timer = threading.Timer(self.window, self.flush)
+                    self._timer.daemon = True
+                    self._timer.start()
+
+        if immediate:
+            self.flush()
+        return True
+
+    def flush(self):
+        """Envía a la bandeja de salida lo acumulado en la ventana actual"""
+        with self._lock:
+            pending, self._pending = list(self._pending.values()), {}
+            self._timer = None
+            threshold = self.digest_threshold
+        if not pending:
+            return
+
+        if len(pending) >= threshold:
+            self.notifier.send_message(self.notifier.format_digest(pending), kind='digest')
+            with self._lock:
+                self.metrics['digests'] += 1
+                self.metrics['messages'] += 1
+            return
+
+        for state in pending:
+            kind, message = self.notifier.format_coalesced(state)
+            self.notifier.send_message(message, kind=kind)
+            with self._lock:
+                self.metrics['messages'] += 1
+
+    def get_metrics(self):
+        with self._lock:
+            metrics = dict(self.metrics)
+            metrics['pending_tickets'] = len(self._pending)
+            metrics['window_seconds'] = self.window
+            metrics['digest_threshold'] = self.digest_threshold
+        return metrics
+
+
+class TelegramConfig:
+    """Foto inmutable de notification_config
+
+    Se reemplaza completa cuando cambia la versión en la base de datos, así los
+    workers siempre ven token, chat y ajustes de una misma versión.
+    """
+
+    def __init__(self, values=None, version=0):
+        self.values = dict(values or {})
+        self.version = version
+        self.method = self.values.get('notification_method', 'none')
+        self.bot_token = self.values.get('telegram_token')
+        self.chat_id = self.values.get('telegram_chat_id')
+        self.enabled = self.method == 'telegram' and bool(self.bot_token and self.chat_id)
+        self.delivery = parse_delivery_settings(self.values)
+        self.loaded_at = time.time()
+
+
+def parse_delivery_settings(values):
+    """Ventana, umbral de resumen y límite de envío, acotados a DELIVERY_SETTINGS"""
+    delivery = {}
+    for name, (config_key, default, minimum, maximum) in DELIVERY_SETTINGS.items():
+        try:
+            value = int(values.get(config_key, default))
+        except (TypeError, ValueError):
+            value = default
+        delivery[name] = max(minimum, min(maximum, value))
+    return delivery
+
+
+def _bump_config_version():
+    """SQL que incrementa el contador de cambios de notification_config"""
+    return f"""
+        INSERT INTO notification_config (key, value, updated_at)
+        VALUES ('{CONFIG_VERSION_KEY}', '1', CURRENT_TIMESTAMP)
+        ON CONFLICT(key) DO UPDATE SET value = CAST(value AS INTEGER) + 1, updated_at = CURRENT_TIMESTAMP;"""
+
+
+# Cualquier escritura en notification_config (de este u otro proceso) sube la versión
+CONFIG_TRIGGERS = {
+    'notification_config_version_insert':
+        f"AFTER INSERT ON notification_config WHEN NEW.key != '{CONFIG_VERSION_KEY}' "
+        f"BEGIN{_bump_config_version()}\n    END",
+    'notification_config_version_update':
+        f"AFTER UPDATE ON notification_config WHEN NEW.key != '{CONFIG_VERSION_KEY}' "
+        f"BEGIN{_bump_config_version()}\n    END",
+    'notification_config_version_delete':
+        f"AFTER DELETE ON notification_config WHEN OLD.key != '{CONFIG_VERSION_KEY}' "
+        f"BEGIN{_bump_config_version()}\n    END",
+}
+
+
+def install_config(conn):
+    """Crea notification_config y los triggers del contador de versión"""
+    cursor = conn.cursor()
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS notification_config (
+            key TEXT PRIMARY KEY,
+            value TEXT,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    for name, body in CONFIG_TRIGGERS.items():
+        cursor.execute(f'CREATE TRIGGER IF NOT EXISTS {name} {body}')
+    conn.commit()
+
+
+def _parse_version(value):
+    try:
+        return int(value or 0)
+    except (TypeError, ValueError):
+        return 0
+
+
+def read_config_version(conn):
+    """Versión actual de la configuración (0 si nunca se guardó)"""
+    row = conn.execute('SELECT value FROM notification_config WHERE key = ?', (CONFIG_VERSION_KEY,)).fetchone()
+    return _parse_version(row[0] if row else None)
+
+
 class TelegramNotifier:
     def __init__(self):
-        self.enabled = False
-        self.bot_token = None
-        self.chat_id = None
+        self.config = TelegramConfig()
+        self.rate_limiter = TokenBucket()
+        self.coalescer = NotificationCoalescer(self)
+        self.outbox = TelegramOutbox(self)
+        self._config_lock = threading.Lock()
+        self._config_installed = False
+        self._watcher = None
+
+        self.config_metrics = {
+            'checks': 0,
+            'reloads': 0,
+            'errors': 0,
+            'last_check': None,
+        }
         self.load_config()
-    
+
+    # La configuración se lee siempre de la foto en memoria, nunca de SQLite
+    @property
+    def enabled(self):
+        return self.config.enabled
+
+    @property
+    def bot_token(self):
+        return self.config.bot_token
+
+    @property
+    def chat_id(self):
+        return self.config.chat_id
+
+    @property
+    def delivery(self):
+        return self.config.delivery
+
     def load_config(self):
-        """Cargar configuración de notificaciones desde base de datos"""
+        """Carga notification_config completa en una nueva foto en memoria"""
         try:
-            conn = sqlite3.connect('tickets.db')
-            cursor = conn.cursor()
-            
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS notification_config (
-                    key TEXT PRIMARY KEY,
-                    value TEXT,
-                    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                )
-            ''')
+            with db_connection() as conn:
+                if not self._config_installed:
+                    install_config(conn)
+                    self._config_installed = True
+                values = dict(conn.execute('SELECT key, value FROM notification_config').fetchall())
+            version = _parse_version(values.get(CONFIG_VERSION_KEY))
+            self.apply_config(TelegramConfig(values, version))
             
-            cursor.execute('SELECT key, value FROM notification_config WHERE key IN (?, ?, ?)', 
-                          ('notification_method', 'telegram_token', 'telegram_chat_id'))
-            config = dict(cursor.fetchall())
-            
-            if config.get('notification_method') == 'telegram':
-                self.bot_token = config.get('telegram_token')
-                self.chat_id = config.get('telegram_chat_id')
-                self.enabled = bool(self.bot_token and self.chat_id)
-                
-                if self.enabled:
-                    print("✅ Notificaciones Telegram habilitadas")
-                else:
-                    print("⚠️ Telegram configurado pero falta token o chat_id")
+        except Exception as e:
+            print(f"❌ Error cargando configuración Telegram: {e}")
+            with self._config_lock:
+                self.config_metrics['errors'] += 1
+    
+    def apply_config(self, config):
+        """Reemplaza la foto actual y ajusta agrupación, límite de envío y workers"""
+        with self._config_lock:
+            previous, self.config = self.config, config
+            self.config_metrics['reloads'] += 1
+        
+        if config.delivery != previous.delivery or previous.version == 0:
+            self.apply_delivery_settings(config.delivery)
+        
+        if config.enabled != previous.enabled or previous.version == 0:
+            if config.enabled:
+                print("✅ Notificaciones Telegram habilitadas")
+                if self._watcher is not None:
+                    # Habilitado desde el panel o desde otro proceso
+                    self.outbox.start()
+            elif config.method == 'telegram':
+                print("⚠️ Telegram configurado pero falta token o chat_id")
             else:
                 print("ℹ️ Notificaciones Telegram deshabilitadas")
-            
-            conn.close()
-            
+    
+    def check_config(self):
+        """Recarga la configuración solo si la versión en la base de datos cambió"""
+        try:
+            with db_connection() as conn:
+                version = read_config_version(conn)
+            with self._config_lock:
+                self.config_metrics['checks'] += 1
+                self.config_metrics['last_check'] = time.time()
+            if version != self.config.version:
+                self.load_config()
         except Exception as e:
-            print(f"❌ Error cargando configuración Telegram: {e}")
-            self.enabled = False
+            print(f"❌ Error revisando versión de configuración Telegram: {e}")
+            with self._config_lock:
+                self.config_metrics['errors'] += 1
+    
+    def start_config_watcher(self, interval=CONFIG_REFRESH_INTERVAL):
+        """Hilo que revisa el contador de cambios cada `interval` segundos
+
+        Otros procesos ven un cambio de configuración como máximo `interval`
+        segundos después de guardado.
+        """
+        if self._watcher is not None:
+            return
+        
+        def watch():
+            while True:
+                time.sleep(interval)
+                self.check_config()
+        
+        self._watcher = threading.Thread(target=watch, name='telegram-config', daemon=True)
+        self._watcher.start()
+    
+    def apply_delivery_settings(self, delivery):
+        """Aplica ventana, umbral de resumen y límite de envío"""
+        self.coalescer.configure(delivery['coalesce_window'], delivery['digest_threshold'])
+        self.rate_limiter.configure(delivery['rate_per_minute'], delivery['rate_burst'])
     
-    def save_config(self, method, telegram_token=None, telegram_chat_id=None):
-        """Guardar configuración de notificaciones"""
+    def save_config(self, method, telegram_token=None, telegram_chat_id=None, **delivery):
+        """Guardar configuración de notificaciones
+
+        delivery acepta los ajustes de DELIVERY_SETTINGS (coalesce_window,
+        digest_threshold, rate_per_minute, rate_burst). Los triggers suben la
+        versión y este proceso recarga de inmediato; los demás en su próxima revisión.
+        """
         try:
-            conn = sqlite3.connect('tickets.db')
-            cursor = conn.cursor()
-            
-            cursor.execute('''
-                INSERT OR REPLACE INTO notification_config (key, value, updated_at)
-                VALUES ('notification_method', ?, CURRENT_TIMESTAMP)
-            ''', (method,))
+            with db_connection() as conn:
+                cursor = conn.cursor()
             
-            if method == 'telegram' and telegram_token and telegram_chat_id:
-                cursor.execute('''
-                    INSERT OR REPLACE INTO notification_config (key, value, updated_at)
-                    VALUES ('telegram_token', ?, CURRENT_TIMESTAMP)
-                ''', (telegram_token,))
-                
                 cursor.execute('''
                     INSERT OR REPLACE INTO notification_config (key, value, updated_at)
-                    VALUES ('telegram_chat_id', ?, CURRENT_TIMESTAMP)
-                ''', (telegram_chat_id,))
+                    VALUES ('notification_method', ?, CURRENT_TIMESTAMP)
+                ''', (method,))
+            
+                for name, value in delivery.items():
+                    if name in DELIVERY_SETTINGS and value is not None:
+                        cursor.execute('''
+                            INSERT OR REPLACE INTO notification_config (key, value, updated_at)
+                            VALUES (?, ?, CURRENT_TIMESTAMP)
+                        ''', (DELIVERY_SETTINGS[name][0], str(int(value))))
+            
+                if method == 'telegram' and telegram_token and telegram_chat_id:
+                    cursor.execute('''
+                        INSERT OR REPLACE INTO notification_config (key, value, updated_at)
+                        VALUES ('telegram_token', ?, CURRENT_TIMESTAMP)
+                    ''', (telegram_token,))
                 
-                self.bot_token = telegram_token
-                self.chat_id = telegram_chat_id
-                self.enabled = True
-            elif method == 'none':
-                self.enabled = False
+                    cursor.execute('''
+                        INSERT OR REPLACE INTO notification_config (key, value, updated_at)
+                        VALUES ('telegram_chat_id', ?, CURRENT_TIMESTAMP)
+                    ''', (telegram_chat_id,))
             
-            conn.commit()
-            conn.close()
+                conn.commit()
             self.load_config()
             return True
             
@@ -92,78 +707,70 @@ class TelegramNotifier:
             return False
     
     def get_config(self):
-        """Obtener configuración actual"""
-        try:
-            conn = sqlite3.connect('tickets.db')
-            cursor = conn.cursor()
-            cursor.execute('SELECT key, value FROM notification_config')
-            config = dict(cursor.fetchall())
-            conn.close()
-            return config
-        except Exception as e:
-            print(f"❌ Error obteniendo configuración: {e}")
-            return {}
+        """Obtener configuración actual (copia de la foto en memoria)"""
+        return dict(self.config.values)
+    
+    def get_config_status(self):
+        """Versión cargada y actividad del watcher"""
+        config = self.config
+        with self._config_lock:
+            status = dict(self.config_metrics)
+        status['version'] = config.version
+        status['loaded_at'] = config.loaded_at
+        status['refresh_interval'] = CONFIG_REFRESH_INTERVAL
+        return status
     
-    def send_message(self, message):
-        """Enviar mensaje a Telegram usando urllib3"""
+    def send_message(self, message, kind='message'):
+        """Encola un mensaje en la bandeja de salida; lo envía un worker"""
         if not self.enabled:
             return False
         
         try:
-            import urllib3
-            import json
-            
-            # Crear pool manager sin verificación SSL
-            http = urllib3.PoolManager(
-                cert_reqs='CERT_NONE',
-                ca_certs=None,
-                ssl_version=None
-            )
-            
-            url = f"https://api.telegram.org/bot{self.bot_token}/sendMessage"
-            payload = {
-                'chat_id': self.chat_id,
-                'text': message,
-                'parse_mode': 'HTML'
-            }
-            
-            # Enviar petición
-            response = http.request(
+            return self.outbox.enqueue(message, kind)
+        except Exception as e:
+            print(f"❌ Error encolando mensaje Telegram: {e}")
+            return False
+    
+    def deliver(self, message):
+        """Envía un mensaje a Telegram (llamado desde los workers)
+
+        Lanza TelegramDeliveryError; retry_after viene de la respuesta 429 de Telegram.
+        """
+        url = f"https://api.telegram.org/bot{self.bot_token}/sendMessage"
+        payload = {
+            'chat_id': self.chat_id,
+            'text': message,
+            'parse_mode': 'HTML'
+        }
+        
+        try:
+            response = get_http_pool().request(
                 'POST',
                 url,
                 body=json.dumps(payload),
-                headers={'Content-Type': 'application/json'},
-                timeout=10
+                headers={'Content-Type': 'application/json'}
             )
-            
-            if response.status == 200:
-                data = json.loads(response.data.decode('utf-8'))
-                if data['ok']:
-                    print(f"📱 Mensaje Telegram enviado exitosamente")
-                    return True
-                else:
-                    print(f"❌ Error API Telegram: {data.get('description', 'Unknown')}")
-                    return False
-            else:
-                print(f"❌ Error HTTP Telegram: {response.status}")
-                return False
-                
-        except Exception as e:
-            print(f"❌ Error enviando mensaje Telegram: {e}")
-            return False
-    
-    def notify_new_ticket(self, ticket_id, title, username, priority, category):
-        """Notificar nuevo ticket"""
-        if not self.enabled:
-            return False
+        except urllib3.exceptions.HTTPError as e:
+            raise TelegramDeliveryError(f"Error de red: {e}")
         
-        # Emojis por prioridad
-        priority_emoji = {
-            'Critical': '🔴',
-            'High': '🟠', 
-            'Medium': '🟡',
-            'Low': '🟢'
-        }
+        try:
+            data = json.loads(response.data.decode('utf-8'))
+        except ValueError:
+            data = {}
+        
+        if response.status == 200 and data.get('ok'):
+            return True
+        
+        description = data.get('description', f'HTTP {response.status}')
+        if response.status == 429:
+            retry_after = (data.get('parameters') or {}).get('retry_after') or response.headers.get('Retry-After')
+            raise TelegramDeliveryError(f"Límite de Telegram: {description}", retry_after=retry_after or 30)
+        # 5xx es transitorio; los demás 4xx (token o chat inválidos) no mejoran reintentando
+        raise TelegramDeliveryError(f"Error API Telegram: {description}", retryable=response.status >= 500)
+    
+    def format_new_ticket(self, ticket_id, title, username, priority, category):
+        """Mensaje de nuevo ticket"""
+        emoji_priority = PRIORITY_EMOJI.get(priority, '📋')
         
         # Emojis por categoría
         category_emoji = {
@@ -175,10 +782,9 @@ class TelegramNotifier:
             'Seguridad': '🔒'
         }
         
-        emoji_priority = priority_emoji.get(priority, '📋')
         emoji_category = category_emoji.get(category, '📋')
         
-        message = f"""🎫 <b>NUEVO TICKET</b>
+        return f"""🎫 <b>NUEVO TICKET</b>
 
 {emoji_priority} <b>Ticket #{ticket_id}</b>
 📝 <b>Título:</b> {title}
@@ -189,23 +795,11 @@ class TelegramNotifier:
 🕒 <b>Creado:</b> {datetime.now().strftime('%d/%m/%Y %H:%M')}
 
 💡 <i>Accede al sistema para gestionar este ticket</i>"""
-        
-        return self.send_message(message)
     
-    def notify_ticket_update(self, ticket_id, title, old_status, new_status, assigned_to=None):
-        """Notificar actualización de ticket"""
-        if not self.enabled:
-            return False
-        
-        # Emojis por estado
-        status_emoji = {
-            'Abierto': '🆕',
-            'En Progreso': '⚙️',
-            'Resuelto': '✅'
-        }
-        
-        emoji_old = status_emoji.get(old_status, '📋')
-        emoji_new = status_emoji.get(new_status, '📋')
+    def format_ticket_update(self, ticket_id, title, old_status, new_status, assigned_to=None):
+        """Mensaje de actualización de ticket"""
+        emoji_old = STATUS_EMOJI.get(old_status, '📋')
+        emoji_new = STATUS_EMOJI.get(new_status, '📋')
         
         message = f"""🔄 <b>TICKET ACTUALIZADO</b>
 
@@ -218,15 +812,11 @@ class TelegramNotifier:
             message += f"\n👤 <b>Asignado a:</b> {assigned_to}"
         
         message += f"\n\n🕒 <b>Actualizado:</b> {datetime.now().strftime('%d/%m/%Y %H:%M')}"
-        
-        return self.send_message(message)
+        return message
     
-    def notify_ticket_comment(self, ticket_id, title, comment_author):
-        """Notificar nuevo comentario"""
-        if not self.enabled:
-            return False
-        
-        message = f"""💬 <b>NUEVO COMENTARIO</b>
+    def format_ticket_comment(self, ticket_id, title, comment_author):
+        """Mensaje de nuevo comentario"""
+        return f"""💬 <b>NUEVO COMENTARIO</b>
 
 📋 <b>Ticket #{ticket_id}</b>
 📝 <b>Título:</b> {title}
@@ -235,8 +825,107 @@ class TelegramNotifier:
 🕒 <b>Fecha:</b> {datetime.now().strftime('%d/%m/%Y %H:%M')}
 
 💡 <i>Revisa el ticket para ver el comentario completo</i>"""
+    
+    def format_coalesced(self, state):
+        """Un mensaje con todos los eventos de un ticket en la ventana; devuelve (tipo, mensaje)"""
+        ticket_id, title = state['ticket_id'], state['title']
+        authors = [str(author) for author in state['comment_authors']]
+        comments_line = ''
+        if authors and (state['created'] or state['new_status'] or len(authors) > 1):
+            comments_line = f"\n💬 <b>{len(authors)} comentario(s) de:</b> {', '.join(sorted(set(authors)))}"
+        
+        if state['created']:
+            message = self.format_new_ticket(ticket_id, title, state.get('username'),
+                                             state.get('priority'), state.get('category'))
+            if state['new_status']:
+                message += f"\n\n{STATUS_EMOJI.get(state['new_status'], '📋')} <b>Estado actual:</b> {state['new_status']}"
+            return 'new_ticket', message + comments_line
+        
+        if state['new_status']:
+            message = self.format_ticket_update(ticket_id, title, state['old_status'],
+                                                state['new_status'], state['assigned_to'])
+            return 'ticket_update', message + comments_line
         
-        return self.send_message(message)
+        if len(authors) == 1:
+            return 'ticket_comment', self.format_ticket_comment(ticket_id, title, authors[0])
+        
+        return 'ticket_comment', f"""💬 <b>NUEVOS COMENTARIOS</b>
+
+📋 <b>Ticket #{ticket_id}</b>
+📝 <b>Título:</b> {title}{comments_line}
+
+🕒 <b>Fecha:</b> {datetime.now().strftime('%d/%m/%Y %H:%M')}"""
+    
+    def format_digest(self, states):
+        """Resumen de una ventana con muchos tickets: '12 tickets actualizados, 3 críticos'"""
+        priorities = {}
+        try:
+            # Las actualizaciones no traen la prioridad: una sola consulta para todo el resumen
+            ids = [state['ticket_id'] for state in states]
+            with db_connection() as conn:
+                rows = conn.execute(f'SELECT id, priority FROM tickets WHERE id IN ({", ".join("?" * len(ids))})',
+                                    ids).fetchall()
+            priorities = dict(rows)
+        except Exception as e:
+            print(f"⚠️ No se pudieron leer prioridades para el resumen: {e}")
+        
+        created = sum(1 for state in states if state['created'])
+        updated = sum(1 for state in states if state['new_status'] and not state['created'])
+        comments = sum(len(state['comment_authors']) for state in states)
+        critical = sum(1 for state in states
+                       if (state.get('priority') or priorities.get(state['ticket_id'])) == 'Critical')
+        
+        summary = [f"{len(states)} tickets con cambios"]
+        if created:
+            summary.append(f"{created} nuevos")
+        if updated:
+            summary.append(f"{updated} actualizados")
+        if comments:
+            summary.append(f"{comments} comentarios")
+        if critical:
+            summary.append(f"{critical} críticos")
+        
+        lines = []
+        for state in states[:DIGEST_MAX_LINES]:
+            priority = state.get('priority') or priorities.get(state['ticket_id'])
+            line = f"{PRIORITY_EMOJI.get(priority, '📋')} #{state['ticket_id']} {html.escape(str(state['title'] or ''))}"
+            if state['created']:
+                line += " (nuevo)"
+            if state['new_status']:
+                line += f" → {STATUS_EMOJI.get(state['new_status'], '')} {state['new_status']}"
+            if state['comment_authors']:
+                line += f" 💬{len(state['comment_authors'])}"
+            lines.append(line)
+        if len(states) > DIGEST_MAX_LINES:
+            lines.append(f"… y {len(states) - DIGEST_MAX_LINES} más")
+        
+        return f"""🗂️ <b>RESUMEN DE TICKETS</b>
+
+📊 {', '.join(summary)}
+
+""" + '\n'.join(lines) + f"""
+
+🕒 <b>Fecha:</b> {datetime.now().strftime('%d/%m/%Y %H:%M')}"""
+    
+    def notify_new_ticket(self, ticket_id, title, username, priority, category):
+        """Notificar nuevo ticket (se agrupa con otros eventos de la ventana)"""
+        if not self.enabled:
+            return False
+        return self.coalescer.add(ticket_id, 'new', title=title, username=username,
+                                  priority=priority, category=category)
+    
+    def notify_ticket_update(self, ticket_id, title, old_status, new_status, assigned_to=None):
+        """Notificar actualización de ticket (se agrupa con otros eventos de la ventana)"""
+        if not self.enabled:
+            return False
+        return self.coalescer.add(ticket_id, 'update', title=title, old_status=old_status,
+                                  new_status=new_status, assigned_to=assigned_to)
+    
+    def notify_ticket_comment(self, ticket_id, title, comment_author):
+        """Notificar nuevo comentario (se agrupa con otros eventos de la ventana)"""
+        if not self.enabled:
+            return False
+        return self.coalescer.add(ticket_id, 'comment', title=title, comment_author=comment_author)
     
     def test_telegram_connection(self):
         """Probar conexión con Telegram usando urllib3"""
@@ -244,19 +933,9 @@ class TelegramNotifier:
             return False, "Telegram no configurado"
         
         try:
-            import urllib3
-            import json
-            
-            # Crear pool manager sin verificación SSL
-            http = urllib3.PoolManager(
-                cert_reqs='CERT_NONE',
-                ca_certs=None,
-                ssl_version=None
-            )
-            
             url = f"https://api.telegram.org/bot{self.bot_token}/getMe"
             
-            response = http.request('GET', url, timeout=10)
+            response = get_http_pool().request('GET', url)
             
             if response.status == 200:
                 data = json.loads(response.data.decode('utf-8'))
@@ -286,27 +965,33 @@ class TelegramNotifier:
 
 💡 <i>Las notificaciones están funcionando correctamente</i>"""
         
-        success = self.send_message(test_message)
-        
-        if success:
+        # La prueba se envía directo para informar el resultado real
+        try:
+            self.deliver(test_message)
             return True, "Mensaje de prueba enviado exitosamente"
-        else:
-            return False, "Error enviando mensaje de prueba"
+        except TelegramDeliveryError as e:
+            return False, f"Error enviando mensaje de prueba: {e}"
 
 # Función de ayuda para enviar notificaciones en background
 def send_notification_async(notification_func, *args, **kwargs):
-    """Enviar notificación en background thread para no bloquear la app"""
-    def worker():
-        try:
-            notification_func(*args, **kwargs)
-        except Exception as e:
-            print(f"❌ Error en notificación background: {e}")
-    
-    thread = threading.Thread(target=worker, daemon=True)
-    thread.start()
+    """Encola la notificación; el envío lo hacen los workers de la bandeja de salida
+
+    Ya no se crea un hilo por notificación: encolar es una escritura local rápida.
+    """
+    try:
+        notification_func(*args, **kwargs)
+    except Exception as e:
+        print(f"❌ Error en notificación background: {e}")
 
 # Instancia global del notificador
 telegram_notifier = TelegramNotifier()
+if telegram_notifier.enabled:
+    # Retoma los mensajes pendientes de ejecuciones anteriores
+    telegram_notifier.outbox.start()
+# Recoge los cambios de configuración guardados por otros procesos
+telegram_notifier.start_config_watcher()
+# Los eventos aún en la ventana de agrupación pasan a la bandeja persistente al salir
+atexit.register(telegram_notifier.coalescer.flush)
 
 # Funciones de conveniencia para usar en app_simple.py
 def notify_new_ticket_async(ticket_id, title, username, priority, category):
@@ -335,6 +1020,10 @@ def configure_notifications(method, **kwargs):
     """Configurar sistema de notificaciones"""
     return telegram_notifier.save_config(method, **kwargs)
 
+def get_delivery_settings():
+    """Ventana de agrupación, umbral de resumen y límite de envío actuales"""
+    return dict(telegram_notifier.delivery)
+
 def get_notification_config():
     """Obtener configuración actual"""
     return telegram_notifier.get_config()
@@ -347,9 +1036,17 @@ def send_telegram_test():
     """Enviar mensaje de prueba"""
     return telegram_notifier.send_test_message()
 
+def get_outbox_metrics():
+    """Métricas de la bandeja de salida (panel de administración)"""
+    metrics = telegram_notifier.outbox.get_metrics()
+    metrics['coalescer'] = telegram_notifier.coalescer.get_metrics()
+    metrics['rate_tokens'] = telegram_notifier.rate_limiter.get_state(telegram_notifier.chat_id)
+    metrics['config'] = telegram_notifier.get_config_status()
+    return metrics
+
 # Función de compatibilidad para app_simple.py
 def send_telegram_notification(message):
-    """Función de compatibilidad - envía mensaje directo"""
+    """Función de compatibilidad - encola el mensaje en la bandeja de salida (no informa del envío real)"""
     return telegram_notifier.send_message(message)
 
 if __name__ == "__main__":
@@ -0,0 +1,200 @@
+"""
+Búsqueda de texto completo del Sistema de Tickets
+Índice FTS5 sobre título, descripción y comentarios, mantenido por triggers
+"""
+
+import html
+import re
+import sqlite3
+import sys
+
+from db_pool import db_connection
+
+# Configuración
+SEARCH_LIMIT = 20
+SEARCH_LIMIT_MAX = 50
+SNIPPET_TOKENS = 12
+# Peso de cada columna en bm25: título > descripción > comentarios
+BM25_WEIGHTS = (10.0, 4.0, 1.0)
+SEARCH_FILTERS = ('status', 'category', 'priority')
+
+# Marcadores internos del snippet; se reemplazan tras escapar el HTML
+MARK_START = '\x02'
+MARK_END = '\x03'
+
+COMMENTS_TEXT = "(SELECT IFNULL(group_concat(comment, ' '), '') FROM comments WHERE ticket_id = {ticket})"
+
+
+def _reindex_comments(ticket):
+    """SQL que recalcula el texto de comentarios indexado de un ticket"""
+    return f"""
+        UPDATE ticket_search SET comments = {COMMENTS_TEXT.format(ticket=ticket)} WHERE rowid = {ticket};"""
+
+
+SEARCH_TRIGGERS = {
+    'search_tickets_insert': """AFTER INSERT ON tickets BEGIN
+        INSERT INTO ticket_search (rowid, title, description, comments)
+        VALUES (NEW.id, NEW.title, NEW.description, '');
+    END""",
+    'search_tickets_delete': """AFTER DELETE ON tickets BEGIN
+        DELETE FROM ticket_search WHERE rowid = OLD.id;
+    END""",
+    'search_tickets_update': """AFTER UPDATE OF title, description ON tickets BEGIN
+        UPDATE ticket_search SET title = NEW.title, description = NEW.description WHERE rowid = NEW.id;
+    END""",
+    'search_comments_insert': f"AFTER INSERT ON comments BEGIN{_reindex_comments('NEW.ticket_id')}\n    END",
+    'search_comments_delete': f"AFTER DELETE ON comments BEGIN{_reindex_comments('OLD.ticket_id')}\n    END",
+    'search_comments_update': (
+        "AFTER UPDATE OF comment, ticket_id ON comments "
+        f"BEGIN{_reindex_comments('OLD.ticket_id')}{_reindex_comments('NEW.ticket_id')}\n    END"
+    ),
+}
+
+
+class SearchUnavailableError(Exception):
+    """SQLite compilado sin FTS5"""
+
+
+def install_search(conn):
+    """Crea el índice FTS5 y sus triggers; lo llena si es nuevo
+
+    Devuelve False si la versión de SQLite no incluye FTS5.
+    """
+    cursor = conn.cursor()
+    cursor.execute("SELECT 1 FROM sqlite_master WHERE name = 'ticket_search'")
+    exists = cursor.fetchone() is not None
+
+    try:
+        cursor.execute('''
+            CREATE VIRTUAL TABLE IF NOT EXISTS ticket_search USING fts5(
+                title, description, comments,
+                tokenize = 'unicode61 remove_diacritics 2'
+            )
+        ''')
+    except sqlite3.OperationalError as e:
+        print(f"⚠️ Búsqueda de texto completo no disponible (FTS5): {e}")
+        return False
+
+    for name, body in SEARCH_TRIGGERS.items():
+        cursor.execute(f'CREATE TRIGGER IF NOT EXISTS {name} {body}')
+
+    if not exists:
+        rebuild_search(conn)
+    conn.commit()
+    return True
+
+
+def rebuild_search(conn):
+    """Reconstruye el índice completo desde tickets y comentarios (dentro de la transacción actual)"""
+    cursor = conn.cursor()
+    cursor.execute('DELETE FROM ticket_search')
+    cursor.execute(f'''
+        INSERT INTO ticket_search (rowid, title, description, comments)
+        SELECT t.id, t.title, t.description, {COMMENTS_TEXT.format(ticket='t.id')}
+        FROM tickets t
+    ''')
+    cursor.execute("INSERT INTO ticket_search (ticket_search) VALUES ('optimize')")
+
+
+def build_match_query(text):
+    """Convierte el texto del usuario en una consulta FTS5 segura
+
+    Cada palabra se busca como término literal (entre comillas) y la última
+    como prefijo, para que la búsqueda funcione mientras se escribe.
+    """
+    terms = re.findall(r'\w+', text or '')
+    if not terms:
+        return None
+    quoted = [f'"{term}"' for term in terms]
+    quoted[-1] += '*'
+    return ' '.join(quoted)
+
+
+def _highlight(fragment):
+    """Escapa el HTML del snippet y convierte los marcadores en <mark>"""
+    escaped = html.escape(fragment or '')
+    return escaped.replace(MARK_START, '<mark>').replace(MARK_END, '</mark>')
+
+
+def search_tickets(text, user_id=None, is_developer=False, filters=None, limit=SEARCH_LIMIT):
+    """Busca tickets por relevancia (bm25) respetando la visibilidad
+
+    Desarrolladores ven todos los tickets; los demás usuarios solo los suyos,
+    igual que en view_ticket.
+    """
+    match = build_match_query(text)
+    if not match:
+        return []
+
+    limit = max(1, min(int(limit), SEARCH_LIMIT_MAX))
+    conditions = ['ticket_search MATCH ?']
+    params = [match]
+
+    if not is_developer:
+        conditions.append('t.user_id = ?')
+        params.append(user_id)
+
+    for column in SEARCH_FILTERS:
+        value = (filters or {}).get(column)
+        if value:
+            conditions.append(f't.{column} = ?')
+            params.append(value)
+
+    weights = ', '.join(str(weight) for weight in BM25_WEIGHTS)
+    with db_connection() as conn:
+        cursor = conn.cursor()
+        try:
+            cursor.execute(f'''
+                SELECT t.id, t.title, t.status, t.category, t.priority, t.created_at,
+                       u.username as user_name, d.username as developer_name,
+                       highlight(ticket_search, 0, ?, ?) as title_html,
+                       snippet(ticket_search, -1, ?, ?, '…', {SNIPPET_TOKENS}) as snippet_html,
+                       bm25(ticket_search, {weights}) as score
+                FROM ticket_search
+                JOIN tickets t ON t.id = ticket_search.rowid
+                LEFT JOIN users u ON t.user_id = u.id
+                LEFT JOIN users d ON t.assigned_to = d.id
+                WHERE {' AND '.join(conditions)}
+                ORDER BY score
+                LIMIT ?
+            ''', [MARK_START, MARK_END, MARK_START, MARK_END] + params + [limit])
+        except sqlite3.OperationalError as e:
+            if 'no such table' in str(e):
+                raise SearchUnavailableError('Índice de búsqueda no disponible') from e
+            raise
+        rows = cursor.fetchall()
+
+    results = []
+    for row in rows:
+        results.append({
+            'id': row[0],
+            'title': row[1],
+            'status': row[2],
+            'category': row[3],
+            'priority': row[4],
+            'created_at': row[5],
+            'user_name': row[6],
+            'developer_name': row[7],
+            'title_html': _highlight(row[8]),
+            'snippet_html': _highlight(row[9]),
+            'score': round(-row[10], 6),
+        })
+    return results
+
+
+if __name__ == "__main__":
+    # Uso: python ticket_search.py [rebuild] | python ticket_search.py buscar <texto>
+    command = sys.argv[1] if len(sys.argv) > 1 else 'rebuild'
+
+    with db_connection() as conn:
+        if not install_search(conn):
+            sys.exit(1)
+        if command == 'rebuild':
+            rebuild_search(conn)
+            conn.commit()
+            print("✅ Índice de búsqueda reconstruido")
+
+    if command == 'buscar':
+        text = ' '.join(sys.argv[2:])
+        for result in search_tickets(text, is_developer=True):
+            print(f"🔍 #{result['id']} [{result['score']}] {result['title']} - {result['snippet_html']}")
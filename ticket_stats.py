@@ -0,0 +1,299 @@
+"""
+Motor de estadísticas del Sistema de Tickets
+Contadores materializados mantenidos por triggers y cacheados en memoria hasta que cambien los datos
+"""
+
+import sys
+import threading
+import time
+
+from db_pool import db_connection
+
+# Configuración
+STATS_CACHE_TTL = 300  # Segundos; red de seguridad ante cambios hechos fuera de la app
+COUNTERS_VERSION = 1
+
+PRIORITY_ORDER = {'Critical': 1, 'High': 2, 'Medium': 3, 'Low': 4}
+
+RESOLUTION_HOURS = "(julianday({row}.resolved_at) - julianday({row}.created_at)) * 24"
+
+
+def _bump(dimension, key, delta):
+    """SQL que suma delta a un contador, creándolo si no existe"""
+    return f"""
+        INSERT OR IGNORE INTO stats_counters (dimension, key, value) VALUES ('{dimension}', {key}, 0);
+        UPDATE stats_counters SET value = value + ({delta}) WHERE dimension = '{dimension}' AND key = {key};"""
+
+
+def _ticket_delta(row, sign):
+    """Cuerpo de trigger que suma (+1) o resta (-1) una fila de tickets"""
+    hours = RESOLUTION_HOURS.format(row=row)
+    return ''.join([
+        _bump('status', f"IFNULL({row}.status, '')", sign),
+        _bump('category', f"IFNULL({row}.category, '')", sign),
+        _bump('priority', f"IFNULL({row}.priority, '')", sign),
+        _bump('totals', "'resolved_count'", f"{sign} * ({hours} IS NOT NULL)"),
+        _bump('totals', "'resolution_hours'", f"{sign} * IFNULL({hours}, 0)"),
+    ])
+
+
+def _user_delta(row, sign):
+    """Cuerpo de trigger que suma o resta un usuario a los contadores de activos"""
+    return ''.join([
+        _bump('totals', "'active_users'", f"{sign} * ({row}.is_active IS 1)"),
+        _bump('totals', "'active_developers'", f"{sign} * ({row}.is_active IS 1 AND {row}.is_developer IS 1)"),
+    ])
+
+
+PRUNE_EMPTY = """
+        DELETE FROM stats_counters WHERE dimension IN ('status', 'category', 'priority') AND value <= 0;"""
+
+COUNTER_TRIGGERS = {
+    'stats_tickets_insert': f"AFTER INSERT ON tickets BEGIN{_ticket_delta('NEW', 1)}\n    END",
+    'stats_tickets_delete': f"AFTER DELETE ON tickets BEGIN{_ticket_delta('OLD', -1)}{PRUNE_EMPTY}\n    END",
+    'stats_tickets_update': (
+        "AFTER UPDATE OF status, category, priority, created_at, resolved_at ON tickets "
+        f"BEGIN{_ticket_delta('OLD', -1)}{_ticket_delta('NEW', 1)}{PRUNE_EMPTY}\n    END"
+    ),
+    'stats_comments_insert': "AFTER INSERT ON comments BEGIN" + _bump('totals', "'comments'", 1) + "\n    END",
+    'stats_comments_delete': "AFTER DELETE ON comments BEGIN" + _bump('totals', "'comments'", -1) + "\n    END",
+    'stats_users_insert': f"AFTER INSERT ON users BEGIN{_user_delta('NEW', 1)}\n    END",
+    'stats_users_delete': f"AFTER DELETE ON users BEGIN{_user_delta('OLD', -1)}\n    END",
+    'stats_users_update': (
+        "AFTER UPDATE OF is_active, is_developer ON users "
+        f"BEGIN{_user_delta('OLD', -1)}{_user_delta('NEW', 1)}\n    END"
+    ),
+}
+
+
+def install_counters(conn):
+    """Crea la tabla de contadores y sus triggers; reconstruye si es nueva o de otra versión"""
+    cursor = conn.cursor()
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS stats_counters (
+            dimension TEXT NOT NULL,
+            key TEXT NOT NULL,
+            value REAL NOT NULL DEFAULT 0,
+            PRIMARY KEY (dimension, key)
+        ) WITHOUT ROWID
+    ''')
+
+    for name, body in COUNTER_TRIGGERS.items():
+        cursor.execute(f'CREATE TRIGGER IF NOT EXISTS {name} {body}')
+
+    cursor.execute("SELECT value FROM stats_counters WHERE dimension = 'meta' AND key = 'version'")
+    row = cursor.fetchone()
+    if not row or int(row[0]) != COUNTERS_VERSION:
+        rebuild_counters(conn)
+    conn.commit()
+
+
+def rebuild_counters(conn):
+    """Recalcula todos los contadores desde las tablas base (dentro de la transacción actual)"""
+    cursor = conn.cursor()
+    cursor.execute('DELETE FROM stats_counters')
+
+    for dimension in ('status', 'category', 'priority'):
+        cursor.execute(f'''
+            INSERT INTO stats_counters (dimension, key, value)
+            SELECT '{dimension}', IFNULL({dimension}, ''), COUNT(*)
+            FROM tickets
+            GROUP BY IFNULL({dimension}, '')
+        ''')
+
+    hours = RESOLUTION_HOURS.format(row='tickets')
+    cursor.execute(f'''
+        INSERT INTO stats_counters (dimension, key, value)
+        SELECT 'totals', 'resolved_count', COUNT({hours}) FROM tickets
+        UNION ALL
+        SELECT 'totals', 'resolution_hours', IFNULL(SUM({hours}), 0) FROM tickets
+        UNION ALL
+        SELECT 'totals', 'comments', COUNT(*) FROM comments
+        UNION ALL
+        SELECT 'totals', 'active_users', COUNT(*) FROM users WHERE is_active IS 1
+        UNION ALL
+        SELECT 'totals', 'active_developers', COUNT(*) FROM users WHERE is_active IS 1 AND is_developer IS 1
+        UNION ALL
+        SELECT 'meta', 'version', ?
+    ''', (COUNTERS_VERSION,))
+
+
+class StatisticsEngine:
+    def __init__(self, ttl=STATS_CACHE_TTL):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._cache = None
+        self._cached_at = 0.0
+        self._version = 0
+
+        self.metrics = {
+            'hits': 0,
+            'recomputes': 0,
+            'invalidations': 0,
+            'last_compute_ms': 0.0,
+            'total_compute_ms': 0.0,
+        }
+
+    def invalidate(self):
+        """Marca la caché como obsoleta (llamar desde los caminos de escritura)"""
+        with self._lock:
+            self._version += 1
+            self._cache = None
+            self.metrics['invalidations'] += 1
+
+    def get_statistics(self):
+        """Devuelve las estadísticas, recalculándolas solo si la caché no es válida"""
+        with self._lock:
+            if self._cache is not None and time.time() - self._cached_at < self.ttl:
+                self.metrics['hits'] += 1
+                return self._cache
+            version = self._version
+
+        started = time.perf_counter()
+        stats = self.compute()
+        elapsed_ms = (time.perf_counter() - started) * 1000
+
+        with self._lock:
+            self.metrics['recomputes'] += 1
+            self.metrics['last_compute_ms'] = round(elapsed_ms, 2)
+            self.metrics['total_compute_ms'] += elapsed_ms
+            # Si hubo una escritura durante el cálculo no se guarda el resultado
+            if version == self._version:
+                self._cache = stats
+                self._cached_at = time.time()
+        return stats
+
+    def compute(self):
+        """Lee los contadores materializados: O(1) respecto al número de tickets"""
+        with db_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('SELECT dimension, key, value FROM stats_counters')
+            rows = cursor.fetchall()
+
+        counters = {}
+        for dimension, key, value in rows:
+            counters.setdefault(dimension, {})[key] = value
+        totals = counters.get('totals', {})
+
+        return self._build(
+            {key: int(value) for key, value in counters.get('status', {}).items()},
+            {key: int(value) for key, value in counters.get('category', {}).items()},
+            {key: int(value) for key, value in counters.get('priority', {}).items()},
+            int(totals.get('resolved_count', 0)),
+            totals.get('resolution_hours', 0),
+            int(totals.get('active_users', 0)),
+            int(totals.get('active_developers', 0)),
+            int(totals.get('comments', 0))
+        )
+
+    def compute_from_scan(self):
+        """Calcula todos los agregados con un único recorrido de tickets (referencia para verificar)"""
+        with db_connection() as conn:
+            cursor = conn.cursor()
+
+            # Un solo GROUP BY produce un cubo pequeño del que se derivan todos los totales
+            cursor.execute('''
+                SELECT status, category, priority,
+                       COUNT(*),
+                       COUNT((julianday(resolved_at) - julianday(created_at)) * 24),
+                       SUM((julianday(resolved_at) - julianday(created_at)) * 24)
+                FROM tickets
+                GROUP BY status, category, priority
+            ''')
+            cube = cursor.fetchall()
+
+            cursor.execute('''
+                SELECT COALESCE(SUM(is_active IS 1), 0),
+                       COALESCE(SUM(is_developer IS 1 AND is_active IS 1), 0),
+                       (SELECT COUNT(*) FROM comments)
+                FROM users
+            ''')
+            total_users, total_developers, total_comments = cursor.fetchone()
+
+        by_status = {}
+        by_category = {}
+        by_priority = {}
+        resolved_count = 0
+        resolution_hours = 0.0
+
+        for status, category, priority, count, resolved, hours in cube:
+            status, category, priority = status or '', category or '', priority or ''
+            by_status[status] = by_status.get(status, 0) + count
+            by_category[category] = by_category.get(category, 0) + count
+            by_priority[priority] = by_priority.get(priority, 0) + count
+            resolved_count += resolved
+            resolution_hours += hours or 0
+
+        return self._build(by_status, by_category, by_priority, resolved_count, resolution_hours,
+                           total_users, total_developers, total_comments)
+
+    def _build(self, by_status, by_category, by_priority, resolved_count, resolution_hours,
+               total_users, total_developers, total_comments):
+        """Arma el diccionario de estadísticas con el formato que esperan las plantillas"""
+        avg_resolution_time = resolution_hours / resolved_count if resolved_count else 0
+
+        return {
+            'total_tickets': sum(by_status.values()),
+            'open_tickets': by_status.get('Abierto', 0),
+            'in_progress_tickets': by_status.get('En Progreso', 0),
+            'resolved_tickets': by_status.get('Resuelto', 0),
+            'tickets_by_category': sorted(by_category.items(), key=lambda item: -item[1]),
+            'tickets_by_priority': sorted(by_priority.items(),
+                                          key=lambda item: PRIORITY_ORDER.get(item[0], 0)),
+            'avg_resolution_hours': round(avg_resolution_time, 1),
+            'total_users': total_users,
+            'total_developers': total_developers,
+            'total_comments': total_comments
+        }
+
+    def verify(self):
+        """Compara los contadores con un recorrido completo; devuelve las diferencias"""
+        expected = self.compute_from_scan()
+        actual = self.compute()
+        differences = {}
+        for key, value in expected.items():
+            other = actual.get(key)
+            if isinstance(value, list):
+                value, other = sorted(value), sorted(other or [])
+            if value != other:
+                differences[key] = {'counters': other, 'scan': value}
+        return differences
+
+    def rebuild(self):
+        """Reconstruye los contadores desde cero e invalida la caché"""
+        with db_connection() as conn:
+            rebuild_counters(conn)
+            conn.commit()
+        self.invalidate()
+
+    def get_metrics(self):
+        """Estado de la caché: antigüedad y coste del último recálculo"""
+        with self._lock:
+            metrics = dict(self.metrics)
+            metrics['total_compute_ms'] = round(metrics['total_compute_ms'], 2)
+            metrics['cached'] = self._cache is not None
+            metrics['cache_age_seconds'] = round(time.time() - self._cached_at, 1) if self._cache is not None else None
+            metrics['ttl_seconds'] = self.ttl
+        return metrics
+
+
+if __name__ == "__main__":
+    # Uso: python ticket_stats.py [check|rebuild]
+    command = sys.argv[1] if len(sys.argv) > 1 else 'check'
+    engine = StatisticsEngine()
+
+    with db_connection() as conn:
+        install_counters(conn)
+
+    if command == 'rebuild':
+        engine.rebuild()
+        print("✅ Contadores de estadísticas reconstruidos")
+
+    differences = engine.verify()
+    if differences:
+        print("❌ Contadores inconsistentes:")
+        for key, diff in differences.items():
+            print(f"   - {key}: contadores={diff['counters']} recorrido={diff['scan']}")
+        print("💡 Ejecuta: python ticket_stats.py rebuild")
+        sys.exit(1)
+    print("✅ Contadores de estadísticas consistentes")
@@ -0,0 +1,211 @@
+"""
+Recepción de adjuntos por streaming del Sistema de Tickets
+Cada archivo del formulario multipart se escribe directamente en el almacén por contenido
+mientras se recibe: se calcula su hash, se detecta el tipo MIME por los primeros bytes y
+se aplican los límites de tamaño antes de terminar de leer la petición
+"""
+
+import threading
+import time
+
+from flask import Request
+from werkzeug.exceptions import RequestEntityTooLarge
+
+from attachment_store import attachment_store
+
+# Configuración
+MAX_ATTACHMENT_SIZE = 25 * 1024 * 1024        # Por archivo
+MAX_UPLOAD_REQUEST_SIZE = 100 * 1024 * 1024   # Por petición (MAX_CONTENT_LENGTH)
+MAX_ATTACHMENTS_PER_REQUEST = 10
+SNIFF_BYTES = 2048                            # Bytes iniciales usados para detectar el tipo
+
+# Firmas de los tipos permitidos (ALLOWED_EXTENSIONS)
+MIME_SIGNATURES = [
+    (b'\x89PNG\r\n\x1a\n', 'image/png'),
+    (b'\xff\xd8\xff', 'image/jpeg'),
+    (b'GIF87a', 'image/gif'),
+    (b'GIF89a', 'image/gif'),
+    (b'%PDF-', 'application/pdf'),
+    (b'PK\x03\x04', 'application/zip'),
+]
+DOCX_MIME = 'application/vnd.openxmlformats-officedocument.wordprocessingml.document'
+
+
+def sniff_mime(head, filename=''):
+    """Tipo MIME según el contenido (no el que declara el navegador)"""
+    for signature, mime in MIME_SIGNATURES:
+        if head.startswith(signature):
+            if mime == 'application/zip' and filename.lower().endswith('.docx'):
+                return DOCX_MIME
+            return mime
+    if b'\x00' not in head:
+        try:
+            # Un carácter multibyte puede quedar cortado al final de la muestra
+            head.decode('utf-8')
+            return 'text/plain'
+        except UnicodeDecodeError as e:
+            if e.start >= len(head) - 3:
+                return 'text/plain'
+    return 'application/octet-stream'
+
+
+class IngestMetrics:
+    """Archivos, bytes y rendimiento de las subidas recibidas"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.files = 0
+        self.bytes = 0
+        self.seconds = 0.0
+        self.rejected = 0
+        self.deduplicated = 0
+        self.last_mb_per_s = None
+
+    def record(self, size, seconds, deduplicated):
+        with self._lock:
+            self.files += 1
+            self.bytes += size
+            self.seconds += seconds
+            if deduplicated:
+                self.deduplicated += 1
+            if seconds > 0:
+                self.last_mb_per_s = round(size / seconds / (1024 * 1024), 2)
+
+    def reject(self):
+        with self._lock:
+            self.rejected += 1
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'files': self.files,
+                'bytes': self.bytes,
+                'rejected': self.rejected,
+                'deduplicated': self.deduplicated,
+                'avg_mb_per_s': round(self.bytes / self.seconds / (1024 * 1024), 2) if self.seconds else None,
+                'last_mb_per_s': self.last_mb_per_s,
+                'max_file_bytes': MAX_ATTACHMENT_SIZE,
+                'max_request_bytes': MAX_UPLOAD_REQUEST_SIZE,
+            }
+
+
+ingest_metrics = IngestMetrics()
+
+
+class IngestStream:
+    """Destino de un archivo del formulario: escribe en el almacén a medida que llega
+
+    Werkzeug llama a write() con cada bloque y a seek(0) al terminar la parte.
+    Los archivos con extensión no permitida se descartan sin tocar el disco.
+    """
+
+    def __init__(self, filename, accepted):
+        self.filename = filename or ''
+        self.accepted = accepted
+        self.size = 0
+        self.started = time.perf_counter()
+        self._head = b''
+        self._writer = attachment_store.open_writer() if accepted else None
+        self.blob = None
+
+    def write(self, data):
+        self.size += len(data)
+        if self.size > MAX_ATTACHMENT_SIZE:
+            self.close()
+            ingest_metrics.reject()
+            raise RequestEntityTooLarge(
+                f'El archivo {self.filename} supera el máximo de {MAX_ATTACHMENT_SIZE // (1024 * 1024)} MB'
+            )
+        if self._writer is not None:
+            if len(self._head) < SNIFF_BYTES:
+                self._head += data[:SNIFF_BYTES - len(self._head)]
+            self._writer.write(data)
+        return len(data)
+
+    def seek(self, offset, whence=0):
+        return 0
+
+    def tell(self):
+        return self.size
+
+    def finish(self):
+        """Guarda el archivo por su hash y devuelve los datos del contenido"""
+        if self.blob is None:
+            if self._writer is None:
+                # Ya descartado (límite superado o petición cerrada): rechazo limpio, no un 500
+                raise RequestEntityTooLarge(f'El archivo {self.filename} no se recibió completo')
+            self.blob = self._writer.finish(sniff_mime(self._head, self.filename))
+            attachment_store.count(self.blob)
+            ingest_metrics.record(self.size, time.perf_counter() - self.started, self.blob['deduplicated'])
+        return self.blob
+
+    def close(self):
+        """Descarta el temporal si el archivo no llegó a guardarse"""
+        if self._writer is not None and self.blob is None:
+            self._writer.abort()
+            self._writer = None
+
+
+class StreamingUploadRequest(Request):
+    """Request de Flask que envía los archivos subidos a IngestStream
+
+    Se activa con app.request_class = StreamingUploadRequest. El tamaño total
+    lo limita MAX_CONTENT_LENGTH (Werkzeug responde 413 sin leer el cuerpo si
+    Content-Length ya lo supera).
+    """
+
+    allowed_extensions = None      # Conjunto de extensiones; None admite todas
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        streams = self.__dict__.setdefault('_ingest_streams', [])
+        if content_length and content_length > MAX_ATTACHMENT_SIZE:
+            ingest_metrics.reject()
+            raise RequestEntityTooLarge(f'El archivo {filename} es demasiado grande')
+        accepted = bool(filename) and self.is_allowed(filename)
+        if accepted and sum(1 for stream in streams if stream.accepted) >= MAX_ATTACHMENTS_PER_REQUEST:
+            ingest_metrics.reject()
+            raise RequestEntityTooLarge(f'Máximo {MAX_ATTACHMENTS_PER_REQUEST} archivos por ticket')
+        stream = IngestStream(filename, accepted)
+        streams.append(stream)
+        return stream
+
+    def is_allowed(self, filename):
+        if self.allowed_extensions is None:
+            return True
+        return '.' in filename and filename.rsplit('.', 1)[1].lower() in self.allowed_extensions
+
+    def close(self):
+        super().close()
+        # Partes a medio recibir (petición cortada o rechazada) no llegan a request.files
+        for stream in self.__dict__.get('_ingest_streams', ()):
+            stream.close()
+
+
+def init_app(app, allowed_extensions=None):
+    """Activa la recepción por streaming y los límites de tamaño en la aplicación"""
+    app.config.setdefault('MAX_CONTENT_LENGTH', MAX_UPLOAD_REQUEST_SIZE)
+    StreamingUploadRequest.allowed_extensions = allowed_extensions
+    app.request_class = StreamingUploadRequest
+
+
+def collect_uploads(files):
+    """Contenidos guardados de una lista de FileStorage: dicts con 'original_name' y 'blob'
+
+    Los archivos rechazados (sin nombre o extensión no permitida) se omiten.
+    Si la aplicación no usa StreamingUploadRequest, el archivo se copia al
+    almacén por bloques desde el stream de Werkzeug.
+    """
+    uploads = []
+    for file in files:
+        stream = file.stream
+        if isinstance(stream, IngestStream):
+            if stream.accepted:
+                uploads.append({'original_name': file.filename, 'blob': stream.finish()})
+        elif file and file.filename:
+            uploads.append({'original_name': file.filename,
+                            'blob': attachment_store.save_stream(stream, file.mimetype)})
+    return uploads
+
+
+def get_ingest_metrics():
+    return ingest_metrics.snapshot()